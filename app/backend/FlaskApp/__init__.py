@@ -1,22 +1,37 @@
+import json
 import logging
-import mimetypes
 import os
 import re
+import shutil
+import time
 from tempfile import mkdtemp
 
 import azure.functions as func
 import magic
-from flask import Flask, jsonify, request
+from azure.core.exceptions import ResourceNotFoundError
+from flask import Flask, Response, abort, g, jsonify, request, stream_with_context
+from werkzeug.wsgi import wrap_file
 
+from .approaches.agentrun import tool_results
 from .approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from .approaches.readdecomposeask import ReadDecomposeAsk
 from .approaches.readretrieveread import ReadRetrieveReadApproach
 from .approaches.retrievethenread import RetrieveThenReadApproach
 # Always use relative import for custom module
-from .clients import (AZURE_OPENAI_CHATGPT_DEPLOYMENT,
-                      AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_CONTENT, KB_FIELDS_SOURCEPAGE, blob_container,
-                      ensure_openai_token, search_client)
+from .aio import event_loop
+from .answercache import AnswerCache
+from .asgi import AsgiAdapter
+from .batch import answer_batch
+from .clients import (ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL, AZURE_OPENAI_CHATGPT_DEPLOYMENT, AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+                      AZURE_OPENAI_GPT_DEPLOYMENT, BATCH_CONCURRENCY, BATCH_MAX_QUESTIONS, BATCH_PACK_SIZE, CONTENT_CACHE_MAX_BLOB_BYTES, CONTENT_CACHE_MAX_BYTES, CONTENT_CACHE_TTL, CONTENT_CHUNK_BYTES, INGESTION_QUEUE_PATH, INGESTION_WORKERS, KB_FIELDS_CONTENT, KB_FIELDS_SOURCEPAGE, TRACING_ENABLED, blob_container,
+                      embedding_client, ensure_openai_token, openai_endpoints, rate_limiter, search_client)
 from .cog_services import process_pdf
+from .contentcache import ContentCache
+from .ingestion import IngestionWorkers, SqliteJobQueue
+from .metrics import http_latency, http_requests, registry
+from .promptbudget import load_encodings
+from .ratelimit import RateLimitExceeded
+from .tracing import start_trace
 
 # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
 # or some derivative, here we include several for exploration purposes
@@ -30,38 +45,161 @@ chat_approaches = {
     "rrr": ChatReadRetrieveReadApproach(search_client, AZURE_OPENAI_CHATGPT_DEPLOYMENT, AZURE_OPENAI_GPT_DEPLOYMENT, KB_FIELDS_SOURCEPAGE, KB_FIELDS_CONTENT)
 }
 
+# The approaches count prompt tokens with these models' tokenizers, so don't leave loading them to the first request
+load_encodings([AZURE_OPENAI_GPT_DEPLOYMENT, AZURE_OPENAI_CHATGPT_DEPLOYMENT])
+
+# Deterministic /ask answers are cached, near-duplicate questions are matched by embedding if a deployment is configured
+answer_cache = AnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL,
+                           embed=(lambda q: embedding_client(q, AZURE_OPENAI_EMBEDDING_DEPLOYMENT)) if AZURE_OPENAI_EMBEDDING_DEPLOYMENT else None,
+                           similarity=ANSWER_CACHE_SIMILARITY)
+
+content_cache = ContentCache(blob_container, CONTENT_CACHE_MAX_BYTES, CONTENT_CACHE_MAX_BLOB_BYTES, CONTENT_CACHE_TTL, CONTENT_CHUNK_BYTES)
+
+# Uploaded files are ingested in the background, the upload route only persists the file and queues a job
+def ingest_file(filename, progress):
+    try:
+        with start_trace("ingest", TRACING_ENABLED, file=os.path.basename(filename)):
+            return process_pdf(filename, progress=progress)
+    finally:
+        shutil.rmtree(os.path.dirname(filename), ignore_errors=True)
+
+ingestion_workers = IngestionWorkers(SqliteJobQueue(INGESTION_QUEUE_PATH), ingest_file, INGESTION_WORKERS)
+
 app = Flask(__name__)
+# Async views share one background event loop instead of starting a new one per request
+app.async_to_sync = event_loop.async_to_sync # type: ignore
+
+# Request rate and latency per route and approach, see metrics.py. Streamed responses are timed until they start.
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "other"
+    approach = ""
+    if request.method == "POST" and request.mimetype != "multipart/form-data":
+        req = request.get_json(silent=True, force=True)
+        approach = str(req.get("approach") or "") if isinstance(req, dict) else ""
+        if approach and approach not in ask_approaches and approach not in chat_approaches:
+            approach = "unknown"
+    http_requests.inc(route, approach, str(response.status_code))
+    http_latency.observe(time.perf_counter() - g.request_start, route, approach)
+    return response
+
+# Statistics kept by the caches, the OpenAI endpoint pool and the rate limiter, read when metrics are scraped
+def app_metrics():
+    answers = answer_cache.stats()
+    caches = {
+        "answers": (answers["hits"], answers["misses"], answers["entries"]),
+        "content": (content_cache.entries.hits, content_cache.entries.misses, len(content_cache.entries)),
+        "agent_tools": (tool_results.hits, tool_results.misses, len(tool_results))}
+    yield "cache_hits_total", "counter", "Cache lookups that found an entry", [({"cache": name}, hits) for name, (hits, _, _) in caches.items()]
+    yield "cache_misses_total", "counter", "Cache lookups that found no entry", [({"cache": name}, misses) for name, (_, misses, _) in caches.items()]
+    yield "cache_hit_ratio", "gauge", "Hits over lookups since startup", [({"cache": name}, hits / (hits + misses) if hits + misses else 0.0) for name, (hits, misses, _) in caches.items()]
+    yield "cache_entries", "gauge", "Entries in the cache", [({"cache": name}, entries) for name, (_, _, entries) in caches.items()]
+    endpoints = openai_endpoints.metrics()
+    yield "openai_endpoint_in_flight", "gauge", "Calls in flight per Azure OpenAI endpoint", [({"endpoint": e["name"]}, e["in_flight"]) for e in endpoints]
+    yield "openai_endpoint_calls_total", "counter", "Calls per Azure OpenAI endpoint, including failed ones", [({"endpoint": e["name"]}, e["requests"]) for e in endpoints]
+    yield "openai_endpoint_errors_total", "counter", "Failed calls per Azure OpenAI endpoint", [({"endpoint": e["name"]}, e["errors"]) for e in endpoints]
+    limits = rate_limiter.metrics()
+    yield "rate_limiter_calls_total", "counter", "Calls through the client side rate limiter by outcome", [({"outcome": outcome}, limits[outcome]) for outcome in ("admitted", "delayed", "rejected")]
+    yield "rate_limiter_wait_seconds_total", "counter", "Time calls spent waiting for the rate limiter", [({}, limits["wait_seconds"])]
+
+registry.register_collector(app_metrics)
 
 # Serve content files from blob storage from within the app to keep the example self-contained. 
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. Hot page blobs are served from memory, larger ones are streamed in chunks, and Range
+# and conditional (ETag / Last-Modified) requests are answered with 206 and 304 responses.
 @app.route("/api/content/<path>")
 def content_file(path):
-    blob = blob_container.get_blob_client(path).download_blob()
-    mime_type = blob.properties["content_settings"]["content_type"] # type: ignore
-    if mime_type == "application/octet-stream":
-        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    return blob.readall(), 200, {"Content-Type": mime_type, "Content-Disposition": f"inline; filename={path}"}
+    try:
+        entry = content_cache.get(path)
+    except ResourceNotFoundError:
+        abort(404)
+    response = Response(wrap_file(request.environ, content_cache.open(path, entry), CONTENT_CHUNK_BYTES), mimetype=entry["content_type"], direct_passthrough=True)
+    response.headers["Content-Disposition"] = f"inline; filename={path}"
+    response.content_length = entry["size"]
+    response.set_etag(entry["etag"])
+    response.last_modified = entry["last_modified"]
+    return response.make_conditional(request, accept_ranges=True, complete_length=entry["size"])
+
+# Traced requests log their stage timings, and return them in the response's "timings" when asked to with the
+# include_timings override
+def with_timings(r: dict, trace, overrides: dict, route: str) -> dict:
+    timings = trace.timings()
+    if timings is None:
+        return r
+    logging.info(f"{route} timings: {timings['stages']} total {timings['total_ms']} ms")
+    if not overrides.get("include_timings"):
+        return r
+    return {**r, "timings": {**(r.get("timings") or {}), **timings}}
+
+def too_many_requests(e: RateLimitExceeded):
+    logging.warning(str(e))
+    return jsonify({"error": "Too many requests, please try again shortly"}), 429, {"Retry-After": str(e.retry_after)}
 
 @app.route("/api/ask", methods=["POST"])
-def ask():
+async def ask():
     req = request.get_json(silent=True, force=True)
-    logging.info(f"ask request: {req}")
+    logging.debug(f"ask request: {req}")
     # ensure_openai_token()
     approach = req["approach"] # type: ignore
     try:
         impl = ask_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(req["question"], req["overrides"] or {}) # type: ignore
-        logging.info(f"ask response: {r}")
-        return jsonify(r)
+        overrides = req["overrides"] or {} # type: ignore
+        with start_trace("ask", TRACING_ENABLED or bool(overrides.get("include_timings")), approach=approach) as trace:
+            r = await answer_cache.aget_or_compute(approach, req["question"], overrides, lambda: impl.arun(req["question"], overrides)) # type: ignore
+        logging.debug(f"ask response: {r}")
+        return jsonify(with_timings(r, trace, overrides, "ask"))
+    except RateLimitExceeded as e:
+        return too_many_requests(e)
     except Exception as e:
         logging.exception("Exception in /ask")
         return jsonify({"error": str(e)}), 500
 
+# Many questions with the same approach and overrides, e.g. an evaluation suite. The response is newline delimited
+# JSON with one line per question as soon as it is answered, each with the question's index in the request and
+# either the /ask response or an error.
+@app.route("/api/ask/batch", methods=["POST"])
+def ask_batch():
+    req = request.get_json(silent=True, force=True)
+    approach = req["approach"] # type: ignore
+    impl = ask_approaches.get(approach)
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    questions = req.get("questions") or [] # type: ignore
+    if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+        return jsonify({"error": "questions must be a list of strings"}), 400
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"at most {BATCH_MAX_QUESTIONS} questions per batch"}), 400
+    lines = answer_batch(impl, approach, questions, req.get("overrides") or {}, answer_cache, BATCH_CONCURRENCY, BATCH_PACK_SIZE, TRACING_ENABLED) # type: ignore
+    def generate():
+        try:
+            for line in event_loop.iterate(lines):
+                yield json.dumps(line) + "\n"
+        except Exception as e:
+            logging.exception("Exception in /ask/batch")
+            yield json.dumps({"error": str(e)}) + "\n"
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/api/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify({"answers": answer_cache.stats()})
+
+@app.route("/api/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/api/endpoints", methods=["GET"])
+def endpoint_metrics():
+    return jsonify({"endpoints": openai_endpoints.metrics(), "rate_limits": rate_limiter.metrics()})
+
 @app.route("/api/chat", methods=["POST"])
-def chat():
+async def chat():
     req = request.get_json(silent=True, force=True)
     ensure_openai_token()
     approach = req["approach"] # type: ignore
@@ -69,12 +207,49 @@ def chat():
         impl = chat_approaches.get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = impl.run(req["history"], req["overrides"] or {}) # type: ignore
-        return jsonify(r)
+        overrides = req["overrides"] or {} # type: ignore
+        with start_trace("chat", TRACING_ENABLED or bool(overrides.get("include_timings")), approach=approach) as trace:
+            r = await impl.arun(req["history"], overrides) # type: ignore
+        return jsonify(with_timings(r, trace, overrides, "chat"))
+    except RateLimitExceeded as e:
+        return too_many_requests(e)
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
 
+# Server-sent events: each event is a JSON payload. Clients get the data points first, then "answer" events with
+# the answer text as it is generated, then an "end" event with the thoughts (or an "error" event if it fails).
+def event_stream(events, route):
+    def generate():
+        try:
+            for event, data in events:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        except Exception as e:
+            logging.exception(f"Exception in {route}")
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/api/ask/stream", methods=["POST"])
+def ask_stream():
+    req = request.get_json(silent=True, force=True)
+    impl = ask_approaches.get(req["approach"]) # type: ignore
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    if not hasattr(impl, "run_stream"):
+        return jsonify({"error": "approach does not support streaming"}), 400
+    return event_stream(impl.run_stream(req["question"], req["overrides"] or {}), "/ask/stream") # type: ignore
+
+@app.route("/api/chat/stream", methods=["POST"])
+def chat_stream():
+    req = request.get_json(silent=True, force=True)
+    ensure_openai_token()
+    impl = chat_approaches.get(req["approach"]) # type: ignore
+    if not impl:
+        return jsonify({"error": "unknown approach"}), 400
+    if not hasattr(impl, "run_stream"):
+        return jsonify({"error": "approach does not support streaming"}), 400
+    return event_stream(impl.run_stream(req["history"], req["overrides"] or {}), "/chat/stream") # type: ignore
+
 @app.route("/api/upload", methods=["POST"]) # type: ignore
 def upload():
     req = request
@@ -84,7 +259,7 @@ def upload():
              "Please upload at least one file",
              status_code=400
         )
-    status = {}
+    jobs = {}
     # Process each file
     for _, file in req.files.items(multi=True): # type: ignore
         file_name = file.filename
@@ -108,13 +283,34 @@ def upload():
             elif file_type == "image/jpeg":
                 logging.info("jpeg image")
             elif file_type == "application/pdf":
-                logging.info(f"pdf file - processing - {file_to_process}")
-                process_pdf(file_to_process)
+                logging.info(f"pdf file - queueing - {file_to_process}")
             else:
                 logging.info("unknown file type")
+        # Queue only once the file is closed so the worker never sees a partial write
+        if file_type == "application/pdf":
+            jobs[file_name] = ingestion_workers.submit(file_to_process, file_name)
 
-    logging.info(status)
+    logging.info(jobs)
+    if jobs:
+        return jsonify({ "success":True,"message":"Files queued for processing.","jobs":jobs}), 202
     return jsonify({ "success":True,"message":"Files processed successfully."}), 200
 
+@app.route("/api/upload/<job_id>", methods=["GET"])
+def upload_status(job_id):
+    job = ingestion_workers.queue.get(job_id)
+    if not job:
+        return jsonify({"error": "unknown job"}), 404
+    return jsonify({
+        "id": job["id"],
+        "file": job["source_name"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "stages": job["stages"],
+        "result": job["result"],
+        "error": job["error"]})
+
+# The Functions host serves the app through this, see HandleApproach/__init__.py
+asgi_app = AsgiAdapter(app)
+
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
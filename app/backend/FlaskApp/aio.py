@@ -0,0 +1,83 @@
+import asyncio
+import atexit
+import functools
+import inspect
+import logging
+import threading
+import weakref
+
+# The app's async work runs on one event loop in a background thread. Flask's async views are handed to it instead
+# of getting a new event loop per request, so many requests wait on network I/O concurrently on the same loop and the
+# HTTP sessions and async clients created on it are reused from one request to the next. Coroutines scheduled here
+# keep the caller's context variables, e.g. Flask's request context. Served through asgi.py instead, async views run
+# on the ASGI server's own loop. Either way the sessions and clients created on a loop are closed when it stops.
+
+class EventLoopThread:
+    def __init__(self, name: str = "event-loop"):
+        self.name = name
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name=self.name, daemon=True).start()
+            return self.loop
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop()).result()
+
+    def iterate(self, agen):
+        # Iterate an async generator from synchronous code, e.g. a streamed response body
+        try:
+            while True:
+                try:
+                    yield self.run(agen.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(agen.aclose())
+
+    def async_to_sync(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.run(func(*args, **kwargs))
+        return wrapper
+
+    def stop(self):
+        # Close the sessions and clients created on the loop, then stop it. A later run() starts a new loop.
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(close_loop_local(), loop).result(timeout=10)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+
+event_loop = EventLoopThread()
+atexit.register(event_loop.stop)
+
+loop_values = weakref.WeakKeyDictionary()
+
+def loop_local(name: str, factory):
+    """Return the value for name on the running event loop, creating it with factory() the first time."""
+    values = loop_values.setdefault(asyncio.get_running_loop(), {})
+    if name not in values:
+        values[name] = factory()
+    return values[name]
+
+async def close_loop_local():
+    """Close and forget the values loop_local created on the running event loop, e.g. aiohttp sessions."""
+    values = loop_values.pop(asyncio.get_running_loop(), {})
+    for name, value in values.items():
+        close = getattr(value, "close", None)
+        if close is None:
+            continue
+        try:
+            closed = close()
+            if inspect.isawaitable(closed):
+                await closed
+        except Exception as e:
+            logging.warning(f"Unable to close {name}: {e}")
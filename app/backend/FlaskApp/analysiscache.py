@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import zlib
+from typing import Optional
+
+from azure.core.exceptions import ResourceNotFoundError
+
+# Cache of Form Recognizer analyze results, keyed by the hash of the analyzed document, the model and the pages
+# that were analyzed. Results are kept as zlib compressed JSON (the SDK's to_dict form) in a local directory that
+# is trimmed to max_bytes by evicting the least recently used entries. When a blob container is given it is used
+# as a second, shared tier: local misses are looked up there and new results are written to both. The size of the
+# directory is scanned once and then tracked as entries are written and removed, the directory is only scanned again
+# to evict once the tracked size goes over max_bytes.
+
+class AnalysisCache:
+    def __init__(self, path: str, max_bytes: int, container=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.container = container
+        self.size = None
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(document_hash: str, model_id: str, pages: Optional[str] = None) -> str:
+        return hashlib.sha256(f"{document_hash}|{model_id}|{pages or ''}".encode("utf-8")).hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key + ".json.z")
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Touch the entry, eviction removes the least recently modified entries first
+            os.utime(path)
+        except FileNotFoundError:
+            data = self.get_from_container(key)
+            if data is None:
+                return None
+            self.write(key, data)
+        try:
+            return json.loads(zlib.decompress(data))
+        except (zlib.error, ValueError) as e:
+            logging.warning(f"Discarding corrupt analysis cache entry {key}: {e}")
+            self.remove(key)
+            return None
+
+    def put(self, key: str, result: dict):
+        data = zlib.compress(json.dumps(result, separators=(",", ":")).encode("utf-8"), 1)
+        self.write(key, data)
+        if self.container is not None:
+            try:
+                try:
+                    self.container.upload_blob(key, data, overwrite=True)
+                except ResourceNotFoundError:
+                    self.container.create_container()
+                    self.container.upload_blob(key, data, overwrite=True)
+            except Exception as e:
+                logging.warning(f"Unable to store analysis cache entry {key} in blob storage: {e}")
+
+    def get_from_container(self, key: str) -> Optional[bytes]:
+        if self.container is None:
+            return None
+        try:
+            return self.container.download_blob(key).readall()
+        except ResourceNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Unable to read analysis cache entry {key} from blob storage: {e}")
+            return None
+
+    def write(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        path = self.entry_path(key)
+        # A temporary file of its own, so that concurrent writes of the same entry don't clobber each other
+        with tempfile.NamedTemporaryFile(dir=self.path, suffix=".tmp", delete=False) as f:
+            try:
+                f.write(data)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        replaced = self.entry_size(path)
+        os.replace(f.name, path)
+        with self.lock:
+            if self.size is not None:
+                self.size += len(data) - replaced
+            over = self.size is None or self.size > self.max_bytes
+        if over:
+            self.evict()
+
+    def entry_size(self, path: str) -> int:
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def remove(self, key: str):
+        path = self.entry_path(key)
+        size = self.entry_size(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            if self.size is not None:
+                self.size -= size
+
+    def evict(self):
+        # Scans the directory, which other processes may write to as well, and resets the tracked size from it
+        entries = []
+        for e in os.scandir(self.path):
+            if e.name.endswith(".json.z"):
+                try:
+                    stat = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            self.size = total
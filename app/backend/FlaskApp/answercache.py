@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+
+import numpy as np
+
+from .cache import TTLCache, register_index_cache
+
+# Cache of /ask responses for deterministic requests, those with the temperature set to 0 (the /ask approaches sample
+# at 0.3 when it's unset). Entries are keyed by the approach, the overrides that change the answer and the normalized
+# question. When an embedding function is configured a miss on the exact key falls back to the most similar cached
+# question for the same approach and overrides, if it is similar enough. The cache is cleared whenever ingestion
+# changes the index.
+
+class AnswerCache:
+    key_overrides = ["top", "semantic_ranker", "semantic_captions", "exclude_category", "prompt_template", "prompt_template_prefix", "prompt_template_suffix"]
+
+    def __init__(self, maxsize: int, ttl: float, embed=None, similarity: float = 0.95):
+        self.entries = register_index_cache(TTLCache(maxsize, ttl))
+        self.embed = embed
+        self.similarity = similarity
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "semantic_hits": 0, "misses": 0, "uncacheable": 0, "saved_tokens": 0, "saved_seconds": 0.0}
+
+    @staticmethod
+    def normalize(q: str) -> str:
+        return re.sub(r"\s+", " ", q).strip().rstrip("?!. ").lower()
+
+    def cacheable(self, overrides: dict) -> bool:
+        temperature = overrides.get("temperature")
+        if temperature is None:
+            return False
+        try:
+            return float(temperature) == 0
+        except (TypeError, ValueError):
+            # Left for the approach to reject, a bad override mustn't fail the cache lookup
+            return False
+
+    def scope(self, approach: str, overrides: dict) -> tuple:
+        return (approach,) + tuple(str(overrides.get(name)) for name in self.key_overrides)
+
+    def count(self, **increments):
+        with self.lock:
+            for name, value in increments.items():
+                self.counters[name] += value
+
+    def lookup(self, approach: str, q: str, overrides: dict):
+        scope = self.scope(approach, overrides)
+        question = self.normalize(q)
+        entry = self.entries.get((scope, question))
+        semantic = False
+        embedding = None
+        if entry is None and self.embed:
+            try:
+                embedding = np.asarray(self.embed(question), dtype=np.float32)
+                embedding /= np.linalg.norm(embedding) or 1.0
+                entry = self.find_similar(scope, embedding)
+                semantic = entry is not None
+            except Exception as e:
+                logging.warning(f"Unable to look up similar cached answers: {e}")
+
+        if entry is not None:
+            self.count(hits=1, semantic_hits=1 if semantic else 0, saved_tokens=entry["tokens"], saved_seconds=entry["seconds"])
+        else:
+            self.count(misses=1)
+        return (scope, question), entry, embedding
+
+    def store(self, key: tuple, embedding, result: dict, seconds: float):
+        usage = result.get("usage") or {}
+        self.entries.set(key, {"result": result, "embedding": embedding, "tokens": usage.get("total_tokens", 0), "seconds": seconds})
+
+    def get_or_compute(self, approach: str, q: str, overrides: dict, compute):
+        if not self.cacheable(overrides):
+            self.count(uncacheable=1)
+            return compute()
+        key, entry, embedding = self.lookup(approach, q, overrides)
+        if entry is not None:
+            return entry["result"]
+        start = time.perf_counter()
+        result = compute()
+        self.store(key, embedding, result, time.perf_counter() - start)
+        return result
+
+    async def alookup(self, approach: str, q: str, overrides: dict):
+        # The embedding lookup blocks on a network call, keep it off the event loop
+        if self.embed:
+            return await asyncio.to_thread(self.lookup, approach, q, overrides)
+        return self.lookup(approach, q, overrides)
+
+    async def aget_or_compute(self, approach: str, q: str, overrides: dict, compute):
+        # Same as get_or_compute for a coroutine function compute
+        if not self.cacheable(overrides):
+            self.count(uncacheable=1)
+            return await compute()
+        key, entry, embedding = await self.alookup(approach, q, overrides)
+        if entry is not None:
+            return entry["result"]
+        start = time.perf_counter()
+        result = await compute()
+        self.store(key, embedding, result, time.perf_counter() - start)
+        return result
+
+    def find_similar(self, scope: tuple, embedding):
+        candidates = [entry for (entry_scope, _), entry in self.entries.items() if entry_scope == scope and entry["embedding"] is not None]
+        if not candidates:
+            return None
+        scores = np.stack([entry["embedding"] for entry in candidates]) @ embedding
+        best = int(np.argmax(scores))
+        return candidates[best] if scores[best] >= self.similarity else None
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        stats["entries"] = len(self.entries)
+        return stats
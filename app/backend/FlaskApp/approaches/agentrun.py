@@ -0,0 +1,111 @@
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from typing import Any, Callable, Dict, List, Optional
+
+from ..cache import TTLCache, register_index_cache
+from ..clients import AGENT_PREFETCH_CONCURRENCY, AGENT_TOOL_CACHE_MAX_ENTRIES, AGENT_TOOL_CACHE_TTL
+from ..metrics import search_latency, timed
+from ..text import normalize_query
+from ..tracing import span
+
+# State of one request to an agent based approach. The agents and their tools are shared by concurrent requests, so
+# tools find the overrides and record their results through a context variable rather than on the approach.
+# Search tools go through call_tool, which answers a query the agent already asked in this request from a memo,
+# then tries a short lived cache shared between requests, and only then searches. When the agent's thought names
+# several things to search for, the ones it didn't pick yet are searched in the background (prefetch) so the
+# results are ready by the time it asks for them.
+
+# The overrides that change what a search tool returns
+scope_overrides = ["top", "semantic_ranker", "semantic_captions", "exclude_category"]
+
+tool_results = register_index_cache(TTLCache(AGENT_TOOL_CACHE_MAX_ENTRIES, AGENT_TOOL_CACHE_TTL))
+prefetch_executor = ThreadPoolExecutor(max_workers=AGENT_PREFETCH_CONCURRENCY, thread_name_prefix="agent-prefetch") if AGENT_PREFETCH_CONCURRENCY > 0 else None
+
+class AgentRunState:
+    def __init__(self, overrides: dict, name: str = "", fetchers: Optional[Dict[str, Callable[[str], Any]]] = None):
+        self.overrides = overrides
+        self.results = None
+        # Tool name to a function that runs the tool's search without side effects, so its result can be shared
+        self.fetchers = fetchers or {}
+        self.scope = (name,) + tuple(str(overrides.get(option)) for option in scope_overrides)
+        self.memo = {}
+        self.lock = threading.Lock()
+        self.counters = {"calls": 0, "memo_hits": 0, "cache_hits": 0, "prefetched": 0, "prefetch_hits": 0}
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def fetch(self, tool: str, key: tuple, q: str):
+        cached = tool_results.get(self.scope + key)
+        if cached is not None:
+            return cached[0], True
+        with span("retrieve", tool=tool, query=q), timed(search_latency, self.scope[0]):
+            value = self.fetchers[tool](q)
+        tool_results.set(self.scope + key, (value,))
+        return value, False
+
+    def call_tool(self, tool: str, q: str):
+        with span("tool", tool=tool, query=q) as s:
+            key = (tool, normalize_query(q))
+            with self.lock:
+                self.counters["calls"] += 1
+                entry = self.memo.get(key)
+            if entry is not None:
+                future, prefetched = entry
+                try:
+                    value = future.result()
+                except Exception:
+                    if not prefetched:
+                        raise
+                    # The agent might still get the result when asking for it itself
+                else:
+                    s.set(source="prefetch" if prefetched else "memo")
+                    with self.lock:
+                        self.counters["prefetch_hits" if prefetched else "memo_hits"] += 1
+                        entry[1] = False
+                    return value
+
+            value, cached = self.fetch(tool, key, q)
+            s.set(source="cache" if cached else "search")
+            if cached:
+                self.count("cache_hits")
+            future = Future()
+            future.set_result(value)
+            with self.lock:
+                self.memo[key] = [future, False]
+            return value
+
+    def prefetch(self, tool: str, queries: List[str]):
+        if prefetch_executor is None or tool not in self.fetchers:
+            return
+        for q in queries:
+            key = (tool, normalize_query(q))
+            with self.lock:
+                if key in self.memo or self.scope + key in tool_results:
+                    continue
+                self.memo[key] = [prefetch_executor.submit(copy_context().run, lambda q=q, key=key: self.fetch(tool, key, q)[0]), True]
+                self.counters["prefetched"] += 1
+
+    def report(self) -> dict:
+        with self.lock:
+            return {**self.counters, "saved": self.counters["memo_hits"] + self.counters["cache_hits"]}
+
+agent_run_state: ContextVar[AgentRunState] = ContextVar("agent_run_state")
+
+# "I need to search Nicholas Ray and Elia Kazan, find their professions" names two things to search for
+search_phrase = re.compile(r"\b(?:search(?: for)?|look up|lookup)\s+(.+?)(?:[,.;:\n]|\bthen\b|\bto\b|$)", re.IGNORECASE)
+phrase_separator = re.compile(r"\s*(?:,|\band\b|\bor\b)\s*", re.IGNORECASE)
+
+def candidate_queries(thought: str, tool_input: str, max_queries: int = 3) -> List[str]:
+    """Return the other queries the thought names alongside the one being run, if it names more than one."""
+    names = []
+    for phrase in search_phrase.findall(thought.split("Action", 1)[0]):
+        names += [name.strip(" \"'[]") for name in phrase_separator.split(phrase)]
+    names = [name for name in names if name and len(name) <= 100]
+    if len(names) < 2:
+        return []
+    asked = normalize_query(tool_input)
+    return [name for name in names if normalize_query(name) != asked][:max_queries]
@@ -1,3 +1,11 @@
+import asyncio
+
+
 class Approach:
     def run(self, q: str, use_summaries: bool) -> any:
         raise NotImplementedError
+
+    # Async variant of run. Approaches that can await their search and completion calls override it, the default
+    # runs the blocking run in a worker thread so it doesn't hold up the event loop.
+    async def arun(self, *args) -> any:
+        return await asyncio.to_thread(self.run, *args)
@@ -1,10 +1,17 @@
+import asyncio
 import logging
+import re
+from itertools import zip_longest
 
 from azure.search.documents import SearchClient
 from azure.search.documents.models import QueryType
 
-from ..clients import completion_client, search_client
-from ..text import nonewlines
+from ..clients import (AZURE_OPENAI_CHATGPT_CONTEXT_TOKENS, CHAT_SPECULATIVE_GRACE, CHAT_SPECULATIVE_MAX_TURNS, CHAT_SPECULATIVE_RETRIEVAL,
+                       acompletion_client, async_search_client, completion_client, override_temperature, search_client)
+from ..metrics import search_latency, timed
+from ..promptbudget import PromptBudget
+from ..text import nonewlines, normalize_query
+from ..tracing import span
 from .approach import Approach
 
 
@@ -45,6 +52,9 @@ Question:
 Search query:
 """
 
+    max_tokens = 1024
+    history_max_tokens = 1000
+
     def __init__(self, search_client: SearchClient, chatgpt_deployment: str, gpt_deployment: str, sourcepage_field: str, content_field: str):
         # self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
@@ -52,60 +62,178 @@ Search query:
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
 
-    def run(self, history: list[dict], overrides: dict) -> any:
-        use_semantic_captions = True if overrides.get("semantic_captions") else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
+    def generate_query(self, history: list[dict], overrides: dict) -> str:
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
         prompt = self.query_prompt_template.format(chat_history=self.get_chat_history_as_text(history, include_last_turn=False), question=history[-1]["user"])
 
-        completion = completion_client(prompt=prompt, max_tokens=32, temperature=0.0, n=1, stop=["\n"], deployment_name=self.gpt_deployment)
+        with span("generate_query"):
+            completion = completion_client(prompt=prompt, max_tokens=32, temperature=0.0, n=1, stop=["\n"], deployment_name=self.gpt_deployment)
 
         q = completion.choices[0].text
 
         logging.info(f"Generated search query: {q}")
+        return q
+
+    async def agenerate_query(self, history: list[dict], overrides: dict) -> str:
+        prompt = self.query_prompt_template.format(chat_history=self.get_chat_history_as_text(history, include_last_turn=False), question=history[-1]["user"])
+        with span("generate_query"):
+            completion = await acompletion_client(prompt=prompt, max_tokens=32, temperature=0.0, n=1, stop=["\n"], deployment_name=self.gpt_deployment)
+        q = completion.choices[0].text
+        logging.info(f"Generated search query: {q}")
+        return q
+
+    def search_options(self, overrides: dict) -> dict:
+        use_semantic_captions = True if overrides.get("semantic_captions") else False
+        top = overrides.get("top") or 3
+        exclude_category = overrides.get("exclude_category") or None
+        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
         if overrides.get("semantic_ranker"):
-            r = search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
+            return dict(filter=filter,
+                        query_type=QueryType.SEMANTIC, 
+                        query_language="en-us", 
+                        query_speller="lexicon", 
+                        semantic_configuration_name="default", 
+                        top=top, 
+                        query_caption="extractive|highlight-false" if use_semantic_captions else None)
         else:
-            r = search_client.search(q, filter=filter, top=top)
+            return dict(filter=filter, top=top)
 
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
+    def format_result(self, doc: dict, overrides: dict) -> str:
+        if overrides.get("semantic_captions"):
+            return doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']]))
         else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
-        content = "\n".join(results)
+            return doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field])
+
+    def retrieve(self, q: str, overrides: dict) -> list:
+        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+        with span("retrieve", query=q), timed(search_latency, "ChatReadRetrieveRead"):
+            r = search_client.search(q, **self.search_options(overrides))
+            return [self.format_result(doc, overrides) for doc in r]
 
+    async def aretrieve(self, q: str, overrides: dict) -> list:
+        with span("retrieve", query=q), timed(search_latency, "ChatReadRetrieveRead"):
+            r = await async_search_client().search(q, **self.search_options(overrides))
+            return [self.format_result(doc, overrides) async for doc in r]
+
+    def build_prompt(self, history: list[dict], overrides: dict, results: list):
         follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
         
         # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
         prompt_override = overrides.get("prompt_template")
-        if prompt_override is None:
-            prompt = self.prompt_prefix.format(injected_prompt="", sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
-        elif prompt_override.startswith(">>>"):
-            prompt = self.prompt_prefix.format(injected_prompt=prompt_override[3:] + "\n", sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
-        else:
-            prompt = prompt_override.format(sources=content, chat_history=self.get_chat_history_as_text(history), follow_up_questions_prompt=follow_up_questions_prompt)
+        template, injected_prompt = self.prompt_prefix, ""
+        if prompt_override is not None and prompt_override.startswith(">>>"):
+            injected_prompt = prompt_override[3:] + "\n"
+        elif prompt_override is not None:
+            template = prompt_override
+
+        def fill(sources: str, chat_history: str) -> str:
+            return template.format(injected_prompt=injected_prompt, sources=sources, chat_history=chat_history, follow_up_questions_prompt=follow_up_questions_prompt)
+
+        # The instructions and the question always go in. Earlier turns, most recent first, get up to history_max_tokens
+        # but no more than half of what is left, and the sources, most relevant first, get the rest.
+        budget = PromptBudget(self.chatgpt_deployment, AZURE_OPENAI_CHATGPT_CONTEXT_TOKENS, self.max_tokens)
+        budget.reserve("instructions", fill("", ""))
+        turns = [self.format_turn(h) for h in reversed(history)]
+        budget.reserve("question", turns[0])
+        earlier_turns = budget.fit("history", turns[1:], max_tokens=min(self.history_max_tokens, budget.remaining // 2), truncate=False, separator_tokens=0)
+        sources = budget.fit("sources", results)
+        return fill("\n".join(sources), "".join(reversed([turns[0]] + earlier_turns))), budget.report()
+
+    def run(self, history: list[dict], overrides: dict) -> any:
+        q = self.generate_query(history, overrides)
+        results = self.retrieve(q, overrides)
+        with span("build_prompt"):
+            prompt, prompt_tokens = self.build_prompt(history, overrides, results)
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-        completion = completion_client(prompt=prompt, max_tokens=1024, temperature=overrides.get("temperature") or 0, n=1, stop=["<|im_end|>", "<|im_start|>"], deployment_name=self.chatgpt_deployment)
+        completion = completion_client(prompt=prompt, max_tokens=self.max_tokens, temperature=override_temperature(overrides, 0), n=1, stop=["<|im_end|>", "<|im_start|>"], deployment_name=self.chatgpt_deployment)
+
+        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>'), "prompt_tokens": prompt_tokens}
 
-        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+    async def arun(self, history: list[dict], overrides: dict) -> any:
+        if self.speculate(history, overrides):
+            with span("speculative_retrieve") as s:
+                q, results, speculation = await self.speculative_retrieve(history, overrides)
+                s.set(speculation=speculation)
+        else:
+            q = await self.agenerate_query(history, overrides)
+            results = await self.aretrieve(q, overrides)
+        with span("build_prompt"):
+            prompt, prompt_tokens = self.build_prompt(history, overrides, results)
+
+        completion = await acompletion_client(prompt=prompt, max_tokens=self.max_tokens, temperature=override_temperature(overrides, 0), n=1, stop=["<|im_end|>", "<|im_start|>"], deployment_name=self.chatgpt_deployment)
+
+        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>'), "prompt_tokens": prompt_tokens}
+
+    def speculate(self, history: list[dict], overrides: dict) -> bool:
+        enabled = overrides.get("speculative_retrieval")
+        if enabled is None:
+            enabled = CHAT_SPECULATIVE_RETRIEVAL
+        return bool(enabled) and len(history) - 1 <= CHAT_SPECULATIVE_MAX_TURNS
+
+    # Early in a conversation the user's question is usually a good enough search query, so search for it while the
+    # query is being rewritten instead of after. Once that search is back the rewrite gets a short grace period: if it
+    # is done by then and differs from the question, its results are merged in, otherwise the question's results are
+    # used as they are and the rewrite is dropped, taking a completion round trip off the critical path. Returns the
+    # query, the results and which of the two were used ("question" or "merged").
+    async def speculative_retrieve(self, history: list[dict], overrides: dict):
+        question = history[-1]["user"]
+        query_task = asyncio.ensure_future(self.agenerate_query(history, overrides))
+        try:
+            results = await self.aretrieve(question, overrides)
+        except BaseException:
+            query_task.cancel()
+            raise
+
+        done, _ = await asyncio.wait([query_task], timeout=CHAT_SPECULATIVE_GRACE)
+        if not done:
+            query_task.cancel()
+            return question, results, "question"
+        try:
+            q = query_task.result()
+        except Exception as e:
+            logging.warning(f"Query generation failed, searching for the question only: {e}")
+            return question, results, "question"
+        if normalize_query(q) == normalize_query(question):
+            return question, results, "question"
+
+        rewritten_results = await self.aretrieve(q, overrides)
+        return f"{q}<br>{question}", merge_results(rewritten_results, results, overrides.get("top") or 3), "merged"
+
+    # Same as run, but yields (event, data) pairs as soon as each part of the response is available: the data points,
+    # then the answer a few tokens at a time as the completion streams in, then the thoughts and follow-up questions
+    def run_stream(self, history: list[dict], overrides: dict):
+        q = self.generate_query(history, overrides)
+        results = self.retrieve(q, overrides)
+        yield "data_points", {"data_points": results}
+        with span("build_prompt"):
+            prompt, prompt_tokens = self.build_prompt(history, overrides, results)
+
+        completion = completion_client(prompt=prompt, max_tokens=self.max_tokens, temperature=override_temperature(overrides, 0), n=1, stop=["<|im_end|>", "<|im_start|>"], deployment_name=self.chatgpt_deployment, stream=True)
+        answer = []
+        for chunk in completion:
+            if chunk.choices and chunk.choices[0].text:
+                answer.append(chunk.choices[0].text)
+                yield "answer", {"text": chunk.choices[0].text}
+
+        followup_questions = re.findall(r"<<([^<>]+)>>", "".join(answer)) if overrides.get("suggest_followup_questions") else []
+        yield "end", {"thoughts": f"Searched for:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>'), "followup_questions": followup_questions, "prompt_tokens": prompt_tokens}
     
-    def get_chat_history_as_text(self, history, include_last_turn=True, approx_max_tokens=1000) -> str:
-        history_text = ""
-        for h in reversed(history if include_last_turn else history[:-1]):
-            history_text = """<|im_start|>user""" +"\n" + h["user"] + "\n" + """<|im_end|>""" + "\n" + """<|im_start|>assistant""" + "\n" + (h.get("bot") + """<|im_end|>""" if h.get("bot") else "") + "\n" + history_text
-            if len(history_text) > approx_max_tokens*4:
-                break    
-        return history_text
\ No newline at end of file
+    def format_turn(self, h: dict) -> str:
+        return """<|im_start|>user""" +"\n" + h["user"] + "\n" + """<|im_end|>""" + "\n" + """<|im_start|>assistant""" + "\n" + (h.get("bot") + """<|im_end|>""" if h.get("bot") else "") + "\n"
+
+    def get_chat_history_as_text(self, history, include_last_turn=True, max_tokens=1000) -> str:
+        # As many of the most recent whole turns as fit in max_tokens
+        turns = [self.format_turn(h) for h in reversed(history if include_last_turn else history[:-1])]
+        budget = PromptBudget(self.gpt_deployment, max_tokens, 0)
+        return "".join(reversed(budget.fit("history", turns, truncate=False, separator_tokens=0)))
+
+def merge_results(first: list, second: list, top: int) -> list:
+    # Interleave both result lists, best first, without duplicates
+    merged = []
+    for pair in zip_longest(first, second):
+        for r in pair:
+            if r is not None and r not in merged:
+                merged.append(r)
+    return merged[:top]
@@ -1,3 +1,4 @@
+import functools
 from typing import List
 
 from azure.search.documents import SearchClient
@@ -5,22 +6,38 @@ from azure.search.documents.models import QueryType
 from langchain.agents import AgentExecutor, Tool
 from langchain.agents.react.base import ReActDocstoreAgent
 from langchain.callbacks.base import CallbackManager
-from langchain.prompts import BasePromptTemplate, PromptTemplate
+from langchain.chains import LLMChain
+from langchain.prompts import PromptTemplate
 
 from ..clients import llm_client, search_client
-from ..langchainadapters import HtmlCallbackHandler
+from ..langchainadapters import HtmlCallbackHandler, PrefetchCallbackHandler
+from ..promptbudget import truncate_tokens
 from ..text import nonewlines
+from ..tracing import span
+from .agentrun import AgentRunState, agent_run_state, candidate_queries
 from .approach import Approach
 
 
 class ReadDecomposeAsk(Approach):
+    # Search and lookup observations are cut to these many tokens so the agent's scratchpad stays within the model's context
+    source_max_tokens = 128
+    lookup_max_tokens = 256
+
     def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
         # self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
 
-    def search(self, q: str, overrides: dict) -> str:
+    def search(self, q: str) -> str:
+        state = agent_run_state.get()
+        state.results = state.call_tool("Search", q)
+        return "\n".join(state.results)
+
+    def lookup(self, q: str) -> str:
+        return agent_run_state.get().call_tool("Lookup", q)
+
+    def search_sources(self, q: str, overrides: dict) -> List[str]:
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 3
         exclude_category = overrides.get("exclude_category") or None
@@ -38,12 +55,11 @@ class ReadDecomposeAsk(Approach):
         else:
             r = search_client.search(q, filter=filter, top=top)
         if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) for doc in r]
+            return [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) for doc in r]
         else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) for doc in r]
-        return "\n".join(self.results)
+            return [doc[self.sourcepage_field] + ":" + truncate_tokens(nonewlines(doc[self.content_field]), self.source_max_tokens, self.openai_deployment) for doc in r]
 
-    def lookup(self, q: str) -> str:
+    def find_answer(self, q: str) -> str:
         r = search_client.search(q,
                                       top = 1,
                                       include_total_count=True,
@@ -58,44 +74,47 @@ class ReadDecomposeAsk(Approach):
         if answers and len(answers) > 0:
             return answers[0].text
         if r.get_count() > 0:
-            return "\n".join(d['content'] for d in r)
+            return truncate_tokens("\n".join(d['content'] for d in r), self.lookup_max_tokens, self.openai_deployment)
         return None        
 
-    def run(self, q: str, overrides: dict) -> any:
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
-
-        # Use to capture thought process during iterations
-        cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
-        
-        llm = llm_client(deployment_name=self.openai_deployment, overrides=overrides)
+    # The tools, prompt, LLM and agent only depend on these overrides, so they are built once for each combination
+    @functools.lru_cache(maxsize=32)
+    def get_agent(self, prompt_prefix: str, temperature: float):
+        llm = llm_client(deployment_name=self.openai_deployment, overrides={"temperature": temperature})
         # TODO: Add a tool for other "lookup" that uses the search client to find the answer to the question
         tools = [
-            Tool(name="Search", func=lambda q: self.search(q, overrides), description="Searches the document store for the given query"),
+            Tool(name="Search", func=self.search, description="Searches the document store for the given query"),
             Tool(name="Lookup", func=self.lookup, description="Looks up the given query in the document store")
         ]
 
-        # Like results above, not great to keep this as a global, will interfere with interleaving
-        global prompt
-        prompt_prefix = overrides.get("prompt_template")
         prompt = PromptTemplate.from_examples(
             EXAMPLES, SUFFIX, ["input", "agent_scratchpad"], prompt_prefix + "\n\n" + PREFIX if prompt_prefix else PREFIX)
 
-        agent = ReAct.from_llm_and_tools(llm, tools)
+        agent = ReActDocstoreAgent(llm_chain=LLMChain(llm=llm, prompt=prompt), allowed_tools=[tool.name for tool in tools])
+        return agent, tools
+
+    def run(self, q: str, overrides: dict) -> any:
+        agent, tools = self.get_agent(overrides.get("prompt_template"), overrides.get("temperature"))
+
+        state = AgentRunState(overrides, "ReadDecomposeAsk", {"Search": lambda q: self.search_sources(q, overrides), "Lookup": self.find_answer})
+
+        # Use to capture thought process during iterations
+        cb_handler = HtmlCallbackHandler()
+        cb_manager = CallbackManager(handlers=[cb_handler, PrefetchCallbackHandler(state.prefetch, candidate_queries)])
+
         chain = AgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
-        result = chain.run(q)
+        token = agent_run_state.set(state)
+        try:
+            with span("agent"):
+                result = chain.run(q)
+        finally:
+            agent_run_state.reset(token)
 
         # Fix up references to they look like what the frontend expects ([] instead of ()), need a better citation format since parentheses are so common
         result = result.replace("(", "[").replace(")", "]")
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
-    
-class ReAct(ReActDocstoreAgent):
-    @classmethod
-    def create_prompt(cls, tools: List[Tool]) -> BasePromptTemplate:
-        return prompt
-    
+        return {"data_points": state.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log(), "tool_calls": state.report()}
+
 # Modified version of langchain's ReAct prompt that includes instructions and examples for how to cite information sources
 EXAMPLES = [
     """Question: What is the elevation range for the area that the eastern sector of the
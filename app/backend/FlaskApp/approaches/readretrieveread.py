@@ -1,3 +1,6 @@
+import functools
+from typing import List
+
 from azure.search.documents import SearchClient
 from azure.search.documents.models import QueryType
 from langchain.agents import AgentExecutor, Tool, ZeroShotAgent
@@ -5,9 +8,12 @@ from langchain.callbacks.base import CallbackManager
 from langchain.chains import LLMChain
 
 from ..clients import BING_SUBSCRIPTION_KEY, llm_client, search_client
-from ..langchainadapters import HtmlCallbackHandler
+from ..langchainadapters import HtmlCallbackHandler, PrefetchCallbackHandler
 from ..lookuptool import pandas_lookup, web_search
+from ..promptbudget import truncate_tokens
 from ..text import nonewlines
+from ..tracing import span
+from .agentrun import AgentRunState, agent_run_state, candidate_queries
 from .approach import Approach
 
 
@@ -67,13 +73,21 @@ Thought: {agent_scratchpad}"""
     PandasLookupToolDescription = "useful to lookup details about employees and their info"
     BingSearchToolDescription = "useful for searching latest information from the web and only if you cannot find answer from internal information sources"
 
+    # Each search result is cut to this many tokens so the agent's scratchpad stays within the model's context
+    source_max_tokens = 64
+
     def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
         # self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
 
-    def retrieve(self, q: str, overrides: dict) -> any: # type: ignore
+    def retrieve(self, q: str) -> any: # type: ignore
+        state = agent_run_state.get()
+        state.results = state.call_tool("CognitiveSearch", q)
+        return "\n".join(state.results)
+
+    def search_sources(self, q: str, overrides: dict) -> List[str]:
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 3
         exclude_category = overrides.get("exclude_category") or None
@@ -91,21 +105,14 @@ Thought: {agent_scratchpad}"""
         else:
             r = search_client.search(q, filter=filter, top=top)
         if use_semantic_captions:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            return [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
         else:
-            self.results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) for doc in r]
-        content = "\n".join(self.results)
-        return content
-        
-    def run(self, q: str, overrides: dict) -> any: # type: ignore
-        # Not great to keep this as instance state, won't work with interleaving (e.g. if using async), but keeps the example simple
-        self.results = None
-
-        # Use to capture thought process during iterations
-        cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
+            return [doc[self.sourcepage_field] + ":" + truncate_tokens(nonewlines(doc[self.content_field]), self.source_max_tokens, self.openai_deployment) for doc in r]
         
-        acs_tool = Tool(name = "CognitiveSearch", func = lambda q: self.retrieve(q, overrides), description = self.CognitiveSearchToolDescription)
+    # The tools, prompt, LLM and agent only depend on these overrides, so they are built once for each combination
+    @functools.lru_cache(maxsize=32)
+    def get_agent(self, prompt_template_prefix: str, prompt_template_suffix: str, temperature: float):
+        acs_tool = Tool(name = "CognitiveSearch", func = self.retrieve, description = self.CognitiveSearchToolDescription)
         pandas_tool = Tool(name="PandasLookup", func=lambda x: pandas_lookup(x.lower()), description=self.PandasLookupToolDescription)
         bing_tool = Tool(name="BingSearchLookup", func=lambda q: web_search(q), description=self.BingSearchToolDescription)
         # employee_tool = EmployeeInfoTool("Employee1")
@@ -116,25 +123,41 @@ Thought: {agent_scratchpad}"""
 
         prompt = ZeroShotAgent.create_prompt(
             tools=tools,
-            prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
-            suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
+            prefix=prompt_template_prefix or self.template_prefix,
+            suffix=prompt_template_suffix or self.template_suffix,
             input_variables = ["input", "agent_scratchpad"])
         # llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key) # type: ignore
         # llm = OpenAI(model_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key) # type: ignore
-        llm = llm_client(deployment_name=self.openai_deployment, overrides=overrides) # type: ignore
+        llm = llm_client(deployment_name=self.openai_deployment, overrides={"temperature": temperature}) # type: ignore
         chain = LLMChain(llm = llm, prompt = prompt)
+        return ZeroShotAgent(llm_chain = chain, tools = tools), tools # type: ignore
+
+    def run(self, q: str, overrides: dict) -> any: # type: ignore
+        agent, tools = self.get_agent(overrides.get("prompt_template_prefix"), overrides.get("prompt_template_suffix"), overrides.get("temperature"))
+
+        state = AgentRunState(overrides, "ReadRetrieveRead", {"CognitiveSearch": lambda q: self.search_sources(q, overrides)})
+
+        # Use to capture thought process during iterations
+        cb_handler = HtmlCallbackHandler()
+        cb_manager = CallbackManager(handlers=[cb_handler, PrefetchCallbackHandler(state.prefetch, candidate_queries)])
+
         agent_exec = AgentExecutor.from_agent_and_tools(
-            agent = ZeroShotAgent(llm_chain = chain, tools = tools), # type: ignore
+            agent = agent,
             tools = tools, 
             verbose = False,
             max_iterations=5, 
             callback_manager = cb_manager)
-        result = agent_exec.run(q)
+        token = agent_run_state.set(state)
+        try:
+            with span("agent"):
+                result = agent_exec.run(q)
+        finally:
+            agent_run_state.reset(token)
                 
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "").replace("[Employee]", "").replace("[PandasLookup]", "").replace("[BingSearchLookup]", "")
 
-        return {"data_points": self.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": state.results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log(), "tool_calls": state.report()}
 
 # class EmployeeInfoTool(CsvLookupTool):
 #     employee_name: str = ""
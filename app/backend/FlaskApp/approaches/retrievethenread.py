@@ -1,8 +1,13 @@
+import asyncio
+
 from azure.search.documents import SearchClient
 from azure.search.documents.models import QueryType
 
-from ..clients import completion_client
+from ..clients import AZURE_OPENAI_GPT_CONTEXT_TOKENS, acompletion_client, async_search_client, completion_client, override_temperature
+from ..metrics import search_latency, timed
+from ..promptbudget import PromptBudget
 from ..text import nonewlines
+from ..tracing import span
 from .approach import Approach
 
 
@@ -41,37 +46,60 @@ Sources:
 Answer:
 """
 
+    max_tokens = 1024
+
     def __init__(self, search_client: SearchClient, openai_deployment: str, sourcepage_field: str, content_field: str):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
 
-    def run(self, q: str, overrides: dict) -> any:
+    def search_options(self, overrides: dict) -> dict:
         use_semantic_captions = True if overrides.get("semantic_captions") else False
         top = overrides.get("top") or 3
         exclude_category = overrides.get("exclude_category") or None
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
 
         if overrides.get("semantic_ranker"):
-            r = self.search_client.search(q, 
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC, 
-                                          query_language="en-us", 
-                                          query_speller="lexicon", 
-                                          semantic_configuration_name="default", 
-                                          top=top, 
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None)
+            return dict(filter=filter,
+                        query_type=QueryType.SEMANTIC, 
+                        query_language="en-us", 
+                        query_speller="lexicon", 
+                        semantic_configuration_name="default", 
+                        top=top, 
+                        query_caption="extractive|highlight-false" if use_semantic_captions else None)
         else:
-            r = self.search_client.search(q, filter=filter, top=top)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            return dict(filter=filter, top=top)
+
+    def format_result(self, doc: dict, overrides: dict) -> str:
+        if overrides.get("semantic_captions"):
+            return doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']]))
         else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
-        content = "\n".join(results)
+            return doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field])
+
+    def retrieve(self, q: str, overrides: dict) -> list:
+        with span("retrieve", query=q), timed(search_latency, "RetrieveThenRead"):
+            r = self.search_client.search(q, **self.search_options(overrides))
+            return [self.format_result(doc, overrides) for doc in r]
+
+    async def aretrieve(self, q: str, overrides: dict) -> list:
+        with span("retrieve", query=q), timed(search_latency, "RetrieveThenRead"):
+            r = await async_search_client().search(q, **self.search_options(overrides))
+            return [self.format_result(doc, overrides) async for doc in r]
 
-        prompt = (overrides.get("prompt_template") or self.template).format(q=q, retrieved=content)
-        completion = completion_client(prompt=prompt,max_tokens=1024,temperature=overrides.get("temperature") or 0.3,n=1,stop=["\n"], deployment_name=self.openai_deployment)
+    def build_prompt(self, q: str, overrides: dict, results: list):
+        # Sources are in order of relevance, the least relevant are left out or cut short to fit the model's context
+        template = overrides.get("prompt_template") or self.template
+        with span("build_prompt"):
+            budget = PromptBudget(self.openai_deployment, AZURE_OPENAI_GPT_CONTEXT_TOKENS, self.max_tokens)
+            budget.reserve("instructions", template.format(q=q, retrieved=""))
+            sources = budget.fit("sources", results)
+            return template.format(q=q, retrieved="\n".join(sources)), budget.report()
+
+    def run(self, q: str, overrides: dict) -> any:
+        results = self.retrieve(q, overrides)
+        prompt, prompt_tokens = self.build_prompt(q, overrides, results)
+        completion = completion_client(prompt=prompt,max_tokens=self.max_tokens,temperature=override_temperature(overrides, 0.3),n=1,stop=["\n"], deployment_name=self.openai_deployment)
         # completion = openai.Completion.create(
         #     model=self.openai_deployment, 
         #     prompt=prompt, 
@@ -80,4 +108,41 @@ Answer:
         #     n=1, 
         #     stop=["\n"])
 
-        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>')}
+        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>'), "usage": completion.get("usage"), "prompt_tokens": prompt_tokens}
+
+    async def arun(self, q: str, overrides: dict) -> any:
+        results = await self.aretrieve(q, overrides)
+        prompt, prompt_tokens = self.build_prompt(q, overrides, results)
+        completion = await acompletion_client(prompt=prompt,max_tokens=self.max_tokens,temperature=override_temperature(overrides, 0.3),n=1,stop=["\n"], deployment_name=self.openai_deployment)
+        return {"data_points": results, "answer": completion.choices[0].text, "thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>'), "usage": completion.get("usage"), "prompt_tokens": prompt_tokens}
+
+    async def arun_batch(self, questions: list, overrides: dict) -> list:
+        # Answers several questions with one completion request, one prompt per question. Returns a result or the
+        # exception raised for each question, in the order of the questions.
+        retrieved = await asyncio.gather(*(self.aretrieve(q, overrides) for q in questions), return_exceptions=True)
+        answered = [i for i, results in enumerate(retrieved) if not isinstance(results, Exception)]
+        outputs = list(retrieved)
+        if not answered:
+            return outputs
+        prompts = {i: self.build_prompt(questions[i], overrides, retrieved[i]) for i in answered}
+        completion = await acompletion_client(prompt=[prompts[i][0] for i in answered],max_tokens=self.max_tokens,temperature=override_temperature(overrides, 0.3),n=1,stop=["\n"], deployment_name=self.openai_deployment)
+        # Choices come back in any order, each with the index of its prompt. Usage is for the whole request, each
+        # question is given an equal share of it.
+        answers = {choice.index: choice.text for choice in completion.choices}
+        usage = {name: value // len(answered) for name, value in (completion.get("usage") or {}).items()}
+        for position, i in enumerate(answered):
+            prompt, prompt_tokens = prompts[i]
+            outputs[i] = {"data_points": retrieved[i], "answer": answers.get(position, ""), "thoughts": f"Question:<br>{questions[i]}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>'), "usage": usage, "prompt_tokens": prompt_tokens}
+        return outputs
+
+    # Same as run, but yields (event, data) pairs as soon as each part of the response is available: the data points,
+    # then the answer a few tokens at a time as the completion streams in, then the thoughts
+    def run_stream(self, q: str, overrides: dict):
+        results = self.retrieve(q, overrides)
+        yield "data_points", {"data_points": results}
+        prompt, prompt_tokens = self.build_prompt(q, overrides, results)
+        completion = completion_client(prompt=prompt,max_tokens=self.max_tokens,temperature=override_temperature(overrides, 0.3),n=1,stop=["\n"], deployment_name=self.openai_deployment, stream=True)
+        for chunk in completion:
+            if chunk.choices and chunk.choices[0].text:
+                yield "answer", {"text": chunk.choices[0].text}
+        yield "end", {"thoughts": f"Question:<br>{q}<br><br>Prompt:<br>" + prompt.replace('\n', '<br>'), "prompt_tokens": prompt_tokens}
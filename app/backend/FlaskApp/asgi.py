@@ -0,0 +1,138 @@
+import asyncio
+import contextvars
+import inspect
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from flask import request, request_started
+from werkzeug.exceptions import HTTPException
+
+from .aio import close_loop_local
+
+# ASGI face of the Flask app, for hosts that run an event loop of their own (the Functions host's AsgiMiddleware, or
+# an ASGI server). Requests for async views are dispatched on the host's loop, so a request waiting on Azure OpenAI or
+# search doesn't hold a thread. Everything else, sync views and streamed responses included, goes through the app's
+# WSGI interface in a thread pool. Shutting down (the lifespan protocol) closes the sessions created on the loop.
+
+class AsgiAdapter:
+    def __init__(self, app, threads: Optional[int] = None):
+        self.app = app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="asgi-sync")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']}")
+        environ = wsgi_environ(scope, await read_body(receive))
+        # Context variables set in the pool, e.g. by a streamed response's request context, are kept for the next call
+        context = contextvars.copy_context()
+        view = self.async_view(environ)
+        if view is None:
+            return await self.send_wsgi(self.app.wsgi_app, environ, send, context)
+        response = await self.dispatch(environ, view)
+        return await self.send_wsgi(response, environ, send, context)
+
+    def async_view(self, environ):
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        view = self.app.view_functions.get(endpoint)
+        return view if inspect.iscoroutinefunction(view) else None
+
+    async def dispatch(self, environ, view):
+        # Flask's wsgi_app and full_dispatch_request, awaiting the view instead of running it to completion in a thread
+        ctx = self.app.request_context(environ)
+        error = None
+        try:
+            ctx.push()
+            try:
+                request_started.send(self.app)
+                rv = self.app.preprocess_request()
+                if rv is None:
+                    rv = await view(**request.view_args)
+            except Exception as e:
+                rv = self.app.handle_user_exception(e)
+            return self.app.finalize_request(rv)
+        except Exception as e:
+            error = e
+            return self.app.handle_exception(e)
+        finally:
+            ctx.pop(error)
+
+    async def send_wsgi(self, wsgi_app, environ, send, context):
+        loop = asyncio.get_running_loop()
+        def call(function, *args):
+            return loop.run_in_executor(self.executor, context.run, function, *args)
+        started = {}
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+        body = await call(wsgi_app, environ, start_response)
+        try:
+            chunks = iter(body)
+            chunk = await call(next, chunks, None)
+            await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+            while chunk is not None:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await call(next, chunks, None)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(body, "close"):
+                await call(body.close)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await close_loop_local()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+async def read_body(receive) -> bytes:
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return bytes(body)
+
+def wsgi_environ(scope, body: bytes) -> dict:
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False}
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_" + name
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
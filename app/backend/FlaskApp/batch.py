@@ -0,0 +1,121 @@
+import asyncio
+import json
+import logging
+import sys
+import time
+from typing import AsyncIterator, List
+
+from .tracing import start_trace
+
+# Bulk question answering, e.g. for nightly evaluation runs. Identical questions are answered once, cached answers
+# are returned straight away and the rest run with at most `concurrency` approach calls in flight. Approaches with
+# an arun_batch method answer up to pack_size questions per call, RetrieveThenRead sends their prompts in a single
+# completion request. Results are yielded in the order they complete, one per question with its index in the input,
+# and a failing question yields an error for that question only. If scheduling the batch fails, every question not
+# answered yet yields that error.
+
+async def answer_batch(impl, approach: str, questions: List[str], overrides: dict, answer_cache=None,
+                       concurrency: int = 8, pack_size: int = 8, traced: bool = False) -> AsyncIterator[dict]:
+    positions = {}
+    for i, q in enumerate(questions):
+        positions.setdefault(q.strip(), []).append(i)
+
+    done = asyncio.Queue()
+    semaphore = asyncio.Semaphore(concurrency)
+    cacheable = answer_cache is not None and answer_cache.cacheable(overrides)
+    cache_keys = {}
+
+    async def lookup(q: str):
+        async with semaphore:
+            try:
+                key, entry, embedding = await answer_cache.alookup(approach, q, overrides)
+            except Exception as e:
+                logging.warning(f"Unable to look up a cached answer for a batch question: {e}")
+                return q
+        if entry is not None:
+            await done.put((q, entry["result"], None))
+            return None
+        cache_keys[q] = (key, embedding)
+        return q
+
+    async def answer(group: List[str]):
+        async with semaphore:
+            start = time.perf_counter()
+            with start_trace("ask_batch", traced or bool(overrides.get("include_timings")), approach=approach, questions=len(group)) as trace:
+                try:
+                    if len(group) > 1:
+                        results = await impl.arun_batch(group, overrides)
+                    else:
+                        results = [await impl.arun(group[0], overrides)]
+                except Exception as e:
+                    results = [e] * len(group)
+            seconds = (time.perf_counter() - start) / len(group)
+        timings = trace.timings()
+        if timings and overrides.get("include_timings"):
+            results = [r if isinstance(r, Exception) else {**r, "timings": timings} for r in results]
+        for q, result in zip(group, results):
+            await done.put((q, result, seconds))
+
+    async def schedule():
+        if cacheable:
+            misses = [q for q in await asyncio.gather(*(lookup(q) for q in positions)) if q is not None]
+        else:
+            if answer_cache is not None:
+                answer_cache.count(uncacheable=len(positions))
+            misses = list(positions)
+        size = pack_size if hasattr(impl, "arun_batch") else 1
+        await asyncio.gather(*(answer(misses[i:i + size]) for i in range(0, len(misses), size)))
+
+    def lines(q: str, result, seconds):
+        if isinstance(result, Exception):
+            logging.error(f"Batch question failed: {result}")
+            return [{"index": i, "question": questions[i], "error": str(result)} for i in positions[q]]
+        if seconds is not None and q in cache_keys:
+            answer_cache.store(*cache_keys[q], result, seconds)
+        return [{"index": i, "question": questions[i], **result} for i in positions[q]]
+
+    task = asyncio.ensure_future(schedule())
+    remaining = set(positions)
+    try:
+        while remaining:
+            if task.done() and done.empty():
+                # Scheduling failed outside of the per question error handling, the questions it left unanswered
+                # fail with its error rather than being waited for forever
+                error = task.exception() or RuntimeError("question was not answered")
+                for q in [q for q in positions if q in remaining]:
+                    remaining.discard(q)
+                    for line in lines(q, error, None):
+                        yield line
+                break
+            if task.done():
+                q, result, seconds = done.get_nowait()
+            else:
+                get = asyncio.ensure_future(done.get())
+                await asyncio.wait({get, task}, return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    continue
+                q, result, seconds = get.result()
+            if q not in remaining:
+                continue
+            remaining.discard(q)
+            for line in lines(q, result, seconds):
+                yield line
+    finally:
+        task.cancel()
+
+def main():
+    # python -m FlaskApp.batch <approach> [overrides JSON] < questions.txt > answers.ndjson
+    from . import answer_cache, ask_approaches
+    from .aio import event_loop
+    from .clients import BATCH_CONCURRENCY, BATCH_PACK_SIZE, TRACING_ENABLED
+
+    approach = sys.argv[1]
+    overrides = json.loads(sys.argv[2]) if len(sys.argv) > 2 else {}
+    questions = [line.strip() for line in sys.stdin if line.strip()]
+    lines = answer_batch(ask_approaches[approach], approach, questions, overrides, answer_cache, BATCH_CONCURRENCY, BATCH_PACK_SIZE, TRACING_ENABLED)
+    for line in event_loop.iterate(lines):
+        print(json.dumps(line), flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+# In-process caches shared by the app. TTLCache is a thread safe LRU with a time to live per entry and an optional
+# size function, so a cache can be bounded by entry count or by e.g. bytes. Caches whose entries are derived from
+# the search index register themselves here and are cleared whenever ingestion changes the index.
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float, getsizeof: Optional[Callable[[Any], int]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.getsizeof = getsizeof or (lambda value: 1)
+        self.entries = OrderedDict()
+        self.currsize = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires, _ = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.getsizeof(value)
+        if size > self.maxsize:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, time.monotonic() + self.ttl, size)
+            self.currsize += size
+            while self.currsize > self.maxsize:
+                self._remove(next(iter(self.entries)))
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            return self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.currsize = 0
+
+    def items(self):
+        now = time.monotonic()
+        with self.lock:
+            return [(key, value) for key, (value, expires, _) in self.entries.items() if expires >= now]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        # Unlike get, doesn't count as a hit or miss or mark the entry as recently used
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[1] >= time.monotonic()
+
+    def _remove(self, key):
+        value, _, size = self.entries.pop(key)
+        self.currsize -= size
+        return value
+
+index_caches = []
+
+def register_index_cache(cache):
+    index_caches.append(cache)
+    return cache
+
+def invalidate_index_caches():
+    for cache in index_caches:
+        cache.clear()
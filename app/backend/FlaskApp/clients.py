@@ -1,78 +1,161 @@
+import json
 import logging
 import os
-import random
-from typing import List
+import time
+from contextvars import ContextVar
+from tempfile import gettempdir
+from typing import Any, List
 
+import aiohttp
 import openai
+import requests
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import DefaultAzureCredential
 from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.storage.blob import BlobServiceClient
-from langchain.llms.openai import AzureOpenAI
+from langchain.llms.openai import AzureOpenAI, OpenAI
 from langchain.utilities import BingSearchAPIWrapper
 
+from .aio import loop_local
+from .endpoints import EndpointPool, endpoints_from_env
+from .localsearch import AsyncLocalSearchClient, LocalSearchClient
+from .metrics import observe_openai
+from .ratelimit import RateLimiter, estimate_tokens
+from .tracing import TraceExporter, set_trace_exporter, span
+
 # Replace these with your own values, either in environment variables or directly here
+AGENT_PREFETCH_CONCURRENCY = int(os.environ.get("AGENT_PREFETCH_CONCURRENCY") or 4)
+AGENT_TOOL_CACHE_MAX_ENTRIES = int(os.environ.get("AGENT_TOOL_CACHE_MAX_ENTRIES") or 1000)
+AGENT_TOOL_CACHE_TTL = float(os.environ.get("AGENT_TOOL_CACHE_TTL") or 60)
+ANALYSIS_CACHE_CONTAINER = os.environ.get("ANALYSIS_CACHE_CONTAINER") or None
+ANALYSIS_CACHE_MAX_BYTES = int(os.environ.get("ANALYSIS_CACHE_MAX_BYTES") or 2 * 1024 * 1024 * 1024)
+ANALYSIS_CACHE_PATH = os.environ.get("ANALYSIS_CACHE_PATH") or os.path.join(gettempdir(), "analysis-cache")
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES") or 1000)
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY") or 0.95)
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL") or 3600)
 AZURE_FORM_RECOGNIZER_KEY = os.environ.get("AZURE_FORM_RECOGNIZER_KEY") or None
 AZURE_FORM_RECOGNIZER_SERVICE = os.environ.get("AZURE_FORM_RECOGNIZER_SERVICE") or "myformrecognizer"
+AZURE_OPENAI_API_VERSION = os.environ.get("AZURE_OPENAI_API_VERSION") or "2023-03-15-preview"
+AZURE_OPENAI_CHATGPT_CONTEXT_TOKENS = int(os.environ.get("AZURE_OPENAI_CHATGPT_CONTEXT_TOKENS") or 4096)
 AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_CHATGPT_DEPLOYMENT") or "gpt-35-turbo"
 AZURE_OPENAI_DEFAULT_TEMP = os.environ.get("AZURE_OPENAI_DEFAULT_TEMP") or 0.1
+AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT") or ""
+AZURE_OPENAI_ENDPOINT_COOLDOWN = float(os.environ.get("AZURE_OPENAI_ENDPOINT_COOLDOWN") or 10)
+AZURE_OPENAI_GPT_CONTEXT_TOKENS = int(os.environ.get("AZURE_OPENAI_GPT_CONTEXT_TOKENS") or 4097)
 AZURE_OPENAI_GPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_DEPLOYMENT") or "text-davinci-003"
 AZURE_OPENAI_GPT4_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT4_DEPLOYMENT") or "gpt4"
 AZURE_OPENAI_GPT4_SERVICE_1 = os.environ.get("AZURE_OPENAI_GPT4_SERVICE_1") or ""
 AZURE_OPENAI_GPT4_SERVICE_1_KEY = os.environ.get("AZURE_OPENAI_GPT4_SERVICE_1_KEY") or ""
-AZURE_OPENAI_SERVICE_1 = os.environ.get("AZURE_OPENAI_SERVICE_1") or ""
-AZURE_OPENAI_SERVICE_1_KEY = os.environ.get("AZURE_OPENAI_SERVICE_1_KEY") or ""
-AZURE_OPENAI_SERVICE_2 = os.environ.get("AZURE_OPENAI_SERVICE_2") or ""
-AZURE_OPENAI_SERVICE_2_KEY = os.environ.get("AZURE_OPENAI_SERVICE_2_KEY") or ""
-AZURE_OPENAI_SERVICE_3 = os.environ.get("AZURE_OPENAI_SERVICE_3") or ""
-AZURE_OPENAI_SERVICE_3_KEY = os.environ.get("AZURE_OPENAI_SERVICE_3_KEY") or ""
+AZURE_OPENAI_MAX_ATTEMPTS = int(os.environ.get("AZURE_OPENAI_MAX_ATTEMPTS") or 3)
+AZURE_OPENAI_POOL_SIZE = int(os.environ.get("AZURE_OPENAI_POOL_SIZE") or 32)
+AZURE_OPENAI_QUEUE_SIZE = int(os.environ.get("AZURE_OPENAI_QUEUE_SIZE") or 32)
+AZURE_OPENAI_QUEUE_TIMEOUT = float(os.environ.get("AZURE_OPENAI_QUEUE_TIMEOUT") or 10)
+AZURE_OPENAI_RATE_LIMITS = json.loads(os.environ.get("AZURE_OPENAI_RATE_LIMITS") or "{}")
+AZURE_OPENAI_RPM = int(os.environ.get("AZURE_OPENAI_RPM") or 0)
+AZURE_OPENAI_TPM = int(os.environ.get("AZURE_OPENAI_TPM") or 0)
 AZURE_SEARCH_INDEX = os.environ.get("AZURE_SEARCH_INDEX") or "gptkbindex"
+AZURE_SEARCH_INDEX_BACKOFF = float(os.environ.get("AZURE_SEARCH_INDEX_BACKOFF") or 1.0)
+AZURE_SEARCH_INDEX_BATCH_BYTES = int(os.environ.get("AZURE_SEARCH_INDEX_BATCH_BYTES") or 8 * 1024 * 1024)
+AZURE_SEARCH_INDEX_BATCH_SIZE = int(os.environ.get("AZURE_SEARCH_INDEX_BATCH_SIZE") or 1000)
+AZURE_SEARCH_INDEX_CONCURRENCY = int(os.environ.get("AZURE_SEARCH_INDEX_CONCURRENCY") or 4)
+AZURE_SEARCH_INDEX_MAX_RETRIES = int(os.environ.get("AZURE_SEARCH_INDEX_MAX_RETRIES") or 5)
 AZURE_SEARCH_KEY = os.environ.get("AZURE_SEARCH_KEY") or ""
 AZURE_SEARCH_SERVICE = os.environ.get("AZURE_SEARCH_SERVICE") or "gptkb-y2nmeuebipp4i"
 AZURE_STORAGE_ACCOUNT = os.environ.get("AZURE_STORAGE_ACCOUNT") or "mystorageaccount"
 AZURE_STORAGE_CONTAINER = os.environ.get("AZURE_STORAGE_CONTAINER") or "content"
 AZURE_STORAGE_KEY = os.environ.get("AZURE_STORAGE_KEY") or None
+AZURE_STORAGE_UPLOAD_CONCURRENCY = int(os.environ.get("AZURE_STORAGE_UPLOAD_CONCURRENCY") or 8)
 AZURE_TENANT_ID = os.environ.get("AZURE_TENANT_ID") or None
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY") or 8)
+BATCH_MAX_QUESTIONS = int(os.environ.get("BATCH_MAX_QUESTIONS") or 10000)
+BATCH_PACK_SIZE = int(os.environ.get("BATCH_PACK_SIZE") or 8)
 BING_SEARCH_URL = os.environ.get("BING_SEARCH_URL") or 'https://api.bing.microsoft.com/v7.0/search'
 BING_SUBSCRIPTION_KEY = os.environ.get("BING_SUBSCRIPTION_KEY") or ""
 CATEGORY = os.environ.get("CATEGORY") or "default"
+CHAT_SPECULATIVE_GRACE = float(os.environ.get("CHAT_SPECULATIVE_GRACE") or 0.3)
+CHAT_SPECULATIVE_MAX_TURNS = int(os.environ.get("CHAT_SPECULATIVE_MAX_TURNS") or 0)
+CHAT_SPECULATIVE_RETRIEVAL = (os.environ.get("CHAT_SPECULATIVE_RETRIEVAL") or "false").lower() == "true"
+CONTENT_CACHE_MAX_BLOB_BYTES = int(os.environ.get("CONTENT_CACHE_MAX_BLOB_BYTES") or 4 * 1024 * 1024)
+CONTENT_CACHE_MAX_BYTES = int(os.environ.get("CONTENT_CACHE_MAX_BYTES") or 64 * 1024 * 1024)
+CONTENT_CACHE_TTL = float(os.environ.get("CONTENT_CACHE_TTL") or 300)
+CONTENT_CHUNK_BYTES = int(os.environ.get("CONTENT_CHUNK_BYTES") or 1024 * 1024)
+INGESTION_MANIFEST_PATH = os.environ.get("INGESTION_MANIFEST_PATH") or os.path.join(gettempdir(), "manifests")
+INGESTION_QUEUE_PATH = os.environ.get("INGESTION_QUEUE_PATH") or os.path.join(gettempdir(), "ingestion.db")
+INGESTION_WORKERS = int(os.environ.get("INGESTION_WORKERS") or 2)
 KB_FIELDS_CATEGORY = os.environ.get("KB_FIELDS_CATEGORY") or "category"
 KB_FIELDS_CONTENT = os.environ.get("KB_FIELDS_CONTENT") or "content"
 KB_FIELDS_SOURCEPAGE = os.environ.get("KB_FIELDS_SOURCEPAGE") or "sourcepage"
 LOCAL_PDF_PARSER_BOOL = os.environ.get("LOCAL_PDF_PARSER_BOOL") or False
+LOCAL_SEARCH_PATH = os.environ.get("LOCAL_SEARCH_PATH") or os.path.join(gettempdir(), "local-search")
 LOG_VERBOSE = os.environ.get("LOG_VERBOSE") or False
 MAX_SECTION_LENGTH = 1000
 OPENAI_TOKEN = os.environ.get("OPENAI_TOKEN") or ""
+SEARCH_BACKEND = (os.environ.get("SEARCH_BACKEND") or "azure").lower()
 SECTION_OVERLAP = 100
 SENTENCE_SEARCH_LIMIT = 100
+TRACING_ENABLED = (os.environ.get("TRACING_ENABLED") or "false").lower() == "true"
+TRACING_EXPORT_PATH = os.environ.get("TRACING_EXPORT_PATH") or None
+TRACING_OTLP_ENDPOINT = os.environ.get("TRACING_OTLP_ENDPOINT") or None
+TRACING_SERVICE_NAME = os.environ.get("TRACING_SERVICE_NAME") or "enterprise-chatgpt-backend"
 USE_AZURE_OPENAI = os.environ.get("USE_AZURE_OPENAI") or True
 
-api_endpoints = [
-    {"base_url": f"https://{AZURE_OPENAI_SERVICE_1}.openai.azure.com", "key": f"{AZURE_OPENAI_SERVICE_1_KEY}"},
-    {"base_url": f"https://{AZURE_OPENAI_SERVICE_2}.openai.azure.com", "key": f"{AZURE_OPENAI_SERVICE_2_KEY}"},
-    {"base_url": f"https://{AZURE_OPENAI_SERVICE_3}.openai.azure.com", "key": f"{AZURE_OPENAI_SERVICE_3_KEY}"},
-]
+# Azure OpenAI endpoints come from AZURE_OPENAI_SERVICE_1/AZURE_OPENAI_SERVICE_1_KEY, AZURE_OPENAI_SERVICE_2/... for as many as are set
+openai_endpoints = EndpointPool(endpoints_from_env(os.environ), max_attempts=AZURE_OPENAI_MAX_ATTEMPTS, cooldown=AZURE_OPENAI_ENDPOINT_COOLDOWN)
+
+# One HTTP session shared by all threads for OpenAI calls, it keeps a pool of up to AZURE_OPENAI_POOL_SIZE
+# keep-alive connections per endpoint. By default the openai package creates a session per thread.
+openai_session = requests.Session()
+openai_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=max(len(openai_endpoints.endpoints), 1), pool_maxsize=AZURE_OPENAI_POOL_SIZE))
+openai_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=max(len(openai_endpoints.endpoints), 1), pool_maxsize=AZURE_OPENAI_POOL_SIZE))
+openai.requestssession = openai_session
+
+# Tokens and requests per minute allowed per endpoint and deployment, 0 for no limit. AZURE_OPENAI_RATE_LIMITS
+# overrides them per deployment, e.g. {"gpt-35-turbo": {"tpm": 120000, "rpm": 720}}
+rate_limiter = RateLimiter(AZURE_OPENAI_TPM, AZURE_OPENAI_RPM, AZURE_OPENAI_RATE_LIMITS, max_queue=AZURE_OPENAI_QUEUE_SIZE, max_wait=AZURE_OPENAI_QUEUE_TIMEOUT)
 
-# Define a function to get a random endpoint from the list
-def get_random_endpoint():
-    endpoint = random.choice(api_endpoints)
-    return endpoint
+# Traces of requests and ingestion jobs are exported to an OpenTelemetry collector and/or a file if either is set,
+# TRACING_ENABLED traces every request rather than only those asking for timings, see tracing.py
+if TRACING_OTLP_ENDPOINT or TRACING_EXPORT_PATH:
+    set_trace_exporter(TraceExporter(TRACING_SERVICE_NAME, endpoint=TRACING_OTLP_ENDPOINT, path=TRACING_EXPORT_PATH))
+
+# Services are given by resource name, or by full base URL, e.g. to point at the local fakes in benchmarks/fakes.py
+def service_url(service: str, domain: str) -> str:
+    return service.rstrip("/") if "://" in service else f"https://{service}.{domain}"
 
 # If you encounter a blocking error during a DefaultAzureCredntial resolution, you can exclude the problematic credential by using a parameter (ex. exclude_shared_token_cache_credential=True)
 azure_credential = DefaultAzureCredential()
 
-index_client = SearchIndexClient(endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net/",
+index_client = SearchIndexClient(endpoint=service_url(AZURE_SEARCH_SERVICE, "search.windows.net") + "/",
                                  credential=AzureKeyCredential(AZURE_SEARCH_KEY))
 
-# Set up clients for Cognitive Search and Storage
-search_client = SearchClient(
-    endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-    index_name=AZURE_SEARCH_INDEX,
-    credential=AzureKeyCredential(AZURE_SEARCH_KEY))
+# Set up clients for Cognitive Search and Storage. SEARCH_BACKEND=local swaps Cognitive Search for the in-process
+# engine in localsearch.py, e.g. for offline development and load tests.
+if SEARCH_BACKEND == "local":
+    search_client = LocalSearchClient(LOCAL_SEARCH_PATH)
+else:
+    search_client = SearchClient(
+        endpoint=service_url(AZURE_SEARCH_SERVICE, "search.windows.net"),
+        index_name=AZURE_SEARCH_INDEX,
+        credential=AzureKeyCredential(AZURE_SEARCH_KEY))
+
+# The async search client and OpenAI HTTP session are created once per event loop, see aio.py
+def async_search_client():
+    if SEARCH_BACKEND == "local":
+        return loop_local("search_client", lambda: AsyncLocalSearchClient(search_client))
+    return loop_local("search_client", lambda: AsyncSearchClient(
+        endpoint=service_url(AZURE_SEARCH_SERVICE, "search.windows.net"),
+        index_name=AZURE_SEARCH_INDEX,
+        credential=AzureKeyCredential(AZURE_SEARCH_KEY)))
+
+def openai_aiosession():
+    return loop_local("openai_aiosession", lambda: aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=AZURE_OPENAI_POOL_SIZE)))
+
+# With AZURE_STORAGE_KEY set the account key is used instead of the Azure AD identity
 blob_client = BlobServiceClient(
-    account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
-    credential=azure_credential)
+    account_url=service_url(AZURE_STORAGE_ACCOUNT, "blob.core.windows.net"),
+    credential={"account_name": AZURE_STORAGE_ACCOUNT.rstrip("/").rsplit("/", 1)[-1], "account_key": AZURE_STORAGE_KEY} if AZURE_STORAGE_KEY else azure_credential)
 blob_container = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
 
 default_creds = azure_credential if AZURE_STORAGE_KEY == None else AzureKeyCredential(
@@ -104,39 +187,110 @@ def ensure_openai_token():
     #         "https://cognitiveservices.azure.com/.default")
     #     openai.api_key = openai_token.token
 
-def completion_client(prompt, max_tokens, temperature, n, stop, deployment_name):
-        if USE_AZURE_OPENAI:
-            aoai_endpoint = get_random_endpoint()
+def azure_openai_params(aoai_endpoint):
+    # Passed with every call instead of setting openai.api_base/api_key/..., which are shared by all threads
+    return {"api_type": "azure", "api_base": aoai_endpoint.base_url, "api_key": aoai_endpoint.key, "api_version": AZURE_OPENAI_API_VERSION}
 
-            logging.info(f"Using Azure OpenAI endpoint: {aoai_endpoint['base_url']}")
-            logging.info(f"Using Azure GPT deployment: {deployment_name}")
+# Record the latency and token usage of each successful call to an endpoint, see metrics.py
+def observed(create, deployment_name, stream=False):
+    def call(aoai_endpoint):
+        start = time.perf_counter()
+        result = create(aoai_endpoint)
+        observe_openai(deployment_name, aoai_endpoint.name, time.perf_counter() - start, None if stream else result.get("usage"))
+        return result
+    return call
 
-            openai.api_type = "azure"
-            openai.api_base = f"{aoai_endpoint['base_url']}"
-            openai.api_key = aoai_endpoint['key']
-            openai.api_version = "2023-03-15-preview"
-
-            completion = openai.Completion.create(
-                engine=deployment_name, 
-                prompt=prompt, 
-                temperature=temperature, 
-                max_tokens=max_tokens, 
-                n=n, 
-                stop=stop)
-        else:
-            openai.api_type = "open_ai"
-            openai.api_key = OPENAI_TOKEN
-            completion = openai.Completion.create(
-                model=deployment_name, 
-                prompt=prompt, 
-                temperature=temperature, 
-                max_tokens=max_tokens, 
-                n=1, 
-                stop=stop)
-        return completion
+def aobserved(create, deployment_name, stream=False):
+    async def call(aoai_endpoint):
+        start = time.perf_counter()
+        result = await create(aoai_endpoint)
+        observe_openai(deployment_name, aoai_endpoint.name, time.perf_counter() - start, None if stream else result.get("usage"))
+        return result
+    return call
+
+def completion_client(prompt, max_tokens, temperature, n, stop, deployment_name, stream=False):
+        with span("completion", deployment=deployment_name, prompts=len(prompt) if isinstance(prompt, list) else 1, stream=stream) as s:
+            if USE_AZURE_OPENAI:
+                def create(aoai_endpoint):
+                    logging.info(f"Using Azure OpenAI endpoint: {aoai_endpoint.base_url}")
+                    logging.info(f"Using Azure GPT deployment: {deployment_name}")
+                    s.set(endpoint=aoai_endpoint.name)
+
+                    return openai.Completion.create(
+                        engine=deployment_name, 
+                        prompt=prompt, 
+                        temperature=temperature, 
+                        max_tokens=max_tokens, 
+                        n=n, 
+                        stop=stop,
+                        stream=stream,
+                        **azure_openai_params(aoai_endpoint))
+                tokens = estimate_tokens(prompt) + max_tokens * n * (len(prompt) if isinstance(prompt, list) else 1)
+                completion = openai_endpoints.call(observed(create, deployment_name, stream), admit=lambda aoai_endpoint: rate_limiter.acquire(aoai_endpoint.name, deployment_name, tokens))
+            else:
+                completion = openai.Completion.create(
+                    model=deployment_name, 
+                    prompt=prompt, 
+                    temperature=temperature, 
+                    max_tokens=max_tokens, 
+                    n=1, 
+                    stop=stop,
+                    stream=stream,
+                    api_type="open_ai",
+                    api_key=OPENAI_TOKEN)
+            if not stream:
+                s.set(**(completion.get("usage") or {}))
+            return completion
+
+async def acompletion_client(prompt, max_tokens, temperature, n, stop, deployment_name, stream=False):
+        # Same as completion_client, without blocking the event loop
+        openai.aiosession.set(openai_aiosession())
+        with span("completion", deployment=deployment_name, prompts=len(prompt) if isinstance(prompt, list) else 1, stream=stream) as s:
+            if USE_AZURE_OPENAI:
+                async def create(aoai_endpoint):
+                    logging.info(f"Using Azure OpenAI endpoint: {aoai_endpoint.base_url}")
+                    logging.info(f"Using Azure GPT deployment: {deployment_name}")
+                    s.set(endpoint=aoai_endpoint.name)
+
+                    return await openai.Completion.acreate(
+                        engine=deployment_name, 
+                        prompt=prompt, 
+                        temperature=temperature, 
+                        max_tokens=max_tokens, 
+                        n=n, 
+                        stop=stop,
+                        stream=stream,
+                        **azure_openai_params(aoai_endpoint))
+                tokens = estimate_tokens(prompt) + max_tokens * n * (len(prompt) if isinstance(prompt, list) else 1)
+                completion = await openai_endpoints.acall(aobserved(create, deployment_name, stream), admit=lambda aoai_endpoint: rate_limiter.acquire_async(aoai_endpoint.name, deployment_name, tokens))
+            else:
+                completion = await openai.Completion.acreate(
+                    model=deployment_name, 
+                    prompt=prompt, 
+                    temperature=temperature, 
+                    max_tokens=max_tokens, 
+                    n=1, 
+                    stop=stop,
+                    stream=stream,
+                    api_type="open_ai",
+                    api_key=OPENAI_TOKEN)
+            if not stream:
+                s.set(**(completion.get("usage") or {}))
+            return completion
+
+def embedding_client(text, deployment_name):
+        with span("embedding", deployment=deployment_name):
+            def create(aoai_endpoint):
+                return openai.Embedding.create(engine=deployment_name, input=text, **azure_openai_params(aoai_endpoint))
+            embedding = openai_endpoints.call(observed(create, deployment_name), admit=lambda aoai_endpoint: rate_limiter.acquire(aoai_endpoint.name, deployment_name, estimate_tokens(text)))
+            return embedding["data"][0]["embedding"]
+
+# The endpoint serving the current langchain call, see NewAzureOpenAI._generate
+current_endpoint = ContextVar("current_endpoint", default=None)
 
 class NewAzureOpenAI(AzureOpenAI):
     stop: List[str] = None
+    endpoints: Any = None
     @property
     def _invocation_params(self):
         params = super()._invocation_params
@@ -145,23 +299,41 @@ class NewAzureOpenAI(AzureOpenAI):
         params.pop('best_of', None)
         params.pop('echo', None)
         # params['stop'] = self.stop
+        aoai_endpoint = current_endpoint.get()
+        if aoai_endpoint is not None:
+            params.update(azure_openai_params(aoai_endpoint))
         return params
 
-def llm_client(deployment_name, overrides):
-        if USE_AZURE_OPENAI:
-            aoai_endpoint = get_random_endpoint()
-
-            logging.info(f"Using Azure OpenAI endpoint: {aoai_endpoint['base_url']}")
-            logging.info(f"Using Azure GPT deployment: {AZURE_OPENAI_GPT_DEPLOYMENT}")
+    def _generate(self, prompts, stop=None):
+        if self.endpoints is None:
+            return super()._generate(prompts, stop)
+        def generate(aoai_endpoint):
+            token = current_endpoint.set(aoai_endpoint)
+            start = time.perf_counter()
+            try:
+                result = super(NewAzureOpenAI, self)._generate(prompts, stop)
+            finally:
+                current_endpoint.reset(token)
+            observe_openai(self.deployment_name, aoai_endpoint.name, time.perf_counter() - start, (result.llm_output or {}).get("token_usage"))
+            return result
+        tokens = estimate_tokens(prompts) + max(self.max_tokens, 0) * len(prompts)
+        with span("completion", deployment=self.deployment_name, prompts=len(prompts)) as s:
+            result = self.endpoints.call(generate, admit=lambda aoai_endpoint: rate_limiter.acquire(aoai_endpoint.name, self.deployment_name, tokens))
+            s.set(**(result.llm_output or {}).get("token_usage", {}))
+            return result
 
-            openai.api_type = "azure"
-            openai.api_base = f"{aoai_endpoint['base_url']}"
-            openai.api_key = aoai_endpoint['key']
-            openai.api_version = "2023-03-15-preview"
+# An unset (or null) temperature override means the approach's default, an explicit 0 is honored
+def override_temperature(overrides, default):
+    temperature = overrides.get("temperature")
+    return default if temperature is None else temperature
 
-            llm = NewAzureOpenAI(deployment_name=deployment_name, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key, stop=["\n"]) # type: ignore
+def llm_client(deployment_name, overrides):
+        if USE_AZURE_OPENAI:
+            logging.info(f"Using Azure GPT deployment: {deployment_name}")
+            # Each call picks its endpoint from the pool and sends that endpoint's key, langchain only insists that
+            # a key is set. Retries are left to the pool so that a throttled endpoint fails over straight away.
+            llm = NewAzureOpenAI(deployment_name=deployment_name, temperature=override_temperature(overrides, 0.3), openai_api_key="per-call", stop=["\n"],
+                                 endpoints=openai_endpoints, max_retries=1) # type: ignore
         else:
-            openai.api_type = "open_ai"
-            openai.api_key = OPENAI_TOKEN
-            llm = OpenAI(model_name=deployment_name, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key) # type: ignore
-        return llm
\ No newline at end of file
+            llm = OpenAI(model_name=deployment_name, temperature=override_temperature(overrides, 0.3), openai_api_key=OPENAI_TOKEN) # type: ignore
+        return llm
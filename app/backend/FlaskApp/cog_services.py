@@ -1,13 +1,16 @@
 import html
 import io
+import json
 import logging
 import os
+import random
 import re
-import sys
 import time
+from bisect import bisect_left, bisect_right
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from azure.ai.formrecognizer import DocumentAnalysisClient
-from azure.identity import DefaultAzureCredential
+from azure.ai.formrecognizer import AnalyzeResult, DocumentAnalysisClient
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
 from azure.search.documents.indexes.models import (PrioritizedFields,
                                                    SearchableField,
                                                    SearchIndex,
@@ -15,15 +18,29 @@ from azure.search.documents.indexes.models import (PrioritizedFields,
                                                    SemanticField,
                                                    SemanticSettings,
                                                    SimpleField)
-from azure.storage.blob import BlobServiceClient
 from pypdf import PdfReader, PdfWriter
 
-from .clients import (AZURE_STORAGE_ACCOUNT, AZURE_STORAGE_KEY,AZURE_STORAGE_CONTAINER, LOCAL_PDF_PARSER_BOOL, LOG_VERBOSE, AZURE_FORM_RECOGNIZER_SERVICE, AZURE_SEARCH_SERVICE, AZURE_SEARCH_INDEX, search_client, index_client, CATEGORY, formrecognizer_creds)
+from .clients import (AZURE_STORAGE_UPLOAD_CONCURRENCY, blob_container, LOCAL_PDF_PARSER_BOOL, LOG_VERBOSE, AZURE_FORM_RECOGNIZER_SERVICE, AZURE_SEARCH_SERVICE, AZURE_SEARCH_INDEX, search_client, index_client, CATEGORY, formrecognizer_creds, INGESTION_MANIFEST_PATH, ANALYSIS_CACHE_CONTAINER, ANALYSIS_CACHE_MAX_BYTES, ANALYSIS_CACHE_PATH, blob_client, AZURE_SEARCH_INDEX_BACKOFF, AZURE_SEARCH_INDEX_BATCH_BYTES, AZURE_SEARCH_INDEX_BATCH_SIZE, AZURE_SEARCH_INDEX_CONCURRENCY, AZURE_SEARCH_INDEX_MAX_RETRIES, SEARCH_BACKEND, service_url)
+from .analysiscache import AnalysisCache
+from .cache import invalidate_index_caches
+from .manifest import ManifestStore, file_hash, page_hash, section_hash
+from .metrics import ingestion_files, ingestion_latency, ingestion_pages, ingestion_sections, timed
+from .tracing import span
 
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
 
+# 429 and 503 mean the search service is throttling, the request can be retried after backing off
+RETRYABLE_STATUS_CODES = (429, 503)
+
+checked_containers = set()
+manifest_store = ManifestStore(INGESTION_MANIFEST_PATH)
+analysis_cache = AnalysisCache(ANALYSIS_CACHE_PATH, ANALYSIS_CACHE_MAX_BYTES, blob_client.get_container_client(ANALYSIS_CACHE_CONTAINER) if ANALYSIS_CACHE_CONTAINER else None)
+
+def no_progress(stage, done, total):
+    pass
+
 def blob_name_from_file_page(filename, page = 0):
     if os.path.splitext(filename)[1].lower() == ".pdf":
         # Remove spaces and dots from filename
@@ -33,49 +50,114 @@ def blob_name_from_file_page(filename, page = 0):
     else:
         return os.path.basename(filename)
 
-def upload_blobs(filename):
-    try:
-        logging.info(f"Uploading blobs for '{filename}' and storage_key '{AZURE_STORAGE_KEY}")
-        credential = DefaultAzureCredential()
-        blob_service = BlobServiceClient(account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=credential)
-        blob_container = blob_service.get_container_client(AZURE_STORAGE_CONTAINER) # type: ignore
-    except Exception as e:
-        logging.error(f"Error connecting to blob storage: {e}")
-        sys.exit(1)
-
-    if not blob_container.exists():
-        blob_container.create_container()
+def ensure_container(container):
+    # Only ask storage whether the container exists the first time it is used by this process
+    name = getattr(container, "container_name", id(container))
+    if name in checked_containers:
+        return
+    if not container.exists():
+        try:
+            container.create_container()
+        except ResourceExistsError:
+            # Created by another ingestion worker in the meantime
+            pass
+    checked_containers.add(name)
+
+def split_pdf_pages(reader, pages):
+    for i in pages:
+        page = reader.pages[i]
+        f = io.BytesIO()
+        writer = PdfWriter()
+        writer.add_page(page)
+        writer.write(f)
+        f.seek(0)
+        yield i, f
+
+def upload_blobs(filename, container=None, concurrency=AZURE_STORAGE_UPLOAD_CONCURRENCY, progress=no_progress, pages=None):
+    logging.info(f"Uploading blobs for '{filename}'")
+    container = container or blob_container
+    ensure_container(container)
+
+    uploaded = []
+    failed = {}
+    in_flight = {}
+    def collect(futures):
+        for future in futures:
+            blob_name = in_flight.pop(future)
+            try:
+                future.result()
+                uploaded.append(blob_name)
+            except Exception as e:
+                logging.error(f"\tError uploading blob {blob_name}: {e}")
+                failed[blob_name] = str(e)
+            progress("upload_blobs", len(uploaded) + len(failed), total)
+
     # if file is PDF split into pages and upload each page as a separate blob
     if os.path.splitext(filename)[1].lower() == ".pdf":
         reader = PdfReader(filename)
-        pages = reader.pages
-        for i in range(len(pages)):
+        if pages is None:
+            pages = range(len(reader.pages))
+        total = len(pages)
+        pages = split_pdf_pages(reader, pages)
+    else:
+        total = 1
+        with open(filename, "rb") as f:
+            pages = [(0, io.BytesIO(f.read()))]
+    progress("upload_blobs", 0, total)
+
+    # Pages are split one at a time on this thread (the pdf reader is not thread safe) and uploaded by the pool,
+    # with at most twice the pool size split pages held in memory at any time
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, data in pages:
             blob_name = blob_name_from_file_page(filename, i)
             logging.info(f"\tUploading blob for page {i} -> {blob_name}")
-            f = io.BytesIO()
-            writer = PdfWriter()
-            writer.add_page(pages[i])
-            writer.write(f)
-            f.seek(0)
-            blob_container.upload_blob(blob_name, f, overwrite=True)
-    else:
-        blob_name = blob_name_from_file_page(filename)
-        with open(filename,"rb") as data:
-            blob_container.upload_blob(blob_name, data, overwrite=True)
+            in_flight[executor.submit(container.upload_blob, blob_name, data, overwrite=True)] = blob_name
+            if len(in_flight) >= 2 * concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(list(in_flight))
+
+    logging.info(f"\tUploaded {len(uploaded)} blobs for '{filename}', {len(failed)} failed")
+    return {"uploaded": len(uploaded), "failed": failed}
 
-def remove_blobs(filename,storage_creds,container):
+def delete_blob_batch(container, names):
+    # One batch request deletes up to 256 blobs, fall back to single deletes to find out which ones failed
+    try:
+        container.delete_blobs(*names)
+        return {}
+    except Exception:
+        failed = {}
+        for name in names:
+            try:
+                container.delete_blob(name)
+            except ResourceNotFoundError:
+                pass
+            except Exception as e:
+                failed[name] = str(e)
+        return failed
+
+def delete_blobs(container, names, concurrency=AZURE_STORAGE_UPLOAD_CONCURRENCY):
+    failed = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch_failed in executor.map(lambda i: delete_blob_batch(container, names[i:i + 256]), range(0, len(names), 256)):
+            failed.update(batch_failed)
+    return failed
+
+def remove_blobs(filename, container=None, concurrency=AZURE_STORAGE_UPLOAD_CONCURRENCY):
     logging.info(f"Removing blobs for '{filename or '<all>'}'")
-    blob_service = BlobServiceClient(account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=storage_creds)
-    blob_container = blob_service.get_container_client(AZURE_STORAGE_CONTAINER)
-    if blob_container.exists():
-        if filename == None:
-            blobs = blob_container.list_blob_names()
-        else:
-            prefix = os.path.splitext(os.path.basename(filename))[0]
-            blobs = filter(lambda b: re.match(f"{prefix}-\d+\.pdf", b), blob_container.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0]))
-        for b in blobs:
-            logging.info(f"\tRemoving blob {b}")
-            blob_container.delete_blob(b)
+    container = container or blob_container
+    if not container.exists():
+        return {"removed": 0, "failed": {}}
+    if filename == None:
+        names = list(container.list_blob_names())
+    elif os.path.splitext(filename)[1].lower() == ".pdf":
+        prefix = blob_name_from_file_page(filename)[:-len("-0.pdf")]
+        names = [b for b in container.list_blob_names(name_starts_with=prefix) if re.fullmatch(re.escape(prefix) + r"-\d+\.pdf", b)]
+    else:
+        names = [blob_name_from_file_page(filename)]
+    failed = delete_blobs(container, names, concurrency)
+    logging.info(f"\tRemoved {len(names) - len(failed)} blobs, {len(failed)} failed")
+    return {"removed": len(names) - len(failed), "failed": failed}
 
 def table_to_html(table):
     table_html = "<table>"
@@ -92,95 +174,166 @@ def table_to_html(table):
     table_html += "</table>"
     return table_html
 
-def get_document_text(filename):
+def get_page_text(content, page_span, tables_on_page):
+    # Build the page text from whole runs of content, replacing the characters covered by table spans with the
+    # table html at the position where each table first appears. Where spans of different tables overlap the
+    # later table wins.
+    page_offset = page_span.offset
+    page_length = page_span.length
+    boundaries = {0, page_length}
+    spans = []
+    for table_id, table in enumerate(tables_on_page):
+        for span in table.spans:
+            span_start = max(span.offset - page_offset, 0)
+            span_end = min(span.offset - page_offset + span.length, page_length)
+            if span_start < span_end:
+                spans.append((span_start, span_end, table_id))
+                boundaries.update((span_start, span_end))
+
+    if not spans:
+        return content[page_offset:page_offset + page_length]
+
+    boundaries = sorted(boundaries)
+    spans.sort()
+    parts = []
+    added_tables = set()
+    active = []
+    next_span = 0
+    for run_start, run_end in zip(boundaries, boundaries[1:]):
+        active = [s for s in active if s[1] > run_start]
+        while next_span < len(spans) and spans[next_span][0] <= run_start:
+            active.append(spans[next_span])
+            next_span += 1
+        table_id = max((s[2] for s in active), default=-1)
+        if table_id == -1:
+            parts.append(content[page_offset + run_start:page_offset + run_end])
+        elif not table_id in added_tables:
+            parts.append(table_to_html(tables_on_page[table_id]))
+            added_tables.add(table_id)
+    return "".join(parts)
+
+def format_page_ranges(pages):
+    # Form Recognizer takes 1-based page ranges, e.g. "1-3,5"
+    ranges = []
+    for page_num in sorted(pages):
+        if ranges and ranges[-1][1] == page_num:
+            ranges[-1][1] = page_num + 1
+        else:
+            ranges.append([page_num + 1, page_num + 1])
+    return ",".join(f"{first}-{last}" if first != last else f"{first}" for first, last in ranges)
+
+# Only the given page numbers are extracted when pages is set, the default is the whole document
+def get_document_text(filename, progress=no_progress, pages=None):
     offset = 0
     page_map = []
+    if pages is not None and len(pages) == 0:
+        progress("analyze", 0, 0)
+        return page_map
     # Skip local PDF parsing for now
     if LOCAL_PDF_PARSER_BOOL:
         reader = PdfReader(filename)
-        pages = reader.pages
-        for page_num, p in enumerate(pages):
-            page_text = p.extract_text()
+        if pages is None:
+            pages = range(len(reader.pages))
+        for i, page_num in enumerate(pages):
+            page_text = reader.pages[page_num].extract_text()
             page_map.append((page_num, offset, page_text))
             offset += len(page_text)
+            progress("analyze", i + 1, len(pages))
     else:
         logging.info(f"Extracting text from '{filename}' using Azure Form Recognizer")
-        form_recognizer_client = DocumentAnalysisClient(endpoint=f"https://{AZURE_FORM_RECOGNIZER_SERVICE}.cognitiveservices.azure.com/", credential=formrecognizer_creds, headers={"x-ms-useragent": "azure-search-chat-demo/1.0.0"}) # type: ignore
-        with open(filename, "rb") as f:
-            poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document = f)
-        form_recognizer_results = poller.result()
-
-        for page_num, page in enumerate(form_recognizer_results.pages):
-            tables_on_page = [table for table in form_recognizer_results.tables if table.bounding_regions[0].page_number == page_num + 1] # type: ignore
-
-            # mark all positions of the table spans in the page
-            page_offset = page.spans[0].offset
-            page_length = page.spans[0].length
-            table_chars = [-1]*page_length
-            for table_id, table in enumerate(tables_on_page):
-                for span in table.spans:
-                    # replace all table spans with "table_id" in table_chars array
-                    for i in range(span.length):
-                        idx = span.offset - page_offset + i
-                        if idx >=0 and idx < page_length:
-                            table_chars[idx] = table_id
-
-            # build page text by replacing charcters in table spans with table html
-            page_text = ""
-            added_tables = set()
-            for idx, table_id in enumerate(table_chars):
-                if table_id == -1:
-                    page_text += form_recognizer_results.content[page_offset + idx]
-                elif not table_id in added_tables:
-                    page_text += table_to_html(tables_on_page[table_id])
-                    added_tables.add(table_id)
-
-            page_text += " "
-            page_map.append((page_num, offset, page_text))
-            offset += len(page_text)
+        progress("analyze", 0, None)
+        page_ranges = format_page_ranges(pages) if pages is not None else None
+        # Analyze results are cached so that re-chunking or re-ingesting a document doesn't pay for OCR again
+        cache_key = analysis_cache.key(file_hash(filename), "prebuilt-layout", page_ranges)
+        cached_results = analysis_cache.get(cache_key)
+        if cached_results is not None:
+            logging.info(f"Using cached Form Recognizer results for '{filename}'")
+            form_recognizer_results = AnalyzeResult.from_dict(cached_results)
+        else:
+            form_recognizer_client = DocumentAnalysisClient(endpoint=service_url(AZURE_FORM_RECOGNIZER_SERVICE, "cognitiveservices.azure.com") + "/", credential=formrecognizer_creds, headers={"x-ms-useragent": "azure-search-chat-demo/1.0.0"}) # type: ignore
+            with open(filename, "rb") as f:
+                if page_ranges is None:
+                    poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document = f)
+                else:
+                    poller = form_recognizer_client.begin_analyze_document("prebuilt-layout", document = f, pages=page_ranges)
+            form_recognizer_results = poller.result()
+            analysis_cache.put(cache_key, form_recognizer_results.to_dict())
+        page_map = assemble_pages(form_recognizer_results, progress)
     logging.info(page_map)
     return page_map
 
+def assemble_pages(form_recognizer_results, progress=no_progress):
+    offset = 0
+    page_map = []
+    tables_by_page = {}
+    for table in form_recognizer_results.tables: # type: ignore
+        tables_by_page.setdefault(table.bounding_regions[0].page_number, []).append(table) # type: ignore
+
+    for i, page in enumerate(form_recognizer_results.pages):
+        page_num = page.page_number - 1
+        tables_on_page = tables_by_page.get(page.page_number, [])
+        page_text = get_page_text(form_recognizer_results.content, page.spans[0], tables_on_page)
+        page_text += " "
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+        progress("analyze", i + 1, len(form_recognizer_results.pages))
+    return page_map
+
 def split_text(page_map):
     SENTENCE_ENDINGS = [".", "!", "?"]
     WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
 
-    def find_page(offset):
-        l = len(page_map)
-        for i in range(l - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return l - 1
-
     all_text = "".join(p[2] for p in page_map)
     length = len(all_text)
+
+    # Index every sentence ending and word break once, so that finding section boundaries is a bisect
+    # instead of a character by character scan of the text for every section
+    sentence_endings = [m.start() for m in re.finditer("[" + re.escape("".join(SENTENCE_ENDINGS)) + "]", all_text)]
+    word_breaks = [m.start() for m in re.finditer("[" + re.escape("".join(WORDS_BREAKS)) + "]", all_text)]
+    page_offsets = [p[1] for p in page_map]
+
+    def find_page(offset):
+        i = bisect_right(page_offsets, offset) - 1
+        return i if i >= 0 else len(page_map) - 1
+
+    def is_sentence_ending(i):
+        return all_text[i] in SENTENCE_ENDINGS
+
     start = 0
     end = length
     while start + SECTION_OVERLAP < length:
-        last_word = -1
         end = start + MAX_SECTION_LENGTH
 
         if end > length:
             end = length
         else:
-            # Try to find the end of the sentence
-            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word # Fall back to at least keeping a whole word
+            # Try to find the end of the sentence within SENTENCE_SEARCH_LIMIT characters
+            search_end = min(length, end + SENTENCE_SEARCH_LIMIT)
+            i = bisect_left(sentence_endings, end)
+            if i < len(sentence_endings) and sentence_endings[i] < search_end:
+                end = sentence_endings[i]
+            else:
+                # Fall back to at least keeping a whole word, breaking at the last word break of the searched range
+                j = bisect_left(word_breaks, search_end) - 1
+                last_word = word_breaks[j] if j >= 0 and word_breaks[j] >= end else -1
+                end = search_end
+                if end < length and not is_sentence_ending(end) and last_word > 0:
+                    end = last_word
         if end < length:
             end += 1
 
         # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
+        search_start = max(0, end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT)
+        if start > search_start:
+            i = bisect_right(sentence_endings, start) - 1
+            if i >= 0 and sentence_endings[i] > search_start:
+                start = sentence_endings[i]
+            else:
+                j = bisect_right(word_breaks, search_start)
+                last_word = word_breaks[j] if j < len(word_breaks) and word_breaks[j] <= start else -1
+                start = search_start
+                if not is_sentence_ending(start) and last_word > 0:
+                    start = last_word
         if start > 0:
             start += 1
 
@@ -211,12 +364,15 @@ def create_sections(filename, page_map):
         }
 
 def create_search_index(index):
+    if SEARCH_BACKEND == "local":
+        # The local engine has a fixed schema and creates its files on first use
+        return
     logging.info(f"Ensuring search index {index} exists")
     if index not in index_client.list_index_names():
         index = SearchIndex(
             name=index,
             fields=[
-                SimpleField(name="id", type="Edm.String", key=True),
+                SimpleField(name="id", type="Edm.String", key=True, filterable=True, sortable=True),
                 SearchableField(name="content", type="Edm.String", analyzer_name="en.microsoft"),
                 SimpleField(name="category", type="Edm.String", filterable=True, facetable=True),
                 SimpleField(name="sourcepage", type="Edm.String", filterable=True, facetable=True),
@@ -233,39 +389,229 @@ def create_search_index(index):
     else:
         logging.info(f"Search index {index} already exists")
 
-def index_sections(filename, sections, index):
-    logging.info(f"Indexing sections from '{filename}' into search index '{index}'")
-    i = 0
+def batch_sections(sections, max_count, max_bytes):
+    # Group sections into batches that stay under both the document count and the request size limits
     batch = []
+    batch_bytes = 0
     for s in sections:
-        batch.append(s)
-        i += 1
-        if i % 1000 == 0:
-            results = search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            logging.info(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+        size = len(json.dumps(s).encode("utf-8"))
+        if batch and (len(batch) >= max_count or batch_bytes + size > max_bytes):
+            yield batch
             batch = []
+            batch_bytes = 0
+        batch.append(s)
+        batch_bytes += size
+    if batch:
+        yield batch
 
-    if len(batch) > 0:
-        results = search_client.upload_documents(documents=batch)
-        succeeded = sum([1 for r in results if r.succeeded])
-        logging.info(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+def send_batch(operation, batch):
+    # Send one batch of index actions, retrying only the documents that were throttled, with exponential backoff and jitter
+    pending = batch
+    succeeded = 0
+    failed = {}
+    retries = 0
+    for attempt in range(AZURE_SEARCH_INDEX_MAX_RETRIES + 1):
+        if attempt > 0:
+            retries += 1
+            time.sleep(min(AZURE_SEARCH_INDEX_BACKOFF * 2 ** (attempt - 1), 60) * random.uniform(0.5, 1.0))
+        try:
+            results = operation(documents=pending)
+        except HttpResponseError as e:
+            if e.status_code in RETRYABLE_STATUS_CODES and attempt < AZURE_SEARCH_INDEX_MAX_RETRIES:
+                logging.warning(f"\tBatch of {len(pending)} documents throttled ({e.status_code}), retrying")
+                continue
+            failed.update((d["id"], str(e)) for d in pending)
+            return succeeded, failed, retries
+        except Exception as e:
+            # Connection errors and timeouts, the whole batch is retried
+            if attempt < AZURE_SEARCH_INDEX_MAX_RETRIES:
+                logging.warning(f"\tBatch of {len(pending)} documents failed ({e}), retrying")
+                continue
+            failed.update((d["id"], str(e)) for d in pending)
+            return succeeded, failed, retries
+        retry_keys = set()
+        for r in results:
+            if r.succeeded:
+                succeeded += 1
+            elif r.status_code in RETRYABLE_STATUS_CODES:
+                retry_keys.add(r.key)
+            else:
+                failed[r.key] = r.error_message
+        pending = [d for d in pending if d["id"] in retry_keys]
+        if not pending:
+            break
+    failed.update((d["id"], "throttled, retries exhausted") for d in pending)
+    return succeeded, failed, retries
+
+def send_batches(operation, batches, concurrency, progress=None):
+    # Run operation (upload_documents or delete_documents of a search client) over the batches with at most
+    # twice the pool size batches in flight, and summarize the outcome
+    summary = {"succeeded": 0, "failed": {}, "batches": 0, "retries": 0, "sent": 0}
+    in_flight = {}
+    def collect(futures):
+        for future in futures:
+            batch_size = in_flight.pop(future)
+            succeeded, failed, retries = future.result()
+            summary["succeeded"] += succeeded
+            summary["failed"].update(failed)
+            summary["retries"] += retries
+            logging.info(f"\tSent {batch_size} documents, {succeeded} succeeded")
+            if progress:
+                progress(summary["succeeded"] + len(summary["failed"]))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch in batches:
+            in_flight[executor.submit(send_batch, operation, batch)] = len(batch)
+            summary["batches"] += 1
+            summary["sent"] += len(batch)
+            if len(in_flight) >= 2 * concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(list(in_flight))
+    return summary
+
+def index_sections(filename, sections, index, progress=no_progress, client=None, concurrency=AZURE_SEARCH_INDEX_CONCURRENCY):
+    logging.info(f"Indexing sections from '{filename}' into search index '{index}'")
+    client = client or search_client
+    progress("index", 0, None)
+    batches = batch_sections(sections, AZURE_SEARCH_INDEX_BATCH_SIZE, AZURE_SEARCH_INDEX_BATCH_BYTES)
+    summary = send_batches(client.upload_documents, batches, concurrency, lambda done: progress("index", done, None))
+    progress("index", summary["sent"], summary["sent"])
+    logging.info(f"Indexed {summary['succeeded']} of {summary['sent']} sections from '{filename}' in {summary['batches']} batches, {len(summary['failed'])} failed, {summary['retries']} retries")
+    return summary
+
+def remove_sections(ids, client=None, concurrency=AZURE_SEARCH_INDEX_CONCURRENCY):
+    client = client or search_client
+    batches = ([{ "id": id } for id in ids[i:i + AZURE_SEARCH_INDEX_BATCH_SIZE]] for i in range(0, len(ids), AZURE_SEARCH_INDEX_BATCH_SIZE))
+    summary = send_batches(client.delete_documents, batches, concurrency)
+    logging.info(f"\tRemoved {summary['succeeded']} of {len(ids)} sections from index, {len(summary['failed'])} failed")
+    return summary
+
+def list_section_ids(filter, client=None, page_size=1000):
+    # Key only query, the client pages through all matching documents
+    client = client or search_client
+    if filter is None and SEARCH_BACKEND != "local":
+        try:
+            return list_all_section_ids(client, page_size)
+        except HttpResponseError as e:
+            # Indexes created before the id field was made sortable and filterable
+            logging.warning(f"\tUnable to page through the index by id, listing sections with skip instead: {e}")
+    return [d["id"] for d in client.search("", filter=filter, select=["id"], include_total_count=True)]
+
+def list_all_section_ids(client, page_size):
+    # The service caps $skip at 100,000, so the whole index is paged through by key instead: ordered by id, each
+    # page starting after the last id of the one before. azure-search-documents 11.4.0b3 sends order_by as given
+    # rather than joining a list, so it is passed as the $orderby string.
+    ids = []
+    while True:
+        filter = "id gt '{}'".format(ids[-1].replace("'", "''")) if ids else None
+        page = [d["id"] for d in client.search("", filter=filter, order_by="id", select=["id"], top=page_size)]
+        ids += page
+        if len(page) < page_size:
+            return ids
 
 def remove_from_index(filename,index):
     logging.info(f"Removing sections from '{filename or '<all>'}' from search index '{index}'")
-    while True:
-        filter = None if filename == None else f"sourcefile eq '{os.path.basename(filename)}'"
-        r = search_client.search("", filter=filter, top=1000, include_total_count=True)
-        if r.get_count() == 0:
-            break
-        r = search_client.delete_documents(documents=[{ "id": d["id"] } for d in r])
-        logging.info(f"\tRemoved {len(r)} sections from index")
-        # It can take a few seconds for search results to reflect changes, so wait a bit
-        time.sleep(2)
-
-def process_pdf(filename):
-    upload_blobs(filename)
-    page_map = get_document_text(filename)
-    sections = create_sections(os.path.basename(filename), page_map)
-    create_search_index(AZURE_SEARCH_INDEX)
-    index_sections(os.path.basename(filename), sections, AZURE_SEARCH_INDEX)
+    filter = None if filename == None else "sourcefile eq '{}'".format(os.path.basename(filename).replace("'", "''"))
+    # The manifest knows every section id that was indexed for the file, otherwise page through the index for them
+    manifest = manifest_store.load(os.path.basename(filename)) if filename != None else None
+    ids = list(manifest["sections"]) if manifest else list_section_ids(filter)
+    summary = remove_sections(ids)
+    if manifest:
+        # Sections the manifest doesn't know about (e.g. ones that failed to index but were partly written)
+        removed = set(ids)
+        leftovers = [id for id in list_section_ids(filter) if id not in removed]
+        if leftovers:
+            leftover_summary = remove_sections(leftovers)
+            summary["succeeded"] += leftover_summary["succeeded"]
+            summary["failed"].update(leftover_summary["failed"])
+    if summary["failed"]:
+        logging.error(f"\tFailed to remove {len(summary['failed'])} sections from index")
+    invalidate_index_caches()
+    # The sections are gone, so the next ingestion of the file has to start from scratch
+    if filename == None:
+        manifest_store.clear()
+    else:
+        manifest_store.delete(filename)
+    return {"removed": summary["succeeded"], "failed": summary["failed"]}
+
+def build_page_map(page_texts):
+    page_map = []
+    offset = 0
+    for page_num, page_text in enumerate(page_texts):
+        page_map.append((page_num, offset, page_text))
+        offset += len(page_text)
+    return page_map
+
+# Only pages whose content changed since the manifest was written are uploaded and analyzed, and only sections
+# whose content changed are sent to the index. Sections that no longer exist are removed from it.
+def process_pdf(filename, progress=no_progress):
+    sourcefile = os.path.basename(filename)
+    manifest = manifest_store.load(sourcefile) or {}
+    current_file_hash = file_hash(filename)
+    # Changing the chunking settings re-splits every file, the page text still comes from the manifest
+    chunking = [MAX_SECTION_LENGTH, SENTENCE_SEARCH_LIMIT, SECTION_OVERLAP]
+    if manifest.get("file_hash") == current_file_hash and manifest.get("chunking") == chunking:
+        logging.info(f"'{sourcefile}' is unchanged since it was last ingested, skipping")
+        ingestion_files.inc("unchanged")
+        return {"unchanged": True}
+
+    with span("hash_pages"), timed(ingestion_latency, "hash_pages"):
+        page_hashes = [page_hash(p) for p in PdfReader(filename).pages]
+    old_pages = manifest.get("pages", [])
+    changed_pages = [i for i, h in enumerate(page_hashes) if h is None or i >= len(old_pages) or old_pages[i]["hash"] != h]
+    logging.info(f"{len(changed_pages)} of {len(page_hashes)} pages of '{sourcefile}' changed since it was last ingested")
+
+    with span("upload_blobs", pages=len(changed_pages)), timed(ingestion_latency, "upload_blobs"):
+        blobs = upload_blobs(filename, progress=progress, pages=changed_pages)
+    removed_pages = [blob_name_from_file_page(filename, page_num) for page_num in range(len(page_hashes), len(old_pages))]
+    for blob_name, error in delete_blobs(blob_container, removed_pages).items():
+        logging.warning(f"\tError removing blob {blob_name} for a deleted page: {error}")
+
+    page_texts = [p["text"] for p in old_pages[:len(page_hashes)]]
+    page_texts += [""] * (len(page_hashes) - len(page_texts))
+    with span("analyze_document", pages=len(changed_pages)), timed(ingestion_latency, "analyze_document"):
+        for page_num, _, page_text in get_document_text(filename, progress=progress, pages=changed_pages):
+            page_texts[page_num] = page_text
+    ingestion_pages.inc(amount=len(changed_pages))
+    page_map = build_page_map(page_texts)
+
+    old_sections = manifest.get("sections", {})
+    sections = {}
+    changed_count = 0
+    def changed_sections():
+        nonlocal changed_count
+        for s in create_sections(sourcefile, page_map):
+            sections[s["id"]] = section_hash(s)
+            if old_sections.get(s["id"]) != sections[s["id"]]:
+                changed_count += 1
+                yield s
+
+    with span("index_sections") as s, timed(ingestion_latency, "index_sections"):
+        create_search_index(AZURE_SEARCH_INDEX)
+        indexing = index_sections(sourcefile, changed_sections(), AZURE_SEARCH_INDEX, progress=progress)
+        failed_sections = indexing["failed"]
+        stale_sections = [id for id in old_sections if id not in sections]
+        if stale_sections:
+            remove_sections(stale_sections)
+        s.set(sections_changed=changed_count, sections_removed=len(stale_sections))
+    ingestion_sections.inc("indexed", amount=changed_count - len(failed_sections))
+    ingestion_sections.inc("failed", amount=len(failed_sections))
+    ingestion_sections.inc("removed", amount=len(stale_sections))
+    if changed_count or stale_sections:
+        invalidate_index_caches()
+
+    # Anything that failed is left out of the manifest so that it is retried on the next ingestion
+    page_nums = {blob_name_from_file_page(filename, i): i for i in changed_pages}
+    for blob_name in blobs["failed"]:
+        page_hashes[page_nums[blob_name]] = None
+    for id in failed_sections:
+        sections.pop(id, None)
+    manifest_store.save(sourcefile, {
+        "file_hash": current_file_hash if not blobs["failed"] and not failed_sections else None,
+        "chunking": chunking,
+        "pages": [{"hash": h, "text": t} for h, t in zip(page_hashes, page_texts)],
+        "sections": sections})
+
+    ingestion_files.inc("processed")
+    return {"blobs": blobs, "pages_changed": len(changed_pages), "sections_changed": changed_count, "sections_failed": len(failed_sections), "sections_removed": len(stale_sections)}
@@ -0,0 +1,73 @@
+import mimetypes
+from io import BytesIO
+from typing import Optional
+
+from .cache import TTLCache, register_index_cache
+
+# Citation clicks fetch page blobs through /api/content. ContentCache keeps the properties of recently served blobs
+# and the contents of the small ones (the per page PDFs) in memory, bounded by bytes, so repeated clicks on the same
+# pages don't go to storage. Larger blobs are read in chunks of chunk_size as the response is sent, and only the
+# requested range of them is downloaded. Entries expire after ttl and are cleared when ingestion changes the index,
+# which is when page blobs are rewritten.
+
+class BlobRangeReader:
+    # Seekable file-like view of a blob that downloads what is read, so werkzeug can serve ranges of it
+    def __init__(self, blob_client, size: int):
+        self.blob_client = blob_client
+        self.size = size
+        self.position = 0
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        base = {0: 0, 1: self.position, 2: self.size}[whence]
+        self.position = min(max(base + offset, 0), self.size)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        length = self.size - self.position if size is None or size < 0 else min(size, self.size - self.position)
+        if length <= 0:
+            return b""
+        data = self.blob_client.download_blob(offset=self.position, length=length).readall()
+        self.position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+class ContentCache:
+    def __init__(self, container, max_bytes: int, max_blob_bytes: int, ttl: float, chunk_size: int):
+        self.container = container
+        self.max_blob_bytes = max_blob_bytes
+        self.chunk_size = chunk_size
+        self.entries = register_index_cache(TTLCache(max_bytes, ttl, getsizeof=lambda entry: len(entry["data"] or b"") + 1024))
+
+    def get(self, path: str) -> dict:
+        """Return the blob's properties, and its contents if it is small enough to keep in memory."""
+        entry = self.entries.get(path)
+        if entry is None:
+            blob_client = self.container.get_blob_client(path)
+            properties = blob_client.get_blob_properties()
+            data = None
+            if properties.size <= self.max_blob_bytes:
+                downloader = blob_client.download_blob()
+                data = downloader.readall()
+                # The blob may have been replaced since, describe what was downloaded
+                properties = downloader.properties
+            content_type = properties.content_settings.content_type
+            if not content_type or content_type == "application/octet-stream":
+                content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            entry = {"etag": properties.etag.strip('"'), "last_modified": properties.last_modified, "size": len(data) if data is not None else properties.size,
+                     "content_type": content_type, "data": data}
+            self.entries.set(path, entry)
+        return entry
+
+    def open(self, path: str, entry: Optional[dict] = None):
+        entry = entry or self.get(path)
+        if entry["data"] is not None:
+            return BytesIO(entry["data"])
+        return BlobRangeReader(self.container.get_blob_client(path), entry["size"])
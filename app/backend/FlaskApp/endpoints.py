@@ -0,0 +1,210 @@
+import logging
+import random
+import threading
+import time
+from typing import List, Optional
+
+import openai
+import requests
+
+# Routing of Azure OpenAI calls across several endpoints. Every endpoint keeps an exponentially weighted moving
+# average of its latency and error rate, the number of calls in flight and a cooldown set from Retry-After when it
+# throttles or fails. Calls go to the better of two randomly sampled endpoints that are not cooling down (power of
+# two choices) and fail over to another endpoint when the chosen one throttles, errors or can't be reached.
+
+# Status codes that say something about the endpoint rather than the request: throttling, server errors and an
+# endpoint whose key or deployment is wrong
+FAILOVER_STATUS_CODES = {401, 403, 404, 408, 429, 500, 502, 503, 504}
+CONNECTION_ERRORS = (openai.error.APIConnectionError, openai.error.Timeout, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+class Endpoint:
+    def __init__(self, name: str, base_url: str, key: str):
+        self.name = name
+        self.base_url = base_url
+        self.key = key
+        self.latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.cooldown_until = 0.0
+        self.last_error = None
+
+    def load(self) -> float:
+        # Expected cost of sending one more call here. Endpoints that haven't answered yet score 0 so they get tried.
+        return (self.latency or 0.0) * (self.in_flight + 1) / max(1.0 - self.error_rate, 0.1)
+
+    def metrics(self, now: float) -> dict:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "cooldown_seconds": round(max(self.cooldown_until - now, 0.0), 1),
+            "last_error": self.last_error}
+
+class EndpointPool:
+    def __init__(self, endpoints: List[Endpoint], max_attempts: int = 3, cooldown: float = 10.0, max_cooldown: float = 60.0, alpha: float = 0.2):
+        self.endpoints = endpoints
+        self.max_attempts = max_attempts
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.alpha = alpha
+        self.lock = threading.Lock()
+
+    def choose(self, exclude=()) -> Endpoint:
+        with self.lock:
+            candidates = [e for e in self.endpoints if e not in exclude] or self.endpoints
+            if not candidates:
+                raise ValueError("No Azure OpenAI endpoints are configured")
+            now = time.monotonic()
+            available = [e for e in candidates if e.cooldown_until <= now]
+            if available:
+                endpoint = min(random.sample(available, min(2, len(available))), key=Endpoint.load)
+            else:
+                # Everything is cooling down, use the endpoint that is due back first rather than failing outright
+                endpoint = min(candidates, key=lambda e: e.cooldown_until)
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, elapsed: Optional[float] = None, error: Optional[Exception] = None):
+        with self.lock:
+            endpoint.in_flight -= 1
+            if error is None:
+                endpoint.latency = elapsed if endpoint.latency is None else endpoint.latency + self.alpha * (elapsed - endpoint.latency)
+                endpoint.error_rate -= self.alpha * endpoint.error_rate
+                endpoint.consecutive_errors = 0
+                return
+            endpoint.errors += 1
+            endpoint.consecutive_errors += 1
+            endpoint.error_rate += self.alpha * (1.0 - endpoint.error_rate)
+            endpoint.last_error = f"{type(error).__name__}: {error}"[:200]
+            delay = retry_after(error)
+            if delay is None:
+                delay = min(self.cooldown * 2 ** (endpoint.consecutive_errors - 1), self.max_cooldown)
+            endpoint.cooldown_until = max(endpoint.cooldown_until, time.monotonic() + delay)
+
+    def call(self, fn, admit=None):
+        """Call fn(endpoint), failing over to other endpoints on throttling, endpoint and connection errors.
+
+        admit(endpoint) is called first and may wait, e.g. for rate limiting, without counting towards latency. If it
+        raises, the endpoint is skipped for this call without counting against its health.
+        """
+        tried = []
+        refused = []
+        while True:
+            endpoint = self.choose(exclude=tried + refused)
+            if admit is not None:
+                try:
+                    admit(endpoint)
+                except Exception as e:
+                    refused.append(endpoint)
+                    if self.refused(endpoint, e, tried + refused):
+                        continue
+                    raise
+            tried.append(endpoint)
+            start = time.perf_counter()
+            try:
+                result = fn(endpoint)
+            except Exception as e:
+                if self.failed(endpoint, e, time.perf_counter() - start, tried, refused):
+                    continue
+                raise
+            self.release(endpoint, time.perf_counter() - start)
+            return result
+
+    async def acall(self, fn, admit=None):
+        """Same as call, for a coroutine function fn and optionally admit."""
+        tried = []
+        refused = []
+        while True:
+            endpoint = self.choose(exclude=tried + refused)
+            if admit is not None:
+                try:
+                    await admit(endpoint)
+                except Exception as e:
+                    refused.append(endpoint)
+                    if self.refused(endpoint, e, tried + refused):
+                        continue
+                    raise
+            tried.append(endpoint)
+            start = time.perf_counter()
+            try:
+                result = await fn(endpoint)
+            except Exception as e:
+                if self.failed(endpoint, e, time.perf_counter() - start, tried, refused):
+                    continue
+                raise
+            self.release(endpoint, time.perf_counter() - start)
+            return result
+
+    def refused(self, endpoint: Endpoint, e: Exception, excluded: list) -> bool:
+        # Admission was refused before anything was sent, e.g. by the rate limiter, which says nothing about the
+        # endpoint itself. Returns whether another endpoint is left to try.
+        with self.lock:
+            endpoint.in_flight -= 1
+            endpoint.requests -= 1
+        if len(excluded) >= len(self.endpoints):
+            return False
+        logging.info(f"Azure OpenAI endpoint {endpoint.name} refused the call ({e}), trying another")
+        return True
+
+    def failed(self, endpoint: Endpoint, e: Exception, elapsed: float, tried: list, refused: list = ()) -> bool:
+        # Returns whether to fail over to another endpoint
+        if not should_fail_over(e):
+            self.release(endpoint, elapsed)
+            return False
+        self.release(endpoint, error=e)
+        if len(tried) >= (min(self.max_attempts, len(self.endpoints) - len(refused)) or 1):
+            return False
+        logging.warning(f"Azure OpenAI endpoint {endpoint.name} failed ({e}), failing over")
+        return True
+
+    def metrics(self) -> List[dict]:
+        now = time.monotonic()
+        with self.lock:
+            return [e.metrics(now) for e in self.endpoints]
+
+def status_code(e: Exception) -> Optional[int]:
+    status = getattr(e, "http_status", None)
+    if status is None and getattr(e, "response", None) is not None:
+        status = getattr(e.response, "status_code", None)
+    return status
+
+def should_fail_over(e: Exception) -> bool:
+    status = status_code(e)
+    if status is None:
+        return isinstance(e, CONNECTION_ERRORS)
+    return status in FAILOVER_STATUS_CODES
+
+def retry_after(e: Exception) -> Optional[float]:
+    headers = getattr(e, "headers", None) or getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def endpoints_from_env(environ, prefix: str = "AZURE_OPENAI_SERVICE") -> List[Endpoint]:
+    # PREFIX_1, PREFIX_1_KEY, PREFIX_2, ... up to the first number that isn't set at all. The service is either the
+    # resource name or a full base URL, e.g. to point at a local stub server.
+    endpoints = []
+    i = 1
+    while f"{prefix}_{i}" in environ or f"{prefix}_{i}_KEY" in environ:
+        service = environ.get(f"{prefix}_{i}") or ""
+        key = environ.get(f"{prefix}_{i}_KEY") or ""
+        if service and key:
+            base_url = service.rstrip("/") if "://" in service else f"https://{service}.openai.azure.com"
+            endpoints.append(Endpoint(service, base_url, key))
+        else:
+            logging.warning(f"Skipping Azure OpenAI endpoint {prefix}_{i}, its name or key is empty")
+        i += 1
+    return endpoints
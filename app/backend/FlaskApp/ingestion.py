@@ -0,0 +1,199 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Optional
+
+# Background ingestion of uploaded files. The upload route enqueues a job per file and returns straight away,
+# a pool of worker threads claims queued jobs and runs them, recording progress per stage so the status route
+# can report it. The queue backend is pluggable, SqliteJobQueue keeps the jobs in a local database file.
+
+STAGES = ["upload_blobs", "analyze", "index"]
+
+class JobQueue(ABC):
+    @abstractmethod
+    def enqueue(self, filename: str, source_name: str) -> str:
+        pass
+
+    @abstractmethod
+    def claim(self) -> Optional[dict]:
+        """Mark the oldest runnable job as running and return it, or None if there is nothing to do."""
+
+    @abstractmethod
+    def renew(self, job_id: str) -> None:
+        """Extend the lease of a running job, so that it isn't handed out again while it's still being worked on."""
+
+    @abstractmethod
+    def update(self, job_id: str, **fields) -> None:
+        pass
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[dict]:
+        pass
+
+class SqliteJobQueue(JobQueue):
+    # Jobs still marked running after this many seconds without an update (the worker renews the lease while it runs
+    # a job) are assumed to belong to a worker that died and are handed out again
+    lease_seconds = 600
+
+    def __init__(self, path: str):
+        self.path = path
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                source_name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                stages TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL)""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def enqueue(self, filename: str, source_name: str) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        stages = {s: {"status": "pending", "done": 0, "total": None} for s in STAGES}
+        with self.connect() as db:
+            db.execute("INSERT INTO jobs (id, filename, source_name, status, stages, created, updated) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                       (job_id, filename, source_name, json.dumps(stages), now, now))
+        return job_id
+
+    def claim(self) -> Optional[dict]:
+        now = time.time()
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT id FROM jobs WHERE status = 'queued' OR (status = 'running' AND updated < ?) ORDER BY created LIMIT 1",
+                                 (now - self.lease_seconds,)).fetchone()
+                if row is not None:
+                    db.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?", (now, row["id"]))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return self.get(row["id"]) if row is not None else None
+
+    def renew(self, job_id: str) -> None:
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET updated = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+    def update(self, job_id: str, **fields) -> None:
+        fields["updated"] = time.time()
+        for name in ("stages", "result"):
+            if name in fields:
+                fields[name] = json.dumps(fields[name])
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self.connect() as db:
+            db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["stages"] = json.loads(job["stages"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+class IngestionWorkers:
+    # Progress is written back to the queue at most this often, plus whenever a stage completes
+    progress_interval = 0.5
+    poll_interval = 2.0
+    # The lease of a running job is renewed this often, whether or not it reports progress: a single Form Recognizer
+    # analysis or index batch can take longer than the lease
+    heartbeat_interval = 30.0
+
+    def __init__(self, queue: JobQueue, process, num_workers: int):
+        self.queue = queue
+        self.process = process
+        self.num_workers = num_workers
+        self.wakeup = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.num_workers):
+                t = threading.Thread(target=self.work, name=f"ingestion-worker-{i}", daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def submit(self, filename: str, source_name: str) -> str:
+        job_id = self.queue.enqueue(filename, source_name)
+        self.start()
+        self.wakeup.set()
+        return job_id
+
+    def work(self):
+        while True:
+            try:
+                job = self.queue.claim()
+            except Exception:
+                logging.exception("Error claiming ingestion job")
+                job = None
+            if job is None:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+            self.run(job)
+
+    def heartbeat(self, job_id: str, stop: threading.Event):
+        while not stop.wait(self.heartbeat_interval):
+            try:
+                self.queue.renew(job_id)
+            except Exception:
+                logging.exception(f"Error renewing the lease of ingestion job {job_id}")
+
+    def run(self, job: dict):
+        job_id = job["id"]
+        stages = job["stages"]
+        last_update = 0.0
+        current_stage = STAGES[0]
+        logging.info(f"Ingestion job {job_id} started for '{job['source_name']}'")
+
+        def progress(stage, done, total):
+            nonlocal last_update, current_stage
+            current_stage = stage
+            for s in STAGES[:STAGES.index(stage)]:
+                stages[s]["status"] = "done"
+            stages[stage] = {"status": "done" if total is not None and done >= total else "running", "done": done, "total": total}
+            now = time.time()
+            if stages[stage]["status"] == "done" or now - last_update >= self.progress_interval:
+                last_update = now
+                self.queue.update(job_id, stage=stage, stages=stages)
+
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(job_id, stop_heartbeat), name=f"ingestion-heartbeat-{job_id[:8]}", daemon=True)
+        heartbeat.start()
+        try:
+            result = self.process(job["filename"], progress=progress)
+            for s in STAGES:
+                stages[s]["status"] = "done"
+            self.queue.update(job_id, status="succeeded", stages=stages, result=result)
+            logging.info(f"Ingestion job {job_id} succeeded")
+        except Exception as e:
+            logging.exception(f"Ingestion job {job_id} failed")
+            stages[current_stage]["status"] = "failed"
+            self.queue.update(job_id, status="failed", stages=stages, error=str(e))
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
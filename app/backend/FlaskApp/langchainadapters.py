@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Union
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish, LLMResult
 
@@ -105,4 +105,53 @@ class HtmlCallbackHandler(BaseCallbackHandler):
     ) -> None:
         """Run on agent end."""
         self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
-        # logging.info(finish.log)
\ No newline at end of file
+        # logging.info(finish.log)
+
+
+class PrefetchCallbackHandler(BaseCallbackHandler):
+    """Starts the searches an agent's thought names besides the one it picked, see AgentRunState.prefetch."""
+
+    def __init__(self, prefetch: Callable[[str, List[str]], None], candidates: Callable[[str, str], List[str]]):
+        self.prefetch = prefetch
+        self.candidates = candidates
+
+    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+        queries = self.candidates(action.log, action.tool_input)
+        if queries:
+            self.prefetch(action.tool, queries)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        pass
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        pass
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        pass
+
+    def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
+        pass
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any) -> None:
+        pass
+
+    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
+        pass
+
+    def on_chain_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
+        pass
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> None:
+        pass
+
+    def on_tool_end(self, output: str, **kwargs: Any) -> None:
+        pass
+
+    def on_tool_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
+        pass
+
+    def on_text(self, text: str, **kwargs: Any) -> None:
+        pass
+
+    def on_agent_finish(self, finish: AgentFinish, **kwargs: Any) -> None:
+        pass
@@ -0,0 +1,436 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import uuid
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from .cache import invalidate_index_caches
+
+# In-process retrieval engine that stands in for the Cognitive Search client, selected with SEARCH_BACKEND=local.
+# It implements the part of SearchClient the app uses: search with a text query, a filter of eq/ne comparisons on
+# category and sourcefile, top, select, total count and caption/answer-like highlights, plus upload_documents and
+# delete_documents for ingestion. Uploaded sections are kept in a SQLite database. A background rebuild compiles
+# them into a BM25 inverted index of numpy arrays that every worker process memory-maps from disk, so the OS keeps
+# a single copy in its page cache. Each rebuild writes a new generation directory and then swaps a pointer file,
+# searches pick up the new generation on their next call. Rebuilds hold a lock file, so only one process at a time
+# builds and swaps, and they keep the generation they replace for readers that still have it open.
+
+FILTERABLE_FIELDS = ["category", "sourcefile"]
+
+STOPWORDS = frozenset("a an and are as at be but by for from has have how i if in into is it its of on or that the their "
+                      "there these they this to was what when where which who why will with".split())
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in re.findall(r"\w+", text.lower()) if t not in STOPWORDS]
+
+def query_terms(text: str) -> List[str]:
+    terms = tokenize(text) or re.findall(r"\w+", text.lower())
+    return list(dict.fromkeys(terms))
+
+def term_hash(term: str) -> int:
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+def parse_filter(filter: Optional[str]) -> List[Tuple[str, str, str]]:
+    # "category ne 'x' and sourcefile eq 'y.pdf'" -> [("category", "ne", "x"), ("sourcefile", "eq", "y.pdf")]
+    if not filter:
+        return []
+    clauses = []
+    for clause in re.split(r"\s+and\s+", filter.strip()):
+        match = re.fullmatch(r"(\w+)\s+(eq|ne)\s+'((?:[^']|'')*)'", clause.strip())
+        if match is None or match.group(1) not in FILTERABLE_FIELDS:
+            raise ValueError(f"Unsupported filter for the local search engine: {filter}")
+        clauses.append((match.group(1), match.group(2), match.group(3).replace("''", "'")))
+    return clauses
+
+@contextmanager
+def file_lock(path: str):
+    # Exclusive lock across processes, released when the file is closed if the process dies holding it
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after about 10 seconds
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def generation_version(name: str) -> Optional[int]:
+    # index-<version>-<suffix>
+    match = re.fullmatch(r"index-(\d+)-\w+", name)
+    return int(match.group(1)) if match else None
+
+def build_index(documents: Iterable[Tuple[str, str]], path: str, version: int):
+    """Compile (id, document JSON) pairs into the index files in path."""
+    os.makedirs(path)
+    vocabulary = {}
+    term_ids, doc_ids, frequencies, lengths = array("i"), array("i"), array("i"), array("i")
+    field_values = {field: {} for field in FILTERABLE_FIELDS}
+    field_codes = {field: array("i") for field in FILTERABLE_FIELDS}
+    doc_offsets = array("q", [0])
+    with open(os.path.join(path, "documents.bin"), "wb") as blob:
+        for d, (_, text) in enumerate(documents):
+            document = json.loads(text)
+            data = text.encode("utf-8")
+            blob.write(data)
+            doc_offsets.append(doc_offsets[-1] + len(data))
+            counts = Counter(tokenize(document.get("content") or ""))
+            lengths.append(sum(counts.values()))
+            for term, frequency in counts.items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_ids.append(d)
+                frequencies.append(frequency)
+            for field in FILTERABLE_FIELDS:
+                values = field_values[field]
+                field_codes[field].append(values.setdefault(document.get(field), len(values)))
+
+    # Terms are numbered in the order of their hashes, so a query term is found with a binary search of the hashes
+    hashes = np.array([term_hash(t) for t in vocabulary], dtype=np.int64)
+    order = np.argsort(hashes)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    term_ids = rank[np.frombuffer(term_ids, dtype=np.int32)] if len(term_ids) else np.zeros(0, dtype=np.int64)
+    doc_ids = np.frombuffer(doc_ids, dtype=np.int32)
+    frequencies = np.frombuffer(frequencies, dtype=np.int32).astype(np.float32)
+    lengths = np.frombuffer(lengths, dtype=np.int32).astype(np.float32)
+
+    # Every posting stores its term's whole BM25 contribution, a query only adds them up. A term's postings are
+    # ordered by that contribution, highest first.
+    count = len(lengths)
+    document_frequencies = np.bincount(term_ids, minlength=len(vocabulary))
+    idf = np.log(1 + (count - document_frequencies + 0.5) / (document_frequencies + 0.5))
+    average_length = float(lengths.mean()) if count else 1.0
+    norms = K1 * (1 - B + B * lengths[doc_ids] / (average_length or 1.0))
+    impacts = (idf[term_ids] * frequencies * (K1 + 1) / (frequencies + norms)).astype(np.float32)
+    by_term = np.lexsort((-impacts, term_ids))
+
+    np.save(os.path.join(path, "terms.npy"), hashes[order])
+    np.save(os.path.join(path, "offsets.npy"), np.concatenate([[0], np.cumsum(document_frequencies)]).astype(np.int64))
+    np.save(os.path.join(path, "postings.npy"), doc_ids[by_term])
+    np.save(os.path.join(path, "impacts.npy"), impacts[by_term])
+    np.save(os.path.join(path, "documents.npy"), np.frombuffer(doc_offsets, dtype=np.int64))
+    for field in FILTERABLE_FIELDS:
+        np.save(os.path.join(path, f"{field}.npy"), np.frombuffer(field_codes[field], dtype=np.int32))
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": version, "count": count, "fields": {field: list(values) for field, values in field_values.items()}}, f)
+
+class LocalIndex:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.version = meta["version"]
+        self.count = meta["count"]
+        self.field_values = {field: {value: code for code, value in enumerate(values)} for field, values in meta["fields"].items()}
+        load = lambda name: np.asarray(np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+        self.terms = load("terms")
+        self.offsets = load("offsets")
+        self.postings = load("postings")
+        self.impacts = load("impacts")
+        self.doc_offsets = load("documents")
+        self.field_codes = {field: load(field) for field in FILTERABLE_FIELDS}
+        self.local = threading.local()
+        self.documents = np.memmap(os.path.join(path, "documents.bin"), dtype=np.uint8, mode="r") if self.doc_offsets[-1] else b""
+
+    def score(self, terms: List[str], max_postings: int) -> Tuple[np.ndarray, np.ndarray, int]:
+        """Score the documents that contain any of the terms with BM25.
+
+        Returns the ids of the matching documents, which repeat for documents that match several terms, their
+        scores and the number of terms that matched. Only the max_postings highest scoring postings of each term are
+        read. Rare terms are read in full, for very common terms, whose contribution to the score is small anyway,
+        the long tail is skipped.
+        """
+        # Scores are added up in a per thread array over all documents, which is reset after use rather than
+        # allocated for every query
+        scores = getattr(self.local, "scores", None)
+        if scores is None:
+            scores = self.local.scores = np.zeros(self.count, dtype=np.float32)
+        ids = []
+        for term in terms:
+            h = term_hash(term)
+            i = int(np.searchsorted(self.terms, h))
+            if i == len(self.terms) or self.terms[i] != h:
+                continue
+            start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+            end = min(end, start + max_postings)
+            # A term's postings hold each document once, so the fancy indexed add is safe
+            scores[self.postings[start:end]] += self.impacts[start:end]
+            ids.append(self.postings[start:end])
+        if not ids:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32), 0
+        copies = len(ids)
+        ids = np.concatenate(ids) if copies > 1 else ids[0]
+        matched = scores[ids]
+        scores[ids] = 0
+        return ids, matched, copies
+
+    def matches(self, ids: np.ndarray, clauses: List[Tuple[str, str, str]]) -> np.ndarray:
+        keep = np.ones(len(ids), dtype=bool)
+        for field, op, value in clauses:
+            code = self.field_values[field].get(value, -1)
+            codes = self.field_codes[field][ids]
+            keep &= (codes == code) if op == "eq" else (codes != code)
+        return keep
+
+    def document(self, i: int) -> dict:
+        return json.loads(bytes(self.documents[self.doc_offsets[i]:self.doc_offsets[i + 1]]))
+
+class LocalCaption:
+    def __init__(self, text: str, highlights: Optional[str] = None):
+        self.text = text
+        self.highlights = highlights
+
+class LocalAnswer:
+    def __init__(self, key: str, text: str, highlights: Optional[str], score: float):
+        self.key = key
+        self.text = text
+        self.highlights = highlights
+        self.score = score
+
+class LocalIndexingResult:
+    def __init__(self, key: str):
+        self.key = key
+        self.succeeded = True
+        self.status_code = 200
+        self.error_message = None
+
+class LocalSearchResults:
+    def __init__(self, documents: List[dict], count: int, answers: Optional[List[LocalAnswer]]):
+        self.documents = documents
+        self.count = count
+        self.answers = answers
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for document in self.documents:
+            yield document
+
+    def get_count(self) -> int:
+        return self.count
+
+    def get_answers(self) -> Optional[List[LocalAnswer]]:
+        return self.answers
+
+def best_caption(content: str, terms: List[str], highlight: bool) -> Tuple[Optional[LocalCaption], int]:
+    # The sentence that contains the most distinct query terms, and how many it contains
+    best, best_hits = None, 0
+    for sentence in re.split(r"(?<=[.!?])\s+", content):
+        words = set(re.findall(r"\w+", sentence.lower()))
+        hits = sum(1 for t in terms if t in words)
+        if hits > best_hits:
+            best, best_hits = sentence.strip(), hits
+    if best is None:
+        return None, 0
+    highlights = re.sub(r"\b(" + "|".join(map(re.escape, terms)) + r")\b", r"<em>\1</em>", best, flags=re.IGNORECASE) if highlight else None
+    return LocalCaption(best, highlights), best_hits
+
+class LocalSearchClient:
+    # Uploads are compiled into the index this many seconds after the last one, rather than once per batch
+    rebuild_delay = 1.0
+    # Postings read per query term, which bounds the latency of queries with very common terms. Total counts are a
+    # lower bound for such queries.
+    max_postings = 10000
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.db_path = os.path.join(path, "sections.db")
+        self.current_path = os.path.join(path, "current")
+        self.lock_path = os.path.join(path, "build.lock")
+        self.index = None
+        self.index_stat = None
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.timer = None
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS sections (id TEXT PRIMARY KEY, document TEXT NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+            version = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+        index = self.get_index()
+        if version and (index is None or index.version < version):
+            self.schedule_rebuild()
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def get_index(self) -> Optional[LocalIndex]:
+        # Reopen the index when another rebuild, possibly in another process, swapped in a new generation
+        try:
+            stat = os.stat(self.current_path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if (stat.st_ino, stat.st_mtime_ns) != self.index_stat:
+                with open(self.current_path, "r", encoding="utf-8") as f:
+                    self.index = LocalIndex(os.path.join(self.path, f.read().strip()))
+                self.index_stat = (stat.st_ino, stat.st_mtime_ns)
+            return self.index
+
+    def search(self, search_text: str, filter: Optional[str] = None, top: Optional[int] = None, select: Optional[List[str]] = None,
+               include_total_count: bool = False, query_caption: Optional[str] = None, query_answer: Optional[str] = None, **kwargs) -> LocalSearchResults:
+        # Semantic ranking options (query_type, query_language, query_speller, ...) are accepted and ignored
+        clauses = parse_filter(filter)
+        index = self.get_index()
+        if index is None or index.count == 0:
+            return LocalSearchResults([], 0, None)
+        terms = query_terms(search_text or "")
+        if terms:
+            ids, scores, copies = index.score(terms, self.max_postings)
+        elif (search_text or "").strip() in ("", "*"):
+            ids, scores, copies = np.arange(index.count), np.ones(index.count, dtype=np.float32), 1
+        else:
+            return LocalSearchResults([], 0, None)
+        if clauses and len(ids):
+            keep = index.matches(ids, clauses)
+            ids, scores = ids[keep], scores[keep]
+        count = len(ids) if copies <= 1 or not include_total_count else len(np.unique(ids))
+
+        # A document is in ids at most once per term, so the best top * copies entries hold the best top documents
+        if top is not None and len(ids) > top * copies:
+            best = np.argpartition(-scores, top * copies)[:top * copies]
+            ids, scores = ids[best], scores[best]
+        if copies > 1:
+            ids, first = np.unique(ids, return_index=True)
+            scores = scores[first]
+        order = np.argsort(-scores, kind="stable")[:top]
+
+        highlight = bool(query_caption) and not query_caption.endswith("highlight-false")
+        documents = []
+        answers = [] if query_answer else None
+        for i in order:
+            stored = index.document(int(ids[i]))
+            document = {field: stored.get(field) for field in select} if select else stored
+            document["@search.score"] = float(scores[i])
+            if query_caption or query_answer:
+                caption, hits = best_caption(stored.get("content") or "", terms, highlight)
+                if query_caption:
+                    document["@search.captions"] = [caption] if caption else []
+                # Like extractive answers, only offer a passage that has every query term
+                if answers is not None and caption and hits == len(terms) and not answers:
+                    answers.append(LocalAnswer(document.get("id"), caption.text, caption.highlights, float(scores[i])))
+            documents.append(document)
+        return LocalSearchResults(documents, count, answers)
+
+    def upload_documents(self, documents: List[dict]) -> List[LocalIndexingResult]:
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("INSERT OR REPLACE INTO sections (id, document) VALUES (?, ?)", [(d["id"], json.dumps(d)) for d in documents])
+            db.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            db.execute("COMMIT")
+        self.schedule_rebuild()
+        return [LocalIndexingResult(d["id"]) for d in documents]
+
+    def delete_documents(self, documents: List[dict]) -> List[LocalIndexingResult]:
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("DELETE FROM sections WHERE id = ?", [(d["id"],) for d in documents])
+            db.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            db.execute("COMMIT")
+        self.schedule_rebuild()
+        return [LocalIndexingResult(d["id"]) for d in documents]
+
+    def schedule_rebuild(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.rebuild_delay, self.rebuild)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def rebuild(self) -> Optional[LocalIndex]:
+        """Compile the sections into a new index generation unless the current one is up to date, and return it."""
+        try:
+            with self.build_lock, file_lock(self.lock_path):
+                return self.build()
+        except Exception as e:
+            logging.exception(f"Unable to rebuild the local search index: {e}")
+            return None
+
+    def build(self) -> Optional[LocalIndex]:
+        with self.connect() as db:
+            # One read transaction, so the version matches the sections that are read
+            db.execute("BEGIN")
+            version = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            index = self.get_index()
+            if index is not None and index.version >= version:
+                db.execute("COMMIT")
+                return index
+            name = f"index-{version}-{uuid.uuid4().hex[:8]}"
+            build_index(db.execute("SELECT id, document FROM sections ORDER BY id"), os.path.join(self.path, name), version)
+            db.execute("COMMIT")
+
+        # Another process may have built a newer generation before this one took the lock
+        index = self.get_index()
+        if index is not None and index.version >= version:
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+            return index
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=self.path, prefix="current-", suffix=".tmp", delete=False) as f:
+            f.write(name)
+        os.replace(f.name, self.current_path)
+        # Searches may still be reading the generation that was just replaced, so only the ones before it go
+        previous = index.version if index is not None else version
+        for entry in os.listdir(self.path):
+            entry_version = generation_version(entry)
+            if entry_version is not None and entry_version < previous:
+                shutil.rmtree(os.path.join(self.path, entry), ignore_errors=True)
+        logging.info(f"Built local search index {name}")
+        invalidate_index_caches()
+        return self.get_index()
+
+    def close(self):
+        pass
+
+class AsyncLocalSearchClient:
+    # The awaitable face of LocalSearchClient for the async approaches, a search takes a few milliseconds at most
+    def __init__(self, client: LocalSearchClient):
+        self.client = client
+
+    async def search(self, *args, **kwargs) -> LocalSearchResults:
+        return self.client.search(*args, **kwargs)
+
+    async def close(self):
+        pass
@@ -1,5 +1,8 @@
 from os import path
+import bisect
 import csv
+import os
+import threading
 from langchain.agents import Tool, tool
 from typing import Optional
 import pandas as pd
@@ -19,6 +22,94 @@ class CsvLookupTool(Tool):
     def lookup(self, key: str) -> Optional[str]:
         return self.data.get(key, "")
 
+# Employee details for the agents' lookup tool. The CSV is loaded once into a DataFrame with a hash index on the
+# lowercased key column and reloaded only when the file's modification time changes. Names that don't match exactly
+# fall back to a unique prefix or a unique match on all of their words. Rendered results are memoized, the format is
+# the same as DataFrame.to_string(index=False) on the matching rows, "Empty DataFrame ..." when nothing matches.
+class EmployeeTable:
+    max_rendered = 4096
+
+    def __init__(self, df: pd.DataFrame, key_field: str):
+        self.df = df
+        self.index = {}
+        # Rows without a key can't be looked up, astype(str) would otherwise index them as "nan"
+        has_key = df[key_field].notna().tolist()
+        for position, key in enumerate(df[key_field].astype(str).str.lower().tolist()):
+            if has_key[position]:
+                self.index.setdefault(key, []).append(position)
+        self.sorted_keys = sorted(self.index)
+        self.words = None
+        self.empty = df.iloc[0:0].to_string(index=False)
+        self.rendered = {}
+
+    def get_words(self) -> dict:
+        # Only needed for names that don't match exactly, so built on first use
+        if self.words is None:
+            words = {}
+            for key in self.sorted_keys:
+                for word in key.split():
+                    words.setdefault(word, set()).add(key)
+            self.words = words
+        return self.words
+
+    def find_key(self, query: str) -> Optional[str]:
+        if query in self.index:
+            return query
+        # A unique key starting with the query, e.g. "employ" for a single "employee1"
+        i = bisect.bisect_left(self.sorted_keys, query)
+        if i < len(self.sorted_keys) and self.sorted_keys[i].startswith(query) and \
+                (i + 1 == len(self.sorted_keys) or not self.sorted_keys[i + 1].startswith(query)):
+            return self.sorted_keys[i]
+        # A unique key containing all words of the query, e.g. "smith john" for "john smith"
+        query_words = query.split()
+        words = self.get_words()
+        if query_words and all(w in words for w in query_words):
+            keys = set.intersection(*(words[w] for w in query_words))
+            if len(keys) == 1:
+                return keys.pop()
+        return None
+
+    def lookup(self, query: str) -> str:
+        key = self.find_key(" ".join(query.lower().split()))
+        if key is None:
+            return self.empty
+        response = self.rendered.get(key)
+        if response is None:
+            response = self.df.iloc[self.index[key]].to_string(index=False)
+            if len(self.rendered) >= self.max_rendered:
+                self.rendered.clear()
+            self.rendered[key] = response
+        return response
+
+class EmployeeDirectory:
+    def __init__(self, filename: str, key_field: str = "name"):
+        self.filename = filename
+        self.key_field = key_field
+        self.mtime = None
+        self.table = None
+        self.lock = threading.Lock()
+
+    def get_table(self) -> EmployeeTable:
+        mtime = os.stat(self.filename).st_mtime_ns
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    self.table = EmployeeTable(pd.read_csv(self.filename), self.key_field)
+                    self.mtime = mtime
+                    logging.info(f"Loaded {len(self.table.df)} rows from {self.filename}")
+        return self.table
+
+    def lookup(self, query: str) -> str:
+        return self.get_table().lookup(query)
+
+employee_directories = {}
+
+def get_employee_directory(filename: str) -> EmployeeDirectory:
+    directory = employee_directories.get(filename)
+    if directory is None:
+        directory = employee_directories.setdefault(filename, EmployeeDirectory(filename))
+    return directory
+
 @tool
 def pandas_lookup(query: str,filename:str = 'FlaskApp/data/employeeinfo.csv') -> Optional[str]:
     """
@@ -32,15 +123,7 @@ def pandas_lookup(query: str,filename:str = 'FlaskApp/data/employeeinfo.csv') ->
         str: A string representation of the rows in the dataframe that match the query.
              Returns "No results found." if no matches are found.
     """
-    df = pd.read_csv(filename)
-    try:
-        result = df.loc[df['name'].str.lower() == query.lower()]
-        response = result.to_string(index=False)
-    except IndexError:
-        response= f"{query} is not in pandas dataframe"
-    # logging.info("-----------------------")
-    # logging.info("response from pandas_lookup: " + response)
-    return response
+    return get_employee_directory(filename).lookup(query)
 
 @tool
 def web_search(query: str) -> Optional[str]:
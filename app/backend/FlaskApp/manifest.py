@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+from typing import Optional
+
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+# The ingestion manifest records what was last ingested for each source file: a hash of the whole file, a hash and
+# the extracted text of every page, and a hash of every section sent to the index. Re-ingesting a file compares
+# against it so that only changed pages are uploaded and analyzed and only changed sections are indexed.
+
+class ManifestStore:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def manifest_path(self, filename: str) -> str:
+        return os.path.join(self.path, re.sub("[^0-9a-zA-Z_.-]", "_", os.path.basename(filename)) + ".json")
+
+    def load(self, filename: str) -> Optional[dict]:
+        try:
+            with open(self.manifest_path(filename), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logging.warning(f"Ignoring unreadable manifest for '{filename}': {e}")
+            return None
+
+    def save(self, filename: str, manifest: dict):
+        path = self.manifest_path(filename)
+        # A temporary file of its own, so that concurrent saves of the same manifest don't clobber each other
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=self.path, suffix=".tmp", delete=False) as f:
+            try:
+                json.dump(manifest, f)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        os.replace(f.name, path)
+
+    def delete(self, filename: str):
+        try:
+            os.remove(self.manifest_path(filename))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith(".json"):
+                os.remove(os.path.join(self.path, name))
+
+def file_hash(filename: str) -> str:
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def page_hash(page) -> Optional[str]:
+    # Hash what is drawn on the page: its content stream, everything its /Resources reference (fonts, images, forms
+    # and their own resources, followed through indirect objects) and its size
+    try:
+        h = hashlib.sha256()
+        contents = page.get_contents()
+        if contents is not None:
+            h.update(contents.get_data())
+        hash_object(h, page.get("/Resources"), set())
+        h.update(repr(list(page.mediabox)).encode())
+        return h.hexdigest()
+    except Exception as e:
+        # A page that can't be hashed is treated as changed every time
+        logging.warning(f"Unable to hash page: {e}")
+        return None
+
+def hash_object(h, obj, seen: set):
+    # Feeds a canonical form of a PDF object to h. Indirect objects are resolved, each once, later references to
+    # one (e.g. a font's /Parent) only add its object number so that cycles end.
+    if isinstance(obj, IndirectObject):
+        h.update(f"R{obj.idnum}.{obj.generation}".encode())
+        if (obj.idnum, obj.generation) in seen:
+            return
+        seen.add((obj.idnum, obj.generation))
+        obj = obj.get_object()
+    if isinstance(obj, StreamObject):
+        h.update(b"stream")
+        h.update(obj.get_data())
+    if isinstance(obj, DictionaryObject):
+        h.update(b"<<")
+        for key in sorted(obj):
+            h.update(key.encode())
+            hash_object(h, obj.raw_get(key), seen)
+        h.update(b">>")
+    elif isinstance(obj, ArrayObject):
+        h.update(b"[")
+        for item in obj:
+            hash_object(h, item, seen)
+        h.update(b"]")
+    else:
+        h.update(repr(obj).encode())
+
+def section_hash(section: dict) -> str:
+    return hashlib.sha256(json.dumps(section, sort_keys=True).encode("utf-8")).hexdigest()
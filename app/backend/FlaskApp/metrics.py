@@ -0,0 +1,178 @@
+import bisect
+import math
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# In-process metrics for capacity planning, served in the Prometheus text format by /api/metrics. Counters and
+# histograms are recorded without locks: every thread updates its own shard of a metric and a scrape adds the shards
+# up. When a thread exits its shard is folded into the metric's base totals, so threads that come and go (e.g. the
+# per-job ingestion heartbeats) don't leave shards behind. Statistics the app already keeps elsewhere (caches, OpenAI
+# endpoints, the rate limiter) are read when scraped by collectors rather than being recorded twice.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.local = threading.local()
+        self.shards = []
+        # Totals of the shards of threads that have exited
+        self.base = {}
+        self.lock = threading.Lock()
+
+    def shard(self) -> dict:
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+            # The thread's local storage, and so the holder, is released when the thread exits
+            self.local.holder = ShardHolder()
+            weakref.finalize(self.local.holder, self.retire, values)
+            with self.lock:
+                self.shards.append(values)
+            return values
+
+    def retire(self, values: dict):
+        with self.lock:
+            self.shards = [shard for shard in self.shards if shard is not values]
+            add(self.base, values)
+
+    def collect(self) -> Dict[tuple, list]:
+        # Shards are only written by their own thread, copying one is atomic under the GIL
+        with self.lock:
+            shards = list(self.shards)
+            merged = {key: list(value) for key, value in self.base.items()}
+        for shard in shards:
+            add(merged, dict(shard))
+        return merged
+
+class ShardHolder:
+    __slots__ = ("__weakref__",)
+
+def add(totals: Dict[tuple, list], values: Dict[tuple, list]):
+    for key, value in values.items():
+        total = totals.get(key)
+        totals[key] = list(value) if total is None else [a + b for a, b in zip(total, value)]
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1.0):
+        shard = self.shard()
+        value = shard.get(labels)
+        if value is None:
+            shard[labels] = [amount]
+        else:
+            value[0] += amount
+
+    def samples(self):
+        for labels, (value,) in sorted(self.collect().items()):
+            yield self.name, dict(zip(self.labels, labels)), value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        shard = self.shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # A count per bucket, then the overflow bucket, then the sum of the observed values
+            counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for labels, counts in sorted(self.collect().items()):
+            labels = dict(zip(self.labels, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield self.name + "_bucket", {**labels, "le": format_value(bound)}, cumulative
+            yield self.name + "_sum", labels, counts[-1]
+            yield self.name + "_count", labels, cumulative
+
+# A collector returns (name, type, help, samples) for each metric it reports, samples being (labels, value) pairs
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Tuple[dict, float]]]]]
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Collector] = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DURATION_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Collector):
+        self.collectors.append(collector)
+        return collector
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.type}"]
+            lines += [format_sample(name, labels, value) for name, labels, value in metric.samples()]
+        for collector in self.collectors:
+            for name, type, help, samples in collector():
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+                lines += [format_sample(name, labels, value) for labels, value in samples]
+        return "\n".join(lines) + "\n"
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value is None or isinstance(value, float) and math.isnan(value):
+        return "NaN"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_sample(name: str, labels: dict, value: float) -> str:
+    if not labels:
+        return f"{name} {format_value(value)}"
+    pairs = ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+    return f"{name}{{{pairs}}} {format_value(value)}"
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+@contextmanager
+def timed(histogram: Histogram, *labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, *labels)
+
+registry = Registry()
+
+http_requests = registry.counter("http_requests_total", "HTTP requests by route, approach and status code", ["route", "approach", "status"])
+http_latency = registry.histogram("http_request_duration_seconds", "Time until the response starts, by route and approach", ["route", "approach"])
+search_latency = registry.histogram("search_duration_seconds", "Search calls made by the approaches, including reading the results", ["approach"])
+openai_latency = registry.histogram("openai_request_duration_seconds", "Successful Azure OpenAI calls by deployment and endpoint", ["deployment", "endpoint"])
+openai_tokens = registry.counter("openai_tokens_total", "Azure OpenAI tokens used by deployment, endpoint and type (prompt or completion)", ["deployment", "endpoint", "type"])
+ingestion_files = registry.counter("ingestion_files_total", "Ingested files by result (processed or unchanged)", ["result"])
+ingestion_pages = registry.counter("ingestion_pages_total", "Pages of ingested files that changed and were analyzed")
+ingestion_sections = registry.counter("ingestion_sections_total", "Index sections by operation (indexed, failed or removed)", ["operation"])
+ingestion_latency = registry.histogram("ingestion_stage_duration_seconds", "Ingestion stages by name", ["stage"])
+
+def observe_openai(deployment: str, endpoint: str, seconds: float, usage):
+    openai_latency.observe(seconds, deployment, endpoint)
+    if usage:
+        openai_tokens.inc(deployment, endpoint, "prompt", amount=usage.get("prompt_tokens") or 0)
+        openai_tokens.inc(deployment, endpoint, "completion", amount=usage.get("completion_tokens") or 0)
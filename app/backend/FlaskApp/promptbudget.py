@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from typing import List, Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Token counting and prompt budgeting. Counts use the model's tokenizer (tiktoken), loaded once per model, and fall
+# back to about four characters per token when it isn't available. tiktoken downloads the tokenizer on first use (set
+# TIKTOKEN_CACHE_DIR to a directory that ships with the app to avoid that), so the app loads its models' tokenizers
+# when it starts and a failed load is retried with exponential backoff rather than given up on. PromptBudget splits what the model's context
+# leaves after the completion between the fixed part of a prompt, the chat history and the sources, keeping the most
+# relevant sources and most recent turns that fit.
+
+DEFAULT_ENCODING = "cl100k_base"
+ENCODING_RETRY_SECONDS = 30
+ENCODING_MAX_RETRY_SECONDS = 3600
+
+encodings = {}
+# Model -> (failed attempts, time of the next attempt)
+encoding_failures = {}
+encodings_lock = threading.Lock()
+
+def load_encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Azure deployment names are often not model names
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+def get_encoding(model: str):
+    encoding = encodings.get(model)
+    if encoding is not None or tiktoken is None:
+        return encoding
+    with encodings_lock:
+        if model in encodings:
+            return encodings[model]
+        attempts, retry_at = encoding_failures.get(model, (0, 0.0))
+        now = time.monotonic()
+        if now < retry_at:
+            return None
+        # Other threads approximate while this one loads, rather than all waiting on the download
+        delay = min(ENCODING_RETRY_SECONDS * 2 ** attempts, ENCODING_MAX_RETRY_SECONDS)
+        encoding_failures[model] = (attempts, now + delay)
+    try:
+        encoding = load_encoding(model)
+    except Exception as e:
+        logging.warning(f"Unable to load the tokenizer for {model}, approximating token counts for {delay:.0f} seconds: {e}")
+        with encodings_lock:
+            encoding_failures[model] = (attempts + 1, time.monotonic() + delay)
+        return None
+    with encodings_lock:
+        encodings[model] = encoding
+        encoding_failures.pop(model, None)
+    return encoding
+
+def load_encodings(models: List[str]):
+    """Load the tokenizers of the given models in the background."""
+    threading.Thread(target=lambda: [get_encoding(model) for model in models], name="load-encodings", daemon=True).start()
+
+def count_tokens(text: str, model: str) -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text: str, max_tokens: int, model: str) -> str:
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+class PromptBudget:
+    # A partly fitting item is cut short rather than dropped if at least this many of its tokens fit
+    min_truncated_tokens = 32
+
+    def __init__(self, model: str, context_tokens: int, completion_tokens: int):
+        self.model = model
+        self.remaining = context_tokens - completion_tokens
+        self.used = {}
+
+    def count(self, text: str) -> int:
+        return count_tokens(text, self.model)
+
+    def spend(self, part: str, tokens: int):
+        self.remaining -= tokens
+        self.used[part] = self.used.get(part, 0) + tokens
+
+    def reserve(self, part: str, text: str) -> int:
+        """Account for text that is always in the prompt, even if it doesn't fit."""
+        tokens = self.count(text)
+        self.spend(part, tokens)
+        return tokens
+
+    def fit(self, part: str, items: List[str], max_tokens: Optional[int] = None, truncate: bool = True, separator_tokens: int = 1) -> List[str]:
+        """Return the leading items that fit in the budget (and max_tokens), so pass the most important first."""
+        budget = self.remaining if max_tokens is None else min(max_tokens, self.remaining)
+        kept = []
+        used = 0
+        for item in items:
+            tokens = self.count(item) + separator_tokens
+            if used + tokens <= budget:
+                kept.append(item)
+                used += tokens
+                continue
+            room = budget - used - separator_tokens
+            if truncate and room >= self.min_truncated_tokens:
+                kept.append(truncate_tokens(item, room, self.model))
+                used += room + separator_tokens
+            break
+        self.spend(part, used)
+        return kept
+
+    def report(self) -> dict:
+        return {**self.used, "total": sum(self.used.values())}
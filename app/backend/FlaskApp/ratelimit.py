@@ -0,0 +1,128 @@
+import asyncio
+import math
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Client side rate limiting of Azure OpenAI calls. Every endpoint/deployment pair gets a token bucket sized from its
+# tokens-per-minute quota and a request bucket sized from its requests-per-minute quota. Like the service, a call is
+# charged its prompt tokens plus max_tokens up front. A call that doesn't fit reserves its share and waits for it,
+# unless too many calls are already waiting for that pair or the wait would be longer than max_wait, in which case
+# it is rejected straight away with RateLimitExceeded so the route can answer 429 instead of queueing forever.
+
+class RateLimitExceeded(Exception):
+    # Raised by admission to an endpoint, the endpoint pool then tries another one. Answered with a 429 when none is left.
+    http_status = 429
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.headers = {"retry-after": str(self.retry_after)}
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        # Quotas are enforced over short windows too, so allow bursts of at most 10 seconds' worth
+        self.capacity = max(per_minute / 6, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self.refill(now)
+        return max(min(amount, self.capacity) - self.tokens, 0) / self.rate
+
+    def take(self, amount: float):
+        # May go negative, later callers then wait for the tokens reserved here to be refilled
+        self.tokens -= min(amount, self.capacity)
+
+class RateLimiter:
+    def __init__(self, tpm: int, rpm: int, deployment_limits: Optional[Dict[str, dict]] = None, max_queue: int = 32, max_wait: float = 10.0):
+        self.tpm = tpm
+        self.rpm = rpm
+        self.deployment_limits = deployment_limits or {}
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.buckets = {}
+        self.waiting = {}
+        self.lock = threading.Lock()
+        self.counters = {"admitted": 0, "delayed": 0, "rejected": 0, "wait_seconds": 0.0}
+
+    def limits(self, deployment: str) -> Tuple[int, int]:
+        limits = self.deployment_limits.get(deployment) or {}
+        return int(limits.get("tpm", self.tpm) or 0), int(limits.get("rpm", self.rpm) or 0)
+
+    def get_buckets(self, key: Tuple[str, str]):
+        buckets = self.buckets.get(key)
+        if buckets is None:
+            tpm, rpm = self.limits(key[1])
+            buckets = self.buckets[key] = (TokenBucket(tpm) if tpm else None, TokenBucket(rpm) if rpm else None)
+        return buckets
+
+    def reserve(self, endpoint: str, deployment: str, tokens: int) -> float:
+        """Take tokens for a call and return how long it has to wait for them, registering it as waiting if at all."""
+        key = (endpoint, deployment)
+        with self.lock:
+            token_bucket, request_bucket = self.get_buckets(key)
+            if token_bucket is None and request_bucket is None:
+                return 0.0
+            now = time.monotonic()
+            wait = max(token_bucket.wait_time(tokens, now) if token_bucket else 0.0,
+                       request_bucket.wait_time(1, now) if request_bucket else 0.0)
+            if wait > 0 and (self.waiting.get(key, 0) >= self.max_queue or wait > self.max_wait):
+                self.counters["rejected"] += 1
+                raise RateLimitExceeded(f"Rate limit for deployment {deployment} on {endpoint} exceeded, retry in {wait:.1f}s", wait)
+            if token_bucket:
+                token_bucket.take(tokens)
+            if request_bucket:
+                request_bucket.take(1)
+            self.counters["admitted"] += 1
+            if wait > 0:
+                self.counters["delayed"] += 1
+                self.counters["wait_seconds"] += wait
+                self.waiting[key] = self.waiting.get(key, 0) + 1
+            return wait
+
+    def done_waiting(self, endpoint: str, deployment: str):
+        with self.lock:
+            self.waiting[(endpoint, deployment)] -= 1
+
+    def acquire(self, endpoint: str, deployment: str, tokens: int):
+        wait = self.reserve(endpoint, deployment, tokens)
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self.done_waiting(endpoint, deployment)
+
+    async def acquire_async(self, endpoint: str, deployment: str, tokens: int):
+        wait = self.reserve(endpoint, deployment, tokens)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.done_waiting(endpoint, deployment)
+
+    def metrics(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            buckets = []
+            for (endpoint, deployment), (token_bucket, request_bucket) in self.buckets.items():
+                for bucket in (token_bucket, request_bucket):
+                    if bucket:
+                        bucket.refill(now)
+                buckets.append({
+                    "endpoint": endpoint,
+                    "deployment": deployment,
+                    "tokens_available": round(token_bucket.tokens) if token_bucket else None,
+                    "requests_available": round(request_bucket.tokens, 1) if request_bucket else None,
+                    "waiting": self.waiting.get((endpoint, deployment), 0)})
+            return {**self.counters, "buckets": buckets}
+
+def estimate_tokens(prompt) -> int:
+    # Roughly four characters per token for English text
+    prompts = prompt if isinstance(prompt, list) else [prompt]
+    return sum(len(p) for p in prompts) // 4 + 1
@@ -1,2 +1,8 @@
+import re
+
+
 def nonewlines(s: str) -> str:
     return s.replace('\n', ' ').replace('\r', ' ')
+
+def normalize_query(q: str) -> str:
+    return " ".join(re.findall(r"\w+", q.lower()))
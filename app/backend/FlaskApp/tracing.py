@@ -0,0 +1,206 @@
+import json
+import logging
+import queue
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+import requests
+
+# Lightweight request tracing. A route starts a trace with start_trace and the code it calls wraps its stages in
+# span(...): query rewrite, search, prompt building, completions, ingestion stages. Spans nest through a context
+# variable, so they follow the request into asyncio tasks and asyncio.to_thread, and are recorded from whichever
+# thread finishes them. When no trace is active span() returns a shared no-op span, which keeps the cost of an
+# untraced request to a context variable lookup per stage. Finished traces can be summarized for a response
+# (Trace.summary) and exported in the OpenTelemetry OTLP/HTTP JSON format by a TraceExporter.
+
+class Trace:
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span: "Span"):
+        with self.lock:
+            self.spans.append(span)
+
+    def summary(self) -> dict:
+        """Stage timings in milliseconds: the total, the time spent per span name and each span in start order."""
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start_ns)
+        if not spans:
+            return {}
+        root = spans[0]
+        depths = {root.span_id: 0}
+        stages = {}
+        timeline = []
+        for s in spans:
+            depth = depths.get(s.parent_id, 0) + 1 if s.parent_id else 0
+            depths[s.span_id] = depth
+            duration_ms = round((s.end_ns - s.start_ns) / 1e6, 2)
+            if s.parent_id:
+                stages[s.name] = round(stages.get(s.name, 0) + duration_ms, 2)
+            item = {"name": s.name, "depth": depth, "start_ms": round((s.start_ns - root.start_ns) / 1e6, 2), "duration_ms": duration_ms}
+            if s.error:
+                item["error"] = s.error
+            timeline.append(item)
+        return {"total_ms": round((root.end_ns - root.start_ns) / 1e6, 2), "stages": stages, "spans": timeline}
+
+    def to_otlp(self) -> List[dict]:
+        with self.lock:
+            spans = list(self.spans)
+        return [s.to_otlp() for s in spans]
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "attributes", "start_ns", "end_ns", "error", "token")
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = 0
+        self.end_ns = 0
+        self.error = None
+        self.token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def timings(self) -> Optional[dict]:
+        return self.trace.summary()
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        current_span.reset(self.token)
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.trace.add(self)
+        if self.parent_id is None and trace_exporter is not None:
+            trace_exporter.submit(self.trace)
+        return False
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            # Server for the request's root span, internal for the stages
+            "kind": 1 if self.parent_id else 2,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": otlp_value(value)} for key, value in self.attributes.items() if value is not None],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}}
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+class NoopSpan:
+    def set(self, **attributes):
+        pass
+
+    def timings(self) -> Optional[dict]:
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+noop_span = NoopSpan()
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+def span(name: str, **attributes):
+    """A span for a stage of the current trace, or a no-op span if nothing is being traced."""
+    parent = current_span.get()
+    if parent is None:
+        return noop_span
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+def start_trace(name: str, sampled: bool = True, **attributes):
+    """A child span of the current trace if there is one, else the root span of a new trace if sampled."""
+    parent = current_span.get()
+    if parent is not None:
+        return Span(parent.trace, name, parent.span_id, attributes)
+    if not sampled:
+        return noop_span
+    return Span(Trace(), name, None, attributes)
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+class TraceExporter:
+    # Sends finished traces in batches from a background thread, as OTLP/HTTP JSON export requests posted to a
+    # collector (e.g. http://localhost:4318/v1/traces) and/or appended one per line to a file. Traces are dropped
+    # rather than slowing down requests when the exporter can't keep up.
+    def __init__(self, service_name: str, endpoint: Optional[str] = None, path: Optional[str] = None,
+                 max_queue: int = 1000, batch_size: int = 64, interval: float = 2.0):
+        self.service_name = service_name
+        self.endpoint = endpoint
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(max_queue)
+        self.session = requests.Session()
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, trace: Trace):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="trace-exporter", daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self.export(batch)
+            except Exception as e:
+                logging.warning(f"Unable to export {len(batch)} traces: {e}")
+
+    def export_request(self, traces: List[Trace]) -> dict:
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": otlp_value(self.service_name)}]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": [s for trace in traces for s in trace.to_otlp()]}]}]}
+
+    def export(self, traces: List[Trace]):
+        body = json.dumps(self.export_request(traces))
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(body + "\n")
+        if self.endpoint:
+            self.session.post(self.endpoint, data=body, headers={"Content-Type": "application/json"}, timeout=10).raise_for_status()
+
+trace_exporter: Optional[TraceExporter] = None
+
+def set_trace_exporter(exporter: Optional[TraceExporter]):
+    global trace_exporter
+    trace_exporter = exporter
@@ -1,12 +1,15 @@
 import logging
 import azure.functions as func
-from ..FlaskApp import app
+from ..FlaskApp import asgi_app
 
 logging.info("Python HTTP HandleApproach trigger - Entry point initialized.")
 
-def main(req: func.HttpRequest, context: func.Context) -> func.HttpResponse:
-    """Each request is redirected to the WSGI handler.
+# Created once, so the host's event loop keeps the app's HTTP sessions and async clients from one request to the next
+middleware = func.AsgiMiddleware(asgi_app)
+
+async def main(req: func.HttpRequest, context: func.Context) -> func.HttpResponse:
+    """Each request is redirected to the ASGI handler, which awaits the async views on the host's event loop.
     """
     logging.info(f"Python HTTP trigger function processed a request. RequestUri={req.url}")
     # logging.info(f"url map: {app.url_map}")
-    return func.WsgiMiddleware(app.wsgi_app).handle(req, context)
+    return await middleware.handle_async(req, context)
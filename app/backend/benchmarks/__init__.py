@@ -0,0 +1,30 @@
+import math
+import os
+import tempfile
+from typing import Dict, Optional
+
+# Offline benchmarks for the backend, run from app/backend:
+#   python -m benchmarks.load --scenario ask --concurrency 16 --requests 500   load test of a route against fakes
+#   python -m benchmarks.micro [name ...]                                       microbenchmarks of hot functions
+# Azure OpenAI, Cognitive Search, Blob Storage and Form Recognizer are replaced by the local fakes in fakes.py, so
+# nothing leaves the machine and runs are repeatable. The settings in FlaskApp/clients.py are read when FlaskApp is
+# imported, so configure() has to run first.
+
+def configure(backends, workdir: Optional[str] = None, env: Optional[Dict[str, str]] = None) -> str:
+    """Point FlaskApp at the fakes and keep its local state in workdir (a new temporary directory by default)."""
+    workdir = workdir or tempfile.mkdtemp(prefix="benchmarks_")
+    os.environ.update(backends.environment())
+    os.environ.update({
+        "ANALYSIS_CACHE_PATH": os.path.join(workdir, "analysis-cache"),
+        "INGESTION_MANIFEST_PATH": os.path.join(workdir, "manifests"),
+        "INGESTION_QUEUE_PATH": os.path.join(workdir, "ingestion.db"),
+        "LOCAL_SEARCH_PATH": os.path.join(workdir, "local-search")})
+    os.environ.update(env or {})
+    return workdir
+
+def percentile(sorted_values, p: float) -> float:
+    """Nearest rank percentile of an ascending list, p in 0-100."""
+    if not sorted_values:
+        return float("nan")
+    rank = min(max(math.ceil(p / 100 * len(sorted_values)), 1), len(sorted_values))
+    return sorted_values[rank - 1]
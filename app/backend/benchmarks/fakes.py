@@ -0,0 +1,618 @@
+import base64
+import hashlib
+import io
+import json
+import operator
+import random
+import re
+import ssl
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+# Local stand-ins for the Azure services the backend calls: Azure OpenAI completions and embeddings, Cognitive
+# Search, Blob Storage and Form Recognizer. Each fake is a small HTTP server that speaks enough of the service's REST
+# API for the Azure SDKs and the openai package to work against it, keeps its state in memory and counts the calls
+# it gets. Faults adds latency and injects throttling (429 with Retry-After) and server errors, so failover, rate
+# limiting and retries can be exercised offline. FakeBackends starts all four and returns the environment variables
+# that point the app at them. The search index client only accepts https, so the search fake is served over TLS with a
+# self-signed certificate that the environment tells requests and aiohttp to trust.
+
+class Faults:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, throttle_rate: float = 0.0, error_rate: float = 0.0, retry_after: float = 1.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self.lock:
+            return max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0.0)
+
+    def inject(self):
+        """Sleep for the configured latency, then return (status, headers) of a fault to answer with, or None."""
+        time.sleep(self.delay())
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.throttle_rate:
+            return 429, {"Retry-After": str(self.retry_after), "retry-after-ms": str(int(self.retry_after * 1000))}
+        if draw < self.throttle_rate + self.error_rate:
+            return 500, {}
+        return None
+
+class Request:
+    def __init__(self, method: str, path: str, query: Dict[str, str], headers, body: bytes):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body or b"{}")
+
+class Response:
+    def __init__(self, status: int = 200, body=b"", headers: Optional[dict] = None, content_type: str = "application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif isinstance(body, str):
+            body = body.encode()
+        self.status = status
+        self.body = body
+        self.headers = {"Content-Type": content_type, **(headers or {})}
+
+class FakeService:
+    # Base for the fakes: runs a threaded HTTP server on a free local port and hands requests to handle()
+    name = "fake"
+
+    def __init__(self, faults: Optional[Faults] = None, certificate: Optional[tuple] = None):
+        self.faults = faults or Faults()
+        self.certificate = certificate
+        self.calls: Dict[str, int] = {}
+        self.lock = threading.RLock()
+        self.server = None
+
+    def count(self, operation: str):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> "FakeService":
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_request(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                query = {key: values[0] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+                request = Request(self.command, unquote(url.path), query, self.headers, body)
+                fault = service.faults.inject()
+                if fault is not None:
+                    status, headers = fault
+                    service.count(f"fault_{status}")
+                    response = service.error(status, headers)
+                else:
+                    try:
+                        response = service.handle(request)
+                    except Exception as e:
+                        service.count("fault_500")
+                        response = service.error(500, {}, str(e))
+                self.send(response, head=self.command == "HEAD")
+
+            def send(self, response: Response, head: bool = False):
+                self.send_response(response.status)
+                for key, value in response.headers.items():
+                    self.send_header(key, value)
+                if isinstance(response.body, bytes):
+                    self.send_header("Content-Length", str(len(response.body)))
+                    self.end_headers()
+                    if not head:
+                        self.wfile.write(response.body)
+                    return
+                # A generator of chunks, sent as server-sent events
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for chunk in response.body:
+                    self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = handle_request
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        if self.certificate is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(*self.certificate)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        threading.Thread(target=self.server.serve_forever, name=f"fake-{self.name}", daemon=True).start()
+        return self
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"{'https' if self.certificate else 'http'}://{host}:{port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def error(self, status: int, headers: dict, message: str = "") -> Response:
+        return Response(status, {"error": {"code": str(status), "message": message or f"Injected {status}"}}, headers)
+
+    def handle(self, request: Request) -> Response:
+        raise NotImplementedError
+
+# Azure OpenAI
+
+def words(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+class FakeOpenAI(FakeService):
+    # Completions answer from the prompt: agent prompts get the next ReAct step, other prompts a sentence citing the
+    # first source in the prompt. Embeddings are deterministic hashes of the input's words.
+    name = "openai"
+    dimensions = 64
+
+    def handle(self, request: Request) -> Response:
+        match = re.match(r"^/openai/deployments/([^/]+)/(completions|embeddings|chat/completions)$", request.path)
+        if request.method != "POST" or not match:
+            return self.error(404, {})
+        if not request.headers.get("api-key"):
+            return self.error(401, {}, "Missing api-key header")
+        deployment, operation = match.groups()
+        self.count(operation)
+        body = request.json()
+        if operation == "embeddings":
+            return self.embeddings(deployment, body)
+        return self.completions(deployment, body)
+
+    def completions(self, deployment: str, body: dict) -> Response:
+        prompts = body.get("prompt")
+        prompts = prompts if isinstance(prompts, list) else [prompts or ""]
+        n = body.get("n") or 1
+        stop = body.get("stop") or []
+        stop = [stop] if isinstance(stop, str) else stop
+        max_tokens = body.get("max_tokens") or 16
+        choices = []
+        for i, prompt in enumerate(prompts):
+            for j in range(n):
+                text = truncate_at_stop(self.complete(prompt), stop)
+                text = " ".join(text.split(" ")[:max_tokens]) if len(text.split(" ")) > max_tokens else text
+                choices.append({"text": text, "index": i * n + j, "finish_reason": "stop", "logprobs": None})
+        prompt_tokens = sum(len(p) // 4 + 1 for p in prompts)
+        completion_tokens = sum(len(c["text"]) // 4 + 1 for c in choices)
+        completion = {"id": f"cmpl-{uuid.uuid4().hex[:12]}", "object": "text_completion", "created": int(time.time()), "model": deployment, "choices": choices}
+        if body.get("stream"):
+            return Response(200, self.stream(completion), content_type="text/event-stream")
+        completion["usage"] = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        return Response(200, completion)
+
+    def stream(self, completion: dict):
+        for choice in completion["choices"]:
+            for piece in re.findall(r"\S+\s*", choice["text"]):
+                chunk = {**completion, "choices": [{**choice, "text": piece, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+
+    def complete(self, prompt: str) -> str:
+        source = re.search(r"[\w\-]+\.(?:pdf|txt)", prompt.rsplit("Question:", 1)[-1]) or re.search(r"[\w\-]+\.(?:pdf|txt)", prompt)
+        citation = f"[{source.group(0)}]" if source else ""
+        question = (re.findall(r"Question: ?'?([^\n']*)", prompt) or [""])[-1].strip()
+        scratchpad = prompt.rsplit("Question:", 1)[-1]
+        if "Action Input:" in prompt:
+            # Zero shot agent: search once, then answer
+            if "Observation:" in scratchpad:
+                return f" I now know the final answer.\nFinal Answer: The answer to {question} is in the documents {citation}."
+            return f" I should search the documents.\nAction: CognitiveSearch\nAction Input: {question}\nObservation:"
+        if re.search(r"Action \d+: Search\[", prompt):
+            # ReAct docstore agent
+            if "Observation" in scratchpad:
+                return f" I have the answer.\nAction: Finish[The answer to {question} is in the documents {citation}]"
+            return f" I need to search {question}.\nAction: Search[{question}]\nObservation:"
+        if "Generate a search query" in prompt or "search query" in prompt[-400:]:
+            return " ".join(words(prompt.rsplit("Question:", 1)[-1])[:8])
+        return f"Contoso's plans cover this, see the sources {citation}."
+
+    def embeddings(self, deployment: str, body: dict) -> Response:
+        inputs = body.get("input")
+        inputs = inputs if isinstance(inputs, list) else [inputs or ""]
+        data = []
+        for i, text in enumerate(inputs):
+            vector = [0.0] * self.dimensions
+            for word in words(text):
+                vector[int(hashlib.blake2b(word.encode(), digest_size=4).hexdigest(), 16) % self.dimensions] += 1.0
+            data.append({"object": "embedding", "index": i, "embedding": vector})
+        tokens = sum(len(t) // 4 + 1 for t in inputs)
+        return Response(200, {"object": "list", "data": data, "model": deployment, "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+def truncate_at_stop(text: str, stop: List[str]) -> str:
+    cut = len(text)
+    for s in stop:
+        position = text.find(s)
+        if position >= 0:
+            cut = min(cut, position)
+    return text[:cut]
+
+# Cognitive Search
+
+def sample_sections(count: int, seed: int = 0) -> List[dict]:
+    """Synthetic index sections about benefits, for seeding FakeSearch."""
+    topics = ["deductible", "copay", "coinsurance", "network", "pharmacy", "dental", "vision", "retirement", "vacation", "wellness",
+              "overlake", "northwind", "perks", "premium", "claims", "referral", "emergency", "hospital", "therapy", "maternity"]
+    filler = ["the", "plan", "employee", "covers", "benefit", "per", "year", "and", "for", "family", "members", "with", "cost", "visit", "in"]
+    rng = random.Random(seed)
+    sections = []
+    for i in range(count):
+        sourcefile = f"Benefit_Options_{i // 50}.pdf"
+        text = " ".join(rng.choice(topics) if rng.random() < 0.3 else rng.choice(filler) for _ in range(120))
+        sections.append({"id": f"section-{i}", "content": text.capitalize() + ".", "category": "benefits",
+                         "sourcepage": f"Benefit_Options_{i // 50}-{i % 50}.pdf", "sourcefile": sourcefile})
+    return sections
+
+class FakeSearch(FakeService):
+    # Keeps documents per index in memory and ranks them by how many query words they contain. Supports the
+    # filters the app uses (eq/ne/gt on a field, joined with and), orderby, select, top, skip (capped at 100,000 like
+    # the service), counts, captions and answers.
+    name = "search"
+
+    def __init__(self, faults: Optional[Faults] = None, documents: Optional[List[dict]] = None, index: str = "gptkbindex", certificate: Optional[tuple] = None):
+        super().__init__(faults, certificate)
+        self.indexes: Dict[str, Dict[str, dict]] = {index: {}}
+        self.postings: Dict[str, Dict[str, set]] = {index: {}}
+        for document in documents or []:
+            self.upsert(index, document)
+
+    def upsert(self, index: str, document: dict):
+        docs = self.indexes.setdefault(index, {})
+        postings = self.postings.setdefault(index, {})
+        old = docs.get(document["id"])
+        if old is not None:
+            for word in set(words(old.get("content") or "")):
+                postings.get(word, set()).discard(old["id"])
+        docs[document["id"]] = document
+        for word in set(words(document.get("content") or "")):
+            postings.setdefault(word, set()).add(document["id"])
+
+    def delete(self, index: str, key: str):
+        document = self.indexes.get(index, {}).pop(key, None)
+        if document is not None:
+            for word in set(words(document.get("content") or "")):
+                self.postings[index].get(word, set()).discard(key)
+
+    def handle(self, request: Request) -> Response:
+        path = request.path
+        if path.rstrip("/") == "/indexes":
+            if request.method == "GET":
+                self.count("list_indexes")
+                return Response(200, {"value": [{"name": name} for name in self.indexes]})
+            if request.method == "POST":
+                self.count("create_index")
+                definition = request.json()
+                with self.lock:
+                    self.indexes.setdefault(definition["name"], {})
+                    self.postings.setdefault(definition["name"], {})
+                return Response(201, definition)
+        match = re.match(r"^/indexes(?:\('([^']+)'\)|/([^/]+))/docs/(search\.post\.search|search\.index)$", path)
+        if not match or request.method != "POST":
+            return self.error(404, {})
+        index = match.group(1) or match.group(2)
+        if index not in self.indexes:
+            return self.error(404, {}, f"Index {index} not found")
+        if match.group(3) == "search.index":
+            self.count("index")
+            return self.index_documents(index, request.json())
+        self.count("search")
+        return self.search(index, request.json())
+
+    def index_documents(self, index: str, body: dict) -> Response:
+        results = []
+        with self.lock:
+            for action in body.get("value", []):
+                kind = action.pop("@search.action", "upload")
+                if kind == "delete":
+                    self.delete(index, action["id"])
+                else:
+                    self.upsert(index, action)
+                results.append({"key": action["id"], "status": True, "errorMessage": None, "statusCode": 200 if kind == "delete" else 201})
+        return Response(200, {"value": results})
+
+    def search(self, index: str, body: dict) -> Response:
+        filters = parse_filter(body.get("filter"))
+        terms = set(words(body.get("search") or ""))
+        with self.lock:
+            docs = self.indexes[index]
+            if terms:
+                scores = {}
+                for term in terms:
+                    for key in self.postings[index].get(term, ()):
+                        scores[key] = scores.get(key, 0) + 1
+                candidates = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            else:
+                candidates = [(key, 1) for key in docs]
+            matches = [(docs[key], score) for key, score in candidates if all(check(docs[key]) for check in filters)]
+        for clause in reversed([c.split() for c in (body.get("orderby") or "").split(",") if c.strip()]):
+            matches.sort(key=lambda match: match[0].get(clause[0]) or "", reverse=clause[-1].lower() == "desc")
+        skip = body.get("skip") or 0
+        if skip > 100000:
+            return self.error(400, {}, "The value of $skip can't be larger than 100000")
+        top = body.get("top") or 50
+        selected = [field.strip() for field in (body.get("select") or "").split(",") if field.strip()]
+        value = []
+        for document, score in matches[skip:skip + top]:
+            result = {field: document.get(field) for field in selected} if selected else dict(document)
+            result["@search.score"] = float(score)
+            if body.get("captions"):
+                result["@search.captions"] = [{"text": (document.get("content") or "")[:200], "highlights": None}]
+            value.append(result)
+        response = {"value": value}
+        if body.get("count"):
+            response["@odata.count"] = len(matches)
+        if body.get("answers") and value:
+            response["@search.answers"] = [{"key": value[0].get("id", ""), "text": (matches[0][0].get("content") or "")[:200], "highlights": None, "score": 0.9}]
+        return Response(200, response)
+
+def parse_filter(expression: Optional[str]):
+    checks = []
+    for clause in re.split(r"\s+and\s+", expression or "", flags=re.IGNORECASE):
+        match = re.match(r"^\s*(\w+)\s+(eq|ne|gt)\s+'((?:[^']|'')*)'\s*$", clause)
+        if match:
+            field, op, value = match.group(1), match.group(2), match.group(3).replace("''", "'")
+            compare = {"eq": operator.eq, "ne": operator.ne, "gt": lambda a, b: a is not None and a > b}[op]
+            checks.append(lambda d, f=field, v=value, compare=compare: compare(d.get(f), v))
+    return checks
+
+# Blob Storage
+
+def http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+class FakeBlobStorage(FakeService):
+    # Block blobs in containers, addressed path style: /<account>/<container>/<blob>. Supports creating and
+    # checking containers, single shot uploads, HEAD, ranged downloads and deletes.
+    name = "blob"
+
+    def __init__(self, faults: Optional[Faults] = None, account: str = "fakeaccount"):
+        super().__init__(faults)
+        self.account = account
+        self.containers: Dict[str, Dict[str, dict]] = {}
+
+    @property
+    def account_url(self) -> str:
+        return f"{self.url}/{self.account}"
+
+    def put(self, container: str, name: str, data: bytes, content_type: str = "application/octet-stream"):
+        with self.lock:
+            self.containers.setdefault(container, {})[name] = {"data": data, "content_type": content_type,
+                                                              "etag": f'"0x{uuid.uuid4().hex[:15].upper()}"', "last_modified": time.time()}
+
+    def storage_error(self, status: int, code: str) -> Response:
+        body = f'<?xml version="1.0" encoding="utf-8"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'
+        return Response(status, body, {"x-ms-error-code": code, "x-ms-request-id": str(uuid.uuid4())}, content_type="application/xml")
+
+    def error(self, status: int, headers: dict, message: str = "") -> Response:
+        response = self.storage_error(status, "ServerBusy" if status in (429, 503) else "InternalError")
+        response.headers.update(headers)
+        return response
+
+    def handle(self, request: Request) -> Response:
+        parts = request.path.strip("/").split("/", 2)
+        if len(parts) < 2 or parts[0] != self.account:
+            return self.storage_error(400, "InvalidUri")
+        container = parts[1]
+        common = {"x-ms-request-id": str(uuid.uuid4()), "x-ms-version": request.headers.get("x-ms-version") or "2021-08-06"}
+        if len(parts) == 2:
+            if request.query.get("restype") != "container":
+                return self.storage_error(400, "InvalidQueryParameterValue")
+            with self.lock:
+                exists = container in self.containers
+                if request.method == "PUT":
+                    self.count("create_container")
+                    if exists:
+                        return self.storage_error(409, "ContainerAlreadyExists")
+                    self.containers[container] = {}
+                    return Response(201, b"", {**common, "ETag": '"0x1"', "Last-Modified": http_date(time.time())})
+            self.count("get_container")
+            if not exists:
+                return self.storage_error(404, "ContainerNotFound")
+            return Response(200, b"", {**common, "ETag": '"0x1"', "Last-Modified": http_date(time.time()), "x-ms-lease-state": "available", "x-ms-lease-status": "unlocked"})
+        name = parts[2]
+        if request.method == "PUT":
+            if request.query.get("comp"):
+                return self.storage_error(400, "UnsupportedQueryParameter")
+            self.count("put_blob")
+            if container not in self.containers:
+                return self.storage_error(404, "ContainerNotFound")
+            self.put(container, name, request.body, request.headers.get("x-ms-blob-content-type") or "application/octet-stream")
+            blob = self.containers[container][name]
+            return Response(201, b"", {**common, "ETag": blob["etag"], "Last-Modified": http_date(blob["last_modified"]),
+                                       "Content-MD5": base64.b64encode(hashlib.md5(request.body).digest()).decode(), "x-ms-request-server-encrypted": "true"})
+        with self.lock:
+            blob = self.containers.get(container, {}).get(name)
+        if request.method == "DELETE":
+            self.count("delete_blob")
+            if blob is None:
+                return self.storage_error(404, "BlobNotFound")
+            with self.lock:
+                self.containers[container].pop(name, None)
+            return Response(202, b"", {**common, "x-ms-delete-type-permanent": "true"})
+        if blob is None:
+            return self.storage_error(404, "BlobNotFound")
+        data = blob["data"]
+        headers = {**common, "ETag": blob["etag"], "Last-Modified": http_date(blob["last_modified"]), "x-ms-blob-type": "BlockBlob",
+                   "Accept-Ranges": "bytes", "x-ms-creation-time": http_date(blob["last_modified"]), "x-ms-server-encrypted": "true"}
+        if request.method == "HEAD":
+            self.count("get_properties")
+            return Response(200, data, {**headers, "Content-Type": blob["content_type"]}, content_type=blob["content_type"])
+        self.count("get_blob")
+        range_header = request.headers.get("x-ms-range") or request.headers.get("Range")
+        match = re.match(r"bytes=(\d+)-(\d*)", range_header or "")
+        if not match:
+            return Response(200, data, headers, content_type=blob["content_type"])
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+        if start >= len(data) and len(data) > 0:
+            return self.storage_error(416, "InvalidRange")
+        if len(data) == 0:
+            return Response(200, data, headers, content_type=blob["content_type"])
+        return Response(206, data[start:end + 1], {**headers, "Content-Range": f"bytes {start}-{end}/{len(data)}"}, content_type=blob["content_type"])
+
+# Form Recognizer
+
+def sample_page_text(document: str, page_number: int, words_per_page: int = 400) -> str:
+    rng = random.Random(f"{document}-{page_number}")
+    vocabulary = ["The", "employee", "plan", "covers", "in-network", "visits", "and", "prescriptions", "with", "a", "deductible", "of",
+                  "$500", "per", "year", "for", "each", "family", "member", "Contoso", "Northwind", "Health", "Plus", "Standard"]
+    sentences = []
+    count = 0
+    while count < words_per_page:
+        length = rng.randint(8, 24)
+        sentences.append(" ".join(rng.choice(vocabulary) for _ in range(length)) + ".")
+        count += length
+    return f"Page {page_number} of {document}. " + " ".join(sentences)
+
+def sample_analyze_result(document: str, page_numbers: List[int], words_per_page: int = 400, table_every: int = 3, table_shape: Tuple[int, int] = (3, 3)) -> dict:
+    """A prebuilt-layout analyzeResult in the REST format, with a rows x columns table on every table_every-th page."""
+    content = ""
+    pages = []
+    tables = []
+    for page_number in page_numbers:
+        start = len(content)
+        content += sample_page_text(document, page_number, words_per_page) + "\n"
+        if table_every and page_number % table_every == 0:
+            cells = []
+            table_start = len(content)
+            rows, columns = table_shape
+            for row in range(rows):
+                for column in range(columns):
+                    text = f"Tier {row}" if column == 0 else f"${(row + 1) * (column + 1) * 100}"
+                    cells.append({"kind": "columnHeader" if row == 0 else "content", "rowIndex": row, "columnIndex": column, "content": text,
+                                  "boundingRegions": [{"pageNumber": page_number, "polygon": [0, 0, 1, 0, 1, 1, 0, 1]}],
+                                  "spans": [{"offset": len(content), "length": len(text)}]})
+                    content += text + " "
+            content += "\n"
+            tables.append({"rowCount": rows, "columnCount": columns, "cells": cells,
+                           "boundingRegions": [{"pageNumber": page_number, "polygon": [0, 0, 1, 0, 1, 1, 0, 1]}],
+                           "spans": [{"offset": table_start, "length": len(content) - table_start}]})
+        pages.append({"pageNumber": page_number, "angle": 0, "width": 8.5, "height": 11, "unit": "inch", "words": [], "lines": [],
+                      "spans": [{"offset": start, "length": len(content) - start}]})
+    return {"apiVersion": "2022-08-31", "modelId": "prebuilt-layout", "stringIndexType": "unicodeCodePoint", "content": content,
+            "pages": pages, "tables": tables, "paragraphs": [], "styles": []}
+
+def parse_pages(pages: Optional[str], count: int) -> List[int]:
+    if not pages:
+        return list(range(1, count + 1))
+    numbers = []
+    for part in pages.split(","):
+        first, _, last = part.partition("-")
+        numbers += range(int(first), int(last or first) + 1)
+    return [n for n in numbers if 1 <= n <= count]
+
+class FakeFormRecognizer(FakeService):
+    # prebuilt-layout analysis as a long running operation that has finished by the first poll. The text of each
+    # page is generated from the document's hash and page number, the page count is read from the PDF.
+    name = "formrecognizer"
+
+    def __init__(self, faults: Optional[Faults] = None, words_per_page: int = 400):
+        super().__init__(faults)
+        self.words_per_page = words_per_page
+        self.operations: Dict[str, dict] = {}
+
+    def handle(self, request: Request) -> Response:
+        match = re.match(r"^/formrecognizer/documentModels/([^/:]+):analyze$", request.path)
+        if match and request.method == "POST":
+            self.count("analyze")
+            from pypdf import PdfReader
+            page_count = len(PdfReader(io.BytesIO(request.body)).pages)
+            document = hashlib.sha256(request.body).hexdigest()[:12]
+            result = sample_analyze_result(document, parse_pages(request.query.get("pages"), page_count), self.words_per_page)
+            operation = uuid.uuid4().hex
+            now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            with self.lock:
+                self.operations[operation] = {"status": "succeeded", "createdDateTime": now, "lastUpdatedDateTime": now, "analyzeResult": result}
+            location = f"{self.url}/formrecognizer/documentModels/{match.group(1)}/analyzeResults/{operation}?api-version={request.query.get('api-version', '2022-08-31')}"
+            return Response(202, b"", {"Operation-Location": location, "Retry-After": "0", "apim-request-id": operation})
+        match = re.match(r"^/formrecognizer/documentModels/([^/]+)/analyzeResults/([^/]+)$", request.path)
+        if match and request.method == "GET":
+            self.count("get_result")
+            with self.lock:
+                operation = self.operations.get(match.group(2))
+            if operation is None:
+                return self.error(404, {})
+            return Response(200, operation, {"Retry-After": "0"})
+        return self.error(404, {})
+
+def self_signed_certificate(directory: str, host: str = "127.0.0.1"):
+    """Write a certificate and key for host to directory and return their paths."""
+    import ipaddress
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)])
+    now = datetime.utcnow()
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number()).not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=30))
+                   .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address(host)), x509.DNSName("localhost")]), critical=False)
+                   .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                   .sign(key, hashes.SHA256()))
+    certfile = f"{directory}/fake-cert.pem"
+    keyfile = f"{directory}/fake-key.pem"
+    with open(certfile, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return certfile, keyfile
+
+class FakeBackends:
+    def __init__(self, openai_faults: Optional[Faults] = None, search_faults: Optional[Faults] = None, blob_faults: Optional[Faults] = None,
+                 formrecognizer_faults: Optional[Faults] = None, documents: Optional[List[dict]] = None):
+        self.directory = tempfile.mkdtemp(prefix="fakes_")
+        self.certificate = self_signed_certificate(self.directory)
+        self.openai = FakeOpenAI(openai_faults)
+        self.search = FakeSearch(search_faults, documents, certificate=self.certificate)
+        self.blob = FakeBlobStorage(blob_faults)
+        self.formrecognizer = FakeFormRecognizer(formrecognizer_faults)
+        self.services = [self.openai, self.search, self.blob, self.formrecognizer]
+
+    def start(self) -> "FakeBackends":
+        for service in self.services:
+            service.start()
+        return self
+
+    def stop(self):
+        for service in self.services:
+            service.stop()
+
+    def environment(self) -> Dict[str, str]:
+        """Environment variables that point the app at the fakes, to be set before FlaskApp is imported."""
+        return {
+            "AZURE_OPENAI_SERVICE_1": self.openai.url,
+            "AZURE_OPENAI_SERVICE_1_KEY": "fake-key",
+            "AZURE_SEARCH_SERVICE": self.search.url,
+            "AZURE_SEARCH_KEY": "fake-key",
+            "AZURE_STORAGE_ACCOUNT": self.blob.account_url,
+            "AZURE_STORAGE_KEY": base64.b64encode(b"fake-storage-key").decode(),
+            "AZURE_FORM_RECOGNIZER_SERVICE": self.formrecognizer.url,
+            "AZURE_FORM_RECOGNIZER_KEY": "fake-key",
+            "REQUESTS_CA_BUNDLE": self.certificate[0],
+            "SSL_CERT_FILE": self.certificate[0]}
+
+    def calls(self) -> Dict[str, Dict[str, int]]:
+        return {service.name: dict(service.calls) for service in self.services}
@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import io
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+import requests
+
+from . import configure, percentile
+from .fakes import FakeBackends, Faults, sample_sections
+
+# Load test of one route of the backend, e.g.
+#   python -m benchmarks.load --scenario ask --approach rtr --concurrency 32 --requests 2000 --latency 0.5 --throttle 0.05
+# Without --url the app is served in this process against the fakes, with --latency, --jitter, --throttle and
+# --errors applied to the services named by --faults. Each scenario sends --requests requests from --concurrency
+# threads, after --warmup requests that aren't measured, and reports the throughput, latency percentiles, status
+# codes and the calls the fakes received. Questions cycle through --distinct variants, which sets the answer cache
+# hit rate. Settings of the app can be changed with --env, e.g. --env SEARCH_BACKEND=local --env ANSWER_CACHE_MAX_ENTRIES=0.
+#
+# Scenarios: ask and chat post to /api/ask and /api/chat, batch posts --batch-size questions to /api/ask/batch and
+# reads the whole response, content downloads --blobs blobs of --blob-kb from /api/content, and upload posts a new
+# PDF of --pages pages to /api/upload and waits for its ingestion job to finish, the upload request alone is reported
+# as upload_request.
+#
+# --server picks how the app is served: wsgi through its WSGI interface from a pool of --threads threads, as the
+# Functions host ran it with WsgiMiddleware, so an async view holds its thread until it's done; asgi through
+# FlaskApp.asgi.AsgiAdapter on an event loop, as the host runs it now, so async views (ask and chat) wait without a
+# thread and only sync views and streamed responses use the pool. Both serve one request per connection. Comparing
+# the two with --concurrency above --threads shows what the async views gain.
+
+TOPICS = ["deductible", "copay for dental", "out of network coverage", "vision benefits", "pharmacy costs", "emergency visits",
+          "maternity coverage", "therapy sessions", "retirement plan", "vacation policy", "wellness perks", "claims process"]
+PLANS = ["Northwind Health Plus", "Northwind Standard", "the employee handbook", "Contoso's perks program"]
+
+def question(i: int) -> str:
+    return f"What does {PLANS[i % len(PLANS)]} say about {TOPICS[(i // len(PLANS)) % len(TOPICS)]}? ({i})"
+
+def sample_pdf(pages: int, title: str) -> bytes:
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(612, 792)
+    # The title makes each generated file unique, so it's ingested rather than skipped as unchanged
+    writer.add_metadata({"/Title": title})
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+class Scenario:
+    def __init__(self, args, url: str, backends: Optional[FakeBackends]):
+        self.args = args
+        self.url = url
+        self.backends = backends
+        self.local = threading.local()
+        self.overrides = json.loads(args.overrides)
+        # Further latency series a scenario records, reported by name
+        self.extra: Dict[str, List[float]] = {}
+
+    def session(self) -> requests.Session:
+        try:
+            return self.local.session
+        except AttributeError:
+            self.local.session = requests.Session()
+            return self.local.session
+
+    def setup(self):
+        pass
+
+    def request(self, i: int) -> Tuple[int, int]:
+        """Send request i and return its status code and response size."""
+        raise NotImplementedError
+
+class AskScenario(Scenario):
+    def request(self, i):
+        r = self.session().post(f"{self.url}/api/ask", json={"approach": self.args.approach, "question": question(i % self.args.distinct), "overrides": self.overrides})
+        return r.status_code, len(r.content)
+
+class ChatScenario(Scenario):
+    def request(self, i):
+        history = [{"user": question(i % self.args.distinct - 1), "bot": "It's covered, see [Benefit_Options_0-1.pdf]."}, {"user": question(i % self.args.distinct)}]
+        r = self.session().post(f"{self.url}/api/chat", json={"approach": "rrr", "history": history, "overrides": self.overrides})
+        return r.status_code, len(r.content)
+
+class BatchScenario(Scenario):
+    def request(self, i):
+        questions = [question((i * self.args.batch_size + j) % self.args.distinct) for j in range(self.args.batch_size)]
+        with self.session().post(f"{self.url}/api/ask/batch", json={"approach": self.args.approach, "questions": questions, "overrides": self.overrides}, stream=True) as r:
+            lines = [line for line in r.iter_lines() if line]
+        failed = sum(1 for line in lines if "error" in json.loads(line))
+        return (r.status_code if not failed else 207), sum(len(line) for line in lines)
+
+class ContentScenario(Scenario):
+    def setup(self):
+        if self.args.paths:
+            self.paths = self.args.paths.split(",")
+            return
+        if self.backends is None:
+            raise SystemExit("--paths is needed for the content scenario with --url")
+        self.paths = []
+        for i in range(self.args.blobs):
+            path = f"Benefit_Options_{i}-0.pdf"
+            self.backends.blob.put("content", path, (f"%PDF-1.7 {i} ".encode() * (self.args.blob_kb * 100))[:self.args.blob_kb * 1024], "application/pdf")
+            self.paths.append(path)
+
+    def request(self, i):
+        with self.session().get(f"{self.url}/api/content/{self.paths[i % len(self.paths)]}", stream=True) as r:
+            size = sum(len(chunk) for chunk in r.iter_content(64 * 1024))
+        return r.status_code, size
+
+class UploadScenario(Scenario):
+    def request(self, i):
+        data = sample_pdf(self.args.pages, f"{uuid.uuid4().hex} {i}")
+        start = time.perf_counter()
+        r = self.session().post(f"{self.url}/api/upload", files={"file": (f"Benefit_Options_{uuid.uuid4().hex[:8]}.pdf", data, "application/pdf")})
+        self.extra.setdefault("upload_request", []).append(time.perf_counter() - start)
+        if r.status_code != 202:
+            return r.status_code, len(r.content)
+        job = list(r.json()["jobs"].values())[0]
+        while True:
+            status = self.session().get(f"{self.url}/api/upload/{job}").json()
+            if status["status"] in ("succeeded", "failed"):
+                break
+            time.sleep(0.02)
+        return (r.status_code if status["status"] == "succeeded" else 500), len(r.content)
+
+scenarios = {"ask": AskScenario, "chat": ChatScenario, "batch": BatchScenario, "content": ContentScenario, "upload": UploadScenario}
+
+def serve_app(app, server: str = "wsgi", threads: Optional[int] = None) -> Tuple[str, Callable[[], None]]:
+    """Serve app on a free port, returning its URL and a function that stops it once its requests are done."""
+    if server == "asgi":
+        return serve_asgi(app, threads)
+    from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+    pool = ThreadPoolExecutor(threads, thread_name_prefix="benchmark-wsgi")
+
+    class Handler(WSGIRequestHandler):
+        # A connection per request, so a kept alive connection doesn't hold a thread of the pool between requests
+        protocol_version = "HTTP/1.0"
+
+    class PooledWSGIServer(BaseWSGIServer):
+        multithread = True
+
+        def process_request(self, request, client_address):
+            pool.submit(self.process_request_thread, request, client_address)
+
+        def process_request_thread(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    wsgi_server = PooledWSGIServer("127.0.0.1", 0, app, Handler)
+    threading.Thread(target=wsgi_server.serve_forever, name="benchmark-app", daemon=True).start()
+
+    def stop():
+        wsgi_server.shutdown()
+        pool.shutdown()
+    return f"http://127.0.0.1:{wsgi_server.server_port}", stop
+
+def serve_asgi(app, threads: Optional[int]) -> Tuple[str, Callable[[], None]]:
+    # No ASGI server is a dependency of the app, so this is a minimal HTTP/1.0 one, enough for the scenarios' requests
+    from FlaskApp.asgi import AsgiAdapter
+    adapter = AsgiAdapter(app, threads)
+    loop = asyncio.new_event_loop()
+    connections = set()
+
+    def connected(reader, writer):
+        task = loop.create_task(serve_connection(adapter, reader, writer))
+        connections.add(task)
+        task.add_done_callback(connections.discard)
+
+    server = loop.run_until_complete(asyncio.start_server(connected, "127.0.0.1", 0, backlog=1024))
+    threading.Thread(target=loop.run_forever, name="benchmark-app", daemon=True).start()
+
+    async def shutdown():
+        # A client can have its whole response before the request is done, so wait for them before the lifespan shutdown
+        server.close()
+        if connections:
+            await asyncio.wait(list(connections))
+        messages = [{"type": "lifespan.shutdown"}]
+        async def receive():
+            return messages.pop(0)
+        async def send(message):
+            pass
+        await adapter({"type": "lifespan"}, receive, send)
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result(timeout=30)
+        loop.call_soon_threadsafe(loop.stop)
+    return f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}", stop
+
+async def serve_connection(adapter, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        method, target, _ = head[0].split(" ", 2)
+        headers = [(name.strip().lower().encode("latin-1"), value.strip().encode("latin-1")) for name, value in (line.split(":", 1) for line in head[1:] if line)]
+        body = await reader.readexactly(int(dict(headers).get(b"content-length", 0)))
+        path, _, query = target.partition("?")
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.0", "method": method, "scheme": "http", "path": unquote(path),
+                 "raw_path": path.encode("latin-1"), "query_string": query.encode("latin-1"), "root_path": "", "headers": headers,
+                 "client": writer.get_extra_info("peername")[:2], "server": writer.get_extra_info("sockname")[:2]}
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                writer.write(f"HTTP/1.0 {status} {HTTPStatus(status).phrase}\r\n".encode("latin-1")
+                             + b"".join(name + b": " + value + b"\r\n" for name, value in message["headers"]) + b"connection: close\r\n\r\n")
+            else:
+                writer.write(message.get("body", b""))
+            await writer.drain()
+
+        await adapter(scope, receive, send)
+    except Exception as e:
+        logging.warning(f"Serving a request failed: {e}")
+    finally:
+        writer.close()
+
+def run(scenario: Scenario, count: int, concurrency: int, first: int = 0) -> Tuple[List[float], Counter, float]:
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def send(i: int):
+        start = time.perf_counter()
+        try:
+            status, _ = scenario.request(i)
+        except Exception as e:
+            logging.warning(f"Request {i} failed: {e}")
+            status = "exception"
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(first, first + count)))
+    return sorted(latencies), statuses, time.perf_counter() - start
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    return {"p50_ms": round(percentile(latencies, 50) * 1000, 1), "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1), "max_ms": round((latencies[-1] if latencies else float("nan")) * 1000, 1)}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load", description="Load test a backend route against local fakes of the Azure services")
+    parser.add_argument("--scenario", choices=sorted(scenarios), default="ask")
+    parser.add_argument("--approach", default="rtr", help="ask approach for the ask and batch scenarios")
+    parser.add_argument("--overrides", default="{}", help="overrides JSON sent with ask, chat and batch requests")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=None, help="unmeasured requests first, the concurrency by default")
+    parser.add_argument("--distinct", type=int, default=1000000, help="number of different questions")
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--blobs", type=int, default=20)
+    parser.add_argument("--blob-kb", type=int, default=256)
+    parser.add_argument("--paths", default="", help="comma separated content paths to request, needed with --url")
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--sections", type=int, default=2000, help="sections in the fake search index")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds added to each call to the faulty services")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--throttle", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--errors", type=float, default=0.0, help="fraction of calls answered with 500")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--faults", default="openai", help="comma separated fakes that get the latency and faults: openai, search, blob, formrecognizer")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--env", action="append", default=[], help="NAME=VALUE setting for the app, may be repeated")
+    parser.add_argument("--server", choices=["wsgi", "asgi"], default="wsgi", help="how the app is served without --url")
+    parser.add_argument("--threads", type=int, default=None, help="threads serving the app, min(32, CPUs + 4) by default as in the Functions host")
+    parser.add_argument("--url", default=None, help="base URL of a running backend to test instead")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    backends = None
+    stop = None
+    url = args.url
+    if url is None:
+        faulty = set(args.faults.split(","))
+        faults = lambda name: Faults(args.latency, args.jitter, args.throttle, args.errors, args.retry_after, args.seed) if name in faulty else None
+        backends = FakeBackends(faults("openai"), faults("search"), faults("blob"), faults("formrecognizer"), sample_sections(args.sections, args.seed)).start()
+        configure(backends, env=dict(setting.split("=", 1) for setting in args.env))
+        from FlaskApp import app
+        url, stop = serve_app(app, args.server, args.threads)
+
+    scenario = scenarios[args.scenario](args, url, backends)
+    scenario.setup()
+    warmup = args.concurrency if args.warmup is None else args.warmup
+    if warmup:
+        run(scenario, warmup, args.concurrency, first=args.requests)
+        scenario.extra.clear()
+        if backends is not None:
+            for service in backends.services:
+                service.calls.clear()
+
+    latencies, statuses, seconds = run(scenario, args.requests, args.concurrency)
+    if stop is not None:
+        stop()
+    report = {"scenario": args.scenario, "requests": args.requests, "concurrency": args.concurrency, "seconds": round(seconds, 2),
+              "throughput_rps": round(args.requests / seconds, 1), **summarize(latencies), "status": dict(statuses)}
+    if args.scenario in ("ask", "batch"):
+        report["approach"] = args.approach
+    if args.url is None:
+        report["server"] = args.server
+    for name, values in scenario.extra.items():
+        report[name] = summarize(sorted(values))
+    if backends is not None:
+        report["fake_calls"] = backends.calls()
+    if args.json:
+        print(json.dumps(report))
+        return
+    for key, value in report.items():
+        print(f"{key:>16}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict
+
+from . import configure, percentile
+from .fakes import FakeBackends, sample_analyze_result, sample_page_text, sample_sections
+from .load import sample_pdf
+
+# Microbenchmarks of the backend's hot functions, e.g.
+#   python -m benchmarks.micro                       all of them
+#   python -m benchmarks.micro split_text tracing    some of them
+# Each benchmark runs its function repeatedly and reports the median and p99 time per call. FlaskApp is imported
+# against the fakes, which only serve the one-off setup (e.g. the first Form Recognizer analysis), never the timed
+# loops. Besides timings, "tracing" reports the spans an /ask request records (tests/test_tracing.py checks them)
+# and "content_memory" the peak memory used to stream a blob too large for the content cache.
+
+benchmarks: Dict[str, Callable[[argparse.Namespace, str], dict]] = {}
+
+def benchmark(function):
+    benchmarks[function.__name__] = function
+    return function
+
+def measure(function: Callable[[], object], seconds: float = 1.0, min_calls: int = 5) -> dict:
+    """Call function for about the given time and return per call statistics in microseconds."""
+    times = []
+    deadline = time.perf_counter() + seconds
+    while len(times) < min_calls or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {"calls": len(times), "median_us": round(statistics.median(times) * 1e6, 2), "p99_us": round(percentile(times, 99) * 1e6, 2)}
+
+def sample_page_map(pages: int):
+    from FlaskApp.cog_services import build_page_map
+    return build_page_map([sample_page_text("benchmark", i + 1) + " " for i in range(pages)])
+
+@benchmark
+def split_text(args, workdir):
+    from FlaskApp.cog_services import split_text
+    page_map = sample_page_map(args.pages)
+    characters = sum(len(text) for _, _, text in page_map)
+    result = measure(lambda: list(split_text(page_map)), args.seconds)
+    return {**result, "pages": args.pages, "sections": len(list(split_text(page_map))), "mb_per_second": round(characters / result["median_us"], 2)}
+
+@benchmark
+def page_assembly(args, workdir):
+    # Building the page text, with the tables as html, from a large table heavy analysis result that is handed
+    # straight to the page assembly, so neither the analysis cache nor its decompression is timed
+    from azure.ai.formrecognizer import AnalyzeResult
+    from azure.ai.formrecognizer._generated.v2022_08_31.models import AnalyzeResult as GeneratedAnalyzeResult
+    from FlaskApp.cog_services import assemble_pages
+    analysis = sample_analyze_result("page assembly", list(range(1, args.pages + 1)), table_every=1, table_shape=(12, 6))
+    results = AnalyzeResult._from_generated(GeneratedAnalyzeResult.deserialize(analysis))
+    result = measure(lambda: assemble_pages(results), args.seconds)
+    return {**result, "pages": args.pages, "tables": len(results.tables), "characters": len(results.content)}
+
+@benchmark
+def upload_blobs(args, workdir):
+    # Splitting a document into page PDFs and uploading them to the fake blob storage
+    from FlaskApp.cog_services import upload_blobs
+    filename = os.path.join(workdir, "upload_blobs.pdf")
+    with open(filename, "wb") as f:
+        f.write(sample_pdf(args.pages, "upload blobs"))
+    logging.disable(logging.INFO)
+    try:
+        result = measure(lambda: upload_blobs(filename), args.seconds)
+    finally:
+        logging.disable(logging.NOTSET)
+    return {**result, "pages": args.pages, "pages_per_second": round(args.pages / result["median_us"] * 1e6)}
+
+@benchmark
+def table_to_html(args, workdir):
+    from azure.ai.formrecognizer import DocumentTable, DocumentTableCell
+    from FlaskApp.cog_services import table_to_html
+    rows, columns = 40, 8
+    cells = [DocumentTableCell(kind="columnHeader" if row == 0 else "content", row_index=row, column_index=column, row_span=1, column_span=1,
+                               content=f"Tier {row}" if column == 0 else f"${row * column * 10} <copay>", bounding_regions=[], spans=[])
+             for row in range(rows) for column in range(columns)]
+    random.Random(0).shuffle(cells)
+    table = DocumentTable(row_count=rows, column_count=columns, cells=cells, bounding_regions=[], spans=[])
+    return {**measure(lambda: table_to_html(table), args.seconds), "cells": rows * columns}
+
+@benchmark
+def pandas_lookup(args, workdir):
+    # Exact names, unique prefixes and misses against a synthetic directory of --employees rows
+    from FlaskApp.lookuptool import pandas_lookup
+    filename = os.path.join(workdir, "employees.csv")
+    with open(filename, "w") as f:
+        f.write("name,title,insurance,insurancegroup\n")
+        for i in range(args.employees):
+            f.write(f"Employee{i},Engineer {i % 7},Northwind Health Plus,{'Family' if i % 2 else 'Single'}\n")
+    queries = [f"employee{i * 7919 % args.employees}" for i in range(50)] + [f"employee{args.employees - 1}"[:-1] + "x", "nobody"]
+    pandas_lookup.func(queries[0], filename)
+    position = [0]
+    def lookup():
+        position[0] = (position[0] + 1) % len(queries)
+        return pandas_lookup.func(queries[position[0]], filename)
+    return {**measure(lookup, args.seconds), "rows": args.employees}
+
+@benchmark
+def rate_limiter(args, workdir):
+    # Admission throughput with limits that never delay, from several threads at once
+    from FlaskApp.ratelimit import RateLimiter
+    limiter = RateLimiter(10 ** 12, 10 ** 9)
+    threads, calls = 8, 20000
+    def work():
+        for _ in range(calls):
+            limiter.acquire("endpoint", "deployment", 500)
+    start = time.perf_counter()
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - start
+    return {"threads": threads, "calls": threads * calls, "calls_per_second": round(threads * calls / seconds), **measure(lambda: limiter.acquire("endpoint", "deployment", 500), args.seconds)}
+
+@benchmark
+def local_search(args, workdir):
+    from FlaskApp.localsearch import LocalSearchClient
+    client = LocalSearchClient(os.path.join(workdir, "local-search-benchmark"))
+    client.upload_documents(sample_sections(args.sections))
+    start = time.perf_counter()
+    client.rebuild()
+    build_seconds = time.perf_counter() - start
+    queries = ["deductible for dental", "pharmacy network costs", "maternity hospital claims", "the plan covers employee family", "vision"]
+    position = [0]
+    def search():
+        position[0] = (position[0] + 1) % len(queries)
+        return list(client.search(queries[position[0]], filter="category ne 'other'", top=3, query_caption="extractive|highlight-false"))
+    return {**measure(search, args.seconds), "sections": args.sections, "build_seconds": round(build_seconds, 2)}
+
+@benchmark
+def index_sections(args, workdir):
+    # Sections per second sent to the fake search index in batches, including the batching and its retry handling
+    from FlaskApp.clients import AZURE_SEARCH_INDEX
+    from FlaskApp.cog_services import create_search_index, index_sections
+    create_search_index(AZURE_SEARCH_INDEX)
+    sections = [{**s, "id": f"index-benchmark-{s['id']}"} for s in sample_sections(args.sections)]
+    logging.disable(logging.INFO)
+    try:
+        start = time.perf_counter()
+        summary = index_sections("index-benchmark.pdf", iter(sections), AZURE_SEARCH_INDEX)
+        seconds = time.perf_counter() - start
+    finally:
+        logging.disable(logging.NOTSET)
+    return {"sections": len(sections), "batches": summary["batches"], "failed": len(summary["failed"]), "seconds": round(seconds, 2),
+            "sections_per_second": round(len(sections) / seconds)}
+
+@benchmark
+def agent_setup(args, workdir):
+    # Building the read-retrieve-read agent for a request, cached per overrides against built every time
+    from FlaskApp import ask_approaches
+    impl = ask_approaches["rrr"]
+    cached = measure(lambda: impl.get_agent(None, None, 0.3), args.seconds)
+    built = measure(lambda: impl.get_agent.__wrapped__(impl, None, None, 0.3), args.seconds)
+    return {"cached_median_us": cached["median_us"], "built_median_us": built["median_us"], "built_p99_us": built["p99_us"]}
+
+@benchmark
+def agent_tools(args, workdir):
+    # A search tool call an agent repeats within a request is answered from the request's memo
+    from FlaskApp.approaches.agentrun import AgentRunState, tool_results
+    state = AgentRunState({}, "benchmark", {"search": lambda q: time.sleep(0.002) or f"results for {q}"})
+    tool_results.clear()
+    first = measure(lambda: (state.memo.clear(), tool_results.clear(), state.call_tool("search", "dental deductible")), args.seconds / 2)
+    repeated = measure(lambda: state.call_tool("search", "Dental  deductible"), args.seconds / 2)
+    return {"search_median_us": first["median_us"], "memo_median_us": repeated["median_us"], "counters": state.report()}
+
+@benchmark
+def content_memory(args, workdir):
+    # Peak memory used by streaming a blob larger than the content cache keeps in memory. The fake storage serves it
+    # from this process, so its buffers for the ranges in flight are included.
+    from FlaskApp import content_cache
+    from FlaskApp.clients import AZURE_STORAGE_CONTAINER, CONTENT_CHUNK_BYTES
+    size = args.blob_mb * 1024 * 1024
+    path = "content-memory-benchmark.pdf"
+    backends.blob.put(AZURE_STORAGE_CONTAINER, path, os.urandom(1024) * (size // 1024), "application/pdf")
+    tracemalloc.start()
+    start = time.perf_counter()
+    streamed = 0
+    f = content_cache.open(path)
+    try:
+        while True:
+            chunk = f.read(CONTENT_CHUNK_BYTES)
+            if not chunk:
+                break
+            streamed += len(chunk)
+    finally:
+        f.close()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"blob_mb": args.blob_mb, "streamed_mb": round(streamed / 2 ** 20, 1), "peak_mb": round(peak / 2 ** 20, 1), "mb_per_second": round(streamed / 2 ** 20 / seconds, 1)}
+
+@benchmark
+def tracing(args, workdir):
+    # Span cost with and without an active trace, and the stages an /ask request records
+    from FlaskApp import app
+    from FlaskApp.tracing import span, start_trace
+    untraced = measure(lambda: span("stage").__enter__().__exit__(None, None, None), args.seconds / 2)
+    def traced():
+        with start_trace("request"):
+            for _ in range(10):
+                with span("stage"):
+                    pass
+    traced = measure(traced, args.seconds / 2)
+    r = app.test_client().post("/api/ask", json={"approach": "rtr", "question": "What is the deductible?", "overrides": {"include_timings": True}})
+    spans = [(s["name"], s["depth"]) for s in r.get_json()["timings"]["spans"]]
+    return {"untraced_span_us": untraced["median_us"], "traced_span_us": round(traced["median_us"] / 11, 2), "ask_spans": spans}
+
+@benchmark
+def metrics(args, workdir):
+    from FlaskApp.metrics import Counter, Histogram, registry
+    counter = Counter("benchmark_total", "", ["route"])
+    histogram = Histogram("benchmark_seconds", "", ["route"])
+    inc = measure(lambda: counter.inc("/api/ask"), args.seconds / 3)
+    observe = measure(lambda: histogram.observe(0.2, "/api/ask"), args.seconds / 3)
+    render = measure(registry.render, args.seconds / 3)
+    return {"inc_us": inc["median_us"], "observe_us": observe["median_us"], "render_us": render["median_us"]}
+
+backends = None
+
+def main(argv=None):
+    global backends
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.micro", description="Microbenchmarks of the backend's hot functions")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run, all by default: {', '.join(benchmarks)}")
+    parser.add_argument("--seconds", type=float, default=1.0, help="time spent on each measurement")
+    parser.add_argument("--pages", type=int, default=50, help="pages of the documents split and assembled")
+    parser.add_argument("--employees", type=int, default=10000)
+    parser.add_argument("--sections", type=int, default=20000)
+    parser.add_argument("--blob-mb", type=int, default=64)
+    parser.add_argument("--json", action="store_true", help="print one JSON line per benchmark")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in benchmarks]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    logging.basicConfig(level=logging.WARNING)
+    backends = FakeBackends(documents=sample_sections(1000)).start()
+    workdir = configure(backends)
+    for name in args.names or benchmarks:
+        result = benchmarks[name](args, workdir)
+        if args.json:
+            print(json.dumps({"benchmark": name, **result}), flush=True)
+        else:
+            print(f"{name:>16}: " + ", ".join(f"{key}={value}" for key, value in result.items()), flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import pytest
+
+from benchmarks import configure
+from benchmarks.fakes import FakeBackends, sample_sections
+
+# The tests run against the local fakes of the Azure services in benchmarks/fakes.py, from app/backend with
+#   python -m pytest tests
+# FlaskApp reads its settings when it is imported, so the fakes are started and the environment pointed at them
+# here, before any test module imports it.
+
+backends = FakeBackends(documents=sample_sections(200)).start()
+workdir = configure(backends)
+
+@pytest.fixture
+def fakes():
+    for service in backends.services:
+        service.calls.clear()
+    return backends
+
+@pytest.fixture
+def client(fakes):
+    from FlaskApp import app
+    from FlaskApp.cache import invalidate_index_caches
+    # Answers, tool results and content cached by an earlier test would hide the calls a test expects
+    invalidate_index_caches()
+    return app.test_client()
@@ -0,0 +1,17 @@
+from FlaskApp.approaches.agentrun import AgentRunState, tool_results
+
+def test_prefetch_leaves_the_tool_cache_counters_alone():
+    searched = []
+    state = AgentRunState({}, "prefetch-test", {"search": lambda q: searched.append(q) or f"results for {q}"})
+    tool_results.clear()
+    tool_results.set(state.scope + ("search", "dental"), ("cached results",))
+    hits, misses = tool_results.hits, tool_results.misses
+    state.prefetch("search", ["Dental", "vision"])
+    for future, _ in list(state.memo.values()):
+        future.result()
+    assert searched == ["vision"]
+    assert state.counters["prefetched"] == 1
+    # The prefetched search itself looks up the cache once before searching
+    assert (tool_results.hits, tool_results.misses) == (hits, misses + 1)
+    assert state.call_tool("search", "vision") == "results for vision"
+    assert state.counters["prefetch_hits"] == 1
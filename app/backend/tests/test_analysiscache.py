@@ -0,0 +1,91 @@
+import os
+import threading
+from types import SimpleNamespace
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from FlaskApp.analysiscache import AnalysisCache
+
+class MemoryContainer:
+    # The parts of a ContainerClient that AnalysisCache uses
+    def __init__(self):
+        self.blobs = {}
+        self.downloads = 0
+
+    def upload_blob(self, name, data, overwrite=False):
+        self.blobs[name] = data
+
+    def download_blob(self, name):
+        self.downloads += 1
+        if name not in self.blobs:
+            raise ResourceNotFoundError(f"{name} not found")
+        return SimpleNamespace(readall=lambda: self.blobs[name])
+
+def result(i: int, size: int = 100) -> dict:
+    # Incompressible enough that entries take up about size bytes
+    return {"content": os.urandom(size).hex(), "page": i}
+
+def test_hits_and_misses(tmp_path):
+    cache = AnalysisCache(str(tmp_path), 1024 * 1024)
+    key = cache.key("document-hash", "prebuilt-layout")
+    assert key != cache.key("document-hash", "prebuilt-layout", "1-3")
+    assert cache.get(key) is None
+    cache.put(key, result(1))
+    assert cache.get(key)["page"] == 1
+    assert os.listdir(tmp_path) == [key + ".json.z"]
+
+def test_corrupt_entries_are_discarded(tmp_path):
+    cache = AnalysisCache(str(tmp_path), 1024 * 1024)
+    with open(cache.entry_path("corrupt"), "wb") as f:
+        f.write(b"not zlib")
+    assert cache.get("corrupt") is None
+    assert not os.path.exists(cache.entry_path("corrupt"))
+
+def test_local_misses_fall_back_to_the_container(tmp_path):
+    container = MemoryContainer()
+    AnalysisCache(str(tmp_path / "first"), 1024 * 1024, container).put("key", result(1))
+    assert list(container.blobs) == ["key"]
+    # Another instance without the entry locally gets it from the container, then keeps a local copy
+    cache = AnalysisCache(str(tmp_path / "second"), 1024 * 1024, container)
+    assert cache.get("key")["page"] == 1
+    assert cache.get("key")["page"] == 1
+    assert container.downloads == 1
+    assert cache.get("missing") is None
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = AnalysisCache(str(tmp_path), 600)
+    for i in range(3):
+        cache.put(f"key-{i}", result(i))
+        os.utime(cache.entry_path(f"key-{i}"), (i, i))
+    cache.get("key-0")
+    cache.put("key-3", result(3, 300))
+    # key-1 was used least recently
+    assert cache.get("key-1") is None
+    assert cache.get("key-0") is not None and cache.get("key-3") is not None
+    assert cache.size == sum(os.path.getsize(os.path.join(tmp_path, name)) for name in os.listdir(tmp_path))
+    assert cache.size <= 600
+
+def test_directory_is_only_scanned_when_over_the_limit(tmp_path, monkeypatch):
+    cache = AnalysisCache(str(tmp_path), 100 * 1024)
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(1) or evict())
+    for i in range(20):
+        cache.put(f"key-{i}", result(i))
+    # Once to learn the size of the directory
+    assert len(scans) == 1
+    for i in range(20, 200):
+        cache.put(f"key-{i}", result(i, 1000))
+    assert 1 < len(scans) < 180
+    assert cache.size <= 100 * 1024
+
+def test_concurrent_writes_of_an_entry_leave_no_temporary_files(tmp_path):
+    cache = AnalysisCache(str(tmp_path), 1024 * 1024)
+    data = [result(i) for i in range(8)]
+    threads = [threading.Thread(target=lambda r=r: [cache.put("key", r) for _ in range(20)]) for r in data]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert os.listdir(tmp_path) == ["key.json.z"]
+    assert cache.get("key") in data
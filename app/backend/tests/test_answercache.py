@@ -0,0 +1,22 @@
+import pytest
+
+from FlaskApp.answercache import AnswerCache
+from FlaskApp.clients import override_temperature
+
+@pytest.mark.parametrize("overrides, cacheable", [({}, False), ({"temperature": None}, False), ({"temperature": 0.3}, False),
+                                                  ({"temperature": 0}, True), ({"temperature": 0.0}, True), ({"temperature": "0"}, True),
+                                                  ({"temperature": "warm"}, False), ({"temperature": [0]}, False)])
+def test_only_temperature_zero_is_cacheable(overrides, cacheable):
+    assert AnswerCache(10, 60).cacheable(overrides) is cacheable
+
+def test_explicit_zero_temperature_is_sent():
+    assert override_temperature({"temperature": 0}, 0.3) == 0
+    assert override_temperature({"temperature": None}, 0.3) == 0.3
+    assert override_temperature({}, 0.3) == 0.3
+
+@pytest.mark.parametrize("overrides, completions", [({}, 2), ({"temperature": 0.3}, 2), ({"temperature": 0}, 1)])
+def test_ask_bypasses_cache_unless_deterministic(client, fakes, overrides, completions):
+    for _ in range(2):
+        r = client.post("/api/ask", json={"approach": "rtr", "question": "What is the deductible?", "overrides": overrides})
+        assert r.status_code == 200
+    assert fakes.openai.calls["completions"] == completions
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+import azure.functions as func
+import pytest
+
+from FlaskApp import aio, app, ask_approaches, asgi_app, chat_approaches
+from FlaskApp.aio import EventLoopThread, close_loop_local, event_loop, loop_local
+from FlaskApp.asgi import AsgiAdapter
+
+QUESTION = "What is the deductible?"
+
+def post(url: str, body: dict) -> func.HttpRequest:
+    return func.HttpRequest("POST", url, headers={"Content-Type": "application/json"}, body=json.dumps(body).encode())
+
+async def handle(adapter, request: func.HttpRequest) -> func.HttpResponse:
+    return await func.AsgiMiddleware(adapter).handle_async(request)
+
+def run(coroutine):
+    # Runs on a loop of its own, closing the sessions the requests opened on it as the host does on shutdown
+    async def served():
+        try:
+            return await coroutine
+        finally:
+            await close_loop_local()
+    return asyncio.run(served())
+
+def test_ask_through_the_functions_host_middleware(client):
+    r = run(handle(asgi_app, post("http://localhost/api/ask", {"approach": "rtr", "question": QUESTION, "overrides": {}})))
+    assert r.status_code == 200
+    answer = json.loads(r.get_body())
+    # The same answer as the WSGI app gives
+    assert answer == client.post("/api/ask", json={"approach": "rtr", "question": QUESTION, "overrides": {}}).get_json()
+    assert answer["data_points"] and answer["answer"]
+
+def test_sync_views_and_streams_run_in_the_thread_pool(client):
+    async def requests():
+        stream = await handle(asgi_app, post("http://localhost/api/chat/stream", {"approach": "rrr", "history": [{"user": QUESTION}], "overrides": {}}))
+        missing = await handle(asgi_app, func.HttpRequest("GET", "http://localhost/api/upload/missing", body=b""))
+        unknown = await handle(asgi_app, post("http://localhost/api/ask", {"approach": "nope", "question": QUESTION, "overrides": {}}))
+        return stream, missing, unknown
+    stream, missing, unknown = run(requests())
+    assert stream.status_code == 200 and stream.mimetype.startswith("text/event-stream")
+    events = [line[len("event: "):] for line in stream.get_body().decode().split("\n") if line.startswith("event: ")]
+    assert events[0] == "data_points" and events[-1] == "end"
+    assert missing.status_code == 404 and json.loads(missing.get_body()) == {"error": "unknown job"}
+    assert unknown.status_code == 400
+
+def test_async_views_run_on_the_host_loop_without_a_thread(client, monkeypatch):
+    # Ten slow answers at once with a single thread in the pool, which they would each hold under WSGI
+    loops = []
+    async def arun(q, overrides):
+        loops.append(asyncio.get_running_loop())
+        await asyncio.sleep(0.3)
+        return {"data_points": [], "answer": q, "thoughts": ""}
+    monkeypatch.setattr(ask_approaches["rtr"], "arun", arun)
+    adapter = AsgiAdapter(app, threads=1)
+    async def requests():
+        start = time.monotonic()
+        responses = await asyncio.gather(*(handle(adapter, post("http://localhost/api/ask", {"approach": "rtr", "question": f"Question {i}?", "overrides": {}}))
+                                           for i in range(10)))
+        return responses, time.monotonic() - start, asyncio.get_running_loop()
+    responses, seconds, loop = run(requests())
+    assert [json.loads(r.get_body())["answer"] for r in responses] == [f"Question {i}?" for i in range(10)]
+    assert seconds < 1.5
+    assert loops == [loop] * 10
+
+def test_shutdown_closes_the_sessions_of_the_loop(client):
+    async def shutdown():
+        lifespan = asyncio.Queue()
+        sent = []
+        async def send(message):
+            sent.append(message["type"])
+        await lifespan.put({"type": "lifespan.startup"})
+        await lifespan.put({"type": "lifespan.shutdown"})
+        r = await handle(asgi_app, post("http://localhost/api/chat", {"approach": "rrr", "history": [{"user": QUESTION}], "overrides": {}}))
+        loop = asyncio.get_running_loop()
+        session = aio.loop_values[loop]["openai_aiosession"]
+        await AsgiAdapter(app).lifespan(lifespan.get, send)
+        return r, session, loop, sent
+    r, session, loop, sent = asyncio.run(shutdown())
+    assert r.status_code == 200
+    assert session.closed
+    assert loop not in aio.loop_values
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+
+def test_stopping_the_event_loop_thread_closes_its_sessions():
+    thread = EventLoopThread("test-loop")
+    async def session():
+        return loop_local("session", aiohttp.ClientSession)
+    first = thread.run(session())
+    assert thread.run(session()) is first
+    thread.stop()
+    assert first.closed
+    # A later call starts a new loop with sessions of its own
+    second = thread.run(session())
+    assert second is not first and not second.closed
+    thread.stop()
+
+@pytest.mark.parametrize("approach", ["rtr"])
+def test_async_ask_matches_the_sync_one(fakes, approach):
+    impl = ask_approaches[approach]
+    overrides = {"top": 3}
+    assert event_loop.run(impl.aretrieve(QUESTION, overrides)) == impl.retrieve(QUESTION, overrides)
+    assert event_loop.run(impl.arun(QUESTION, overrides)) == impl.run(QUESTION, overrides)
+
+def test_async_chat_matches_the_sync_one(fakes):
+    impl = chat_approaches["rrr"]
+    history = [{"user": "Does my plan cover eye exams?", "bot": "Yes [Benefit_Options-2.pdf]."}, {"user": QUESTION}]
+    overrides = {"top": 3, "suggest_followup_questions": True}
+    assert event_loop.run(impl.aretrieve(QUESTION, overrides)) == impl.retrieve(QUESTION, overrides)
+    assert event_loop.run(impl.arun(history, overrides)) == impl.run(history, overrides)
+    # With speculative retrieval the question's results are merged with the rewritten query's
+    speculative = event_loop.run(impl.arun(history, {**overrides, "speculative_retrieval": True}))
+    assert speculative["answer"] and len(speculative["data_points"]) <= 3
@@ -0,0 +1,59 @@
+import asyncio
+import json
+
+from FlaskApp.answercache import AnswerCache
+from FlaskApp.batch import answer_batch
+
+class SlowApproach:
+    # Answers each question after the delay in its text, failing those that start with "fail"
+    def __init__(self):
+        self.calls = []
+
+    async def arun(self, q: str, overrides: dict) -> dict:
+        self.calls.append(q)
+        await asyncio.sleep(float(q.split()[-1]))
+        if q.startswith("fail"):
+            raise ValueError(f"no answer for {q}")
+        return {"answer": q.upper()}
+
+class FailingCountCache(AnswerCache):
+    def count(self, **counts):
+        raise RuntimeError("statistics are unavailable")
+
+def collect(lines) -> list:
+    async def run():
+        return [line async for line in lines]
+    return asyncio.run(asyncio.wait_for(run(), 5))
+
+def test_lines_in_completion_order_with_per_question_errors():
+    impl = SlowApproach()
+    questions = ["slow 0.2", "fail 0.1", "fast 0", "slow 0.2 ", "fail 0.3"]
+    lines = collect(answer_batch(impl, "rtr", questions, {}, concurrency=8))
+    assert lines == [
+        {"index": 2, "question": "fast 0", "answer": "FAST 0"},
+        {"index": 1, "question": "fail 0.1", "error": "no answer for fail 0.1"},
+        # A repeated question is answered once, with a line for each of its positions
+        {"index": 0, "question": "slow 0.2", "answer": "SLOW 0.2"},
+        {"index": 3, "question": "slow 0.2 ", "answer": "SLOW 0.2"},
+        {"index": 4, "question": "fail 0.3", "error": "no answer for fail 0.3"}]
+    assert sorted(impl.calls) == ["fail 0.1", "fail 0.3", "fast 0", "slow 0.2"]
+
+def test_scheduling_failure_fails_every_question_instead_of_hanging():
+    questions = ["first 0", "second 0"]
+    lines = collect(answer_batch(SlowApproach(), "rtr", questions, {}, FailingCountCache(10, 60)))
+    assert sorted(lines, key=lambda line: line["index"]) == [
+        {"index": 0, "question": "first 0", "error": "statistics are unavailable"},
+        {"index": 1, "question": "second 0", "error": "statistics are unavailable"}]
+
+def test_batch_route_streams_a_line_per_question(client, monkeypatch):
+    from FlaskApp import ask_approaches
+    monkeypatch.setitem(ask_approaches, "slow", SlowApproach())
+    r = client.post("/api/ask/batch", json={"approach": "slow", "questions": ["later 0.1", "fail 0", "now 0"], "overrides": {}})
+    assert r.status_code == 200
+    assert r.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    assert [line["index"] for line in lines][-1] == 0
+    assert sorted(lines, key=lambda line: line["index"]) == [
+        {"index": 0, "question": "later 0.1", "answer": "LATER 0.1"},
+        {"index": 1, "question": "fail 0", "error": "no answer for fail 0"},
+        {"index": 2, "question": "now 0", "answer": "NOW 0"}]
@@ -0,0 +1,76 @@
+import io
+import os
+import threading
+
+from pypdf import PdfReader
+
+from benchmarks.load import sample_pdf
+from FlaskApp.cog_services import remove_blobs, upload_blobs
+
+from .conftest import workdir
+
+class MemoryContainer:
+    # The parts of a ContainerClient that uploading and removing blobs use, keeping the blobs in a dict
+    def __init__(self, name: str, fail=()):
+        self.container_name = name
+        self.blobs = {}
+        self.fail = set(fail)
+        self.created = False
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return self.created
+
+    def create_container(self):
+        self.created = True
+
+    def upload_blob(self, name, data, overwrite=False):
+        if name in self.fail:
+            raise IOError(f"upload of {name} failed")
+        with self.lock:
+            self.blobs[name] = data.read()
+
+    def list_blob_names(self, name_starts_with=""):
+        return [name for name in list(self.blobs) if name.startswith(name_starts_with)]
+
+    def delete_blobs(self, *names):
+        for name in names:
+            self.delete_blob(name)
+
+    def delete_blob(self, name):
+        with self.lock:
+            del self.blobs[name]
+
+def write(name: str, data: bytes) -> str:
+    filename = os.path.join(workdir, name)
+    with open(filename, "wb") as f:
+        f.write(data)
+    return filename
+
+def test_pdf_pages_are_uploaded_as_single_page_blobs():
+    container = MemoryContainer("upload-pages")
+    progress = []
+    result = upload_blobs(write("Benefit Options.pdf", sample_pdf(5, "pages")), container, concurrency=2, progress=lambda *p: progress.append(p))
+    assert result == {"uploaded": 5, "failed": {}}
+    assert container.created
+    assert sorted(container.blobs) == [f"Benefit_Options-{i}.pdf" for i in range(5)]
+    assert all(len(PdfReader(io.BytesIO(data)).pages) == 1 for data in container.blobs.values())
+    assert progress[0] == ("upload_blobs", 0, 5) and progress[-1] == ("upload_blobs", 5, 5)
+
+def test_only_the_given_pages_are_uploaded_and_failures_reported():
+    container = MemoryContainer("upload-changed", fail=["Changed-3.pdf"])
+    result = upload_blobs(write("Changed.pdf", sample_pdf(6, "changed")), container, pages=[1, 3, 4])
+    assert result == {"uploaded": 2, "failed": {"Changed-3.pdf": "upload of Changed-3.pdf failed"}}
+    assert sorted(container.blobs) == ["Changed-1.pdf", "Changed-4.pdf"]
+
+def test_other_files_are_uploaded_whole():
+    container = MemoryContainer("upload-text")
+    assert upload_blobs(write("notes.txt", b"plain text"), container) == {"uploaded": 1, "failed": {}}
+    assert container.blobs == {"notes.txt": b"plain text"}
+
+def test_remove_blobs_removes_only_the_pages_of_the_file():
+    container = MemoryContainer("remove")
+    upload_blobs(write("Plan.pdf", sample_pdf(3, "plan")), container)
+    container.blobs.update({"Plan_B-0.pdf": b"", "Plan-0.pdf.bak": b""})
+    assert remove_blobs(os.path.join(workdir, "Plan.pdf"), container) == {"removed": 3, "failed": {}}
+    assert sorted(container.blobs) == ["Plan-0.pdf.bak", "Plan_B-0.pdf"]
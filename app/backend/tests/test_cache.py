@@ -0,0 +1,15 @@
+import time
+
+from FlaskApp.cache import TTLCache
+
+def test_membership_honors_ttl_without_counting():
+    cache = TTLCache(10, 0.05)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert "a" in cache and "missing" not in cache
+    assert (cache.hits, cache.misses) == (0, 0)
+    # Not marked as recently used either, so "a" is still the first to go
+    cache.set("c", 3)
+    assert list(cache.entries) == ["a", "b", "c"]
+    time.sleep(0.06)
+    assert "a" not in cache
@@ -0,0 +1,62 @@
+import asyncio
+import threading
+
+import pytest
+
+from benchmarks.fakes import FakeOpenAI
+from FlaskApp import clients
+from FlaskApp.aio import event_loop
+from FlaskApp.endpoints import Endpoint, EndpointPool
+from FlaskApp.ratelimit import RateLimiter
+
+class RecordingOpenAI(FakeOpenAI):
+    # Records the api-key header of every request it serves
+    def __init__(self):
+        super().__init__()
+        self.keys = []
+
+    def handle(self, request):
+        with self.lock:
+            self.keys.append(request.headers.get("api-key"))
+        return super().handle(request)
+
+@pytest.fixture
+def endpoints(monkeypatch):
+    services = [RecordingOpenAI().start() for _ in range(3)]
+    pool = EndpointPool([Endpoint(f"openai-{i}", service.url, f"key-{i}") for i, service in enumerate(services)])
+    monkeypatch.setattr(clients, "openai_endpoints", pool)
+    monkeypatch.setattr(clients, "rate_limiter", RateLimiter(0, 0))
+    yield services
+    for service in services:
+        service.stop()
+
+def test_concurrent_calls_send_each_endpoint_its_own_key(endpoints):
+    errors = []
+    def work(i):
+        try:
+            for j in range(10):
+                if j % 2:
+                    clients.embedding_client(f"question {i} {j}", "embedding")
+                else:
+                    clients.completion_client(f"Question: {i} {j}", 16, 0.0, 1, None, "davinci")
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert sum(len(service.keys) for service in endpoints) == 160
+    # Every endpoint served some of the calls, so the keys were checked on all of them
+    assert all(service.keys for service in endpoints)
+    for i, service in enumerate(endpoints):
+        assert set(service.keys) <= {f"key-{i}"}
+
+def test_concurrent_async_calls_send_each_endpoint_its_own_key(endpoints):
+    async def work():
+        await asyncio.gather(*(clients.acompletion_client(f"Question: {i}", 16, 0.0, 1, None, "davinci") for i in range(60)))
+    event_loop.run(work())
+    assert sum(len(service.keys) for service in endpoints) == 60
+    for i, service in enumerate(endpoints):
+        assert set(service.keys) <= {f"key-{i}"}
@@ -0,0 +1,106 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+import FlaskApp
+from FlaskApp.cache import invalidate_index_caches
+from FlaskApp.contentcache import ContentCache
+
+class MemoryBlobs:
+    # The parts of a ContainerClient that ContentCache uses, serving blobs from a dict and recording every call
+    def __init__(self, blobs: dict):
+        self.blobs = blobs
+        self.calls = []
+
+    def get_blob_client(self, path: str):
+        return MemoryBlob(self, path)
+
+class MemoryBlob:
+    def __init__(self, container: MemoryBlobs, path: str):
+        self.container = container
+        self.path = path
+
+    def properties(self):
+        if self.path not in self.container.blobs:
+            raise ResourceNotFoundError(f"{self.path} not found")
+        data = self.container.blobs[self.path]
+        return SimpleNamespace(size=len(data), etag=f'"etag-{len(data)}"', last_modified=datetime(2023, 5, 1, tzinfo=timezone.utc),
+                               content_settings=SimpleNamespace(content_type="application/octet-stream"))
+
+    def get_blob_properties(self):
+        self.container.calls.append(("properties", self.path))
+        return self.properties()
+
+    def download_blob(self, offset: int = 0, length: int = None):
+        self.container.calls.append(("download", self.path, offset, length))
+        properties = self.properties()
+        data = self.container.blobs[self.path]
+        data = data[offset:] if length is None else data[offset:offset + length]
+        return SimpleNamespace(readall=lambda: data, properties=properties)
+
+SMALL = bytes(range(256)) * 4
+LARGE = bytes(range(256)) * 64
+
+@pytest.fixture
+def storage(client, monkeypatch):
+    storage = MemoryBlobs({"Small-0.pdf": SMALL, "Large-0.pdf": LARGE})
+    # Blobs up to 2 KB are kept in memory, larger ones are streamed in 1 KB chunks
+    monkeypatch.setattr(FlaskApp, "content_cache", ContentCache(storage, 64 * 1024, 2048, 60, 1024))
+    monkeypatch.setattr(FlaskApp, "CONTENT_CHUNK_BYTES", 1024)
+    return storage
+
+def test_content_is_served_with_validators(client, storage):
+    r = client.get("/api/content/Small-0.pdf")
+    assert r.status_code == 200
+    assert r.data == SMALL
+    assert r.mimetype == "application/pdf"
+    assert r.headers["ETag"] == '"etag-1024"'
+    assert r.headers["Content-Length"] == "1024"
+
+@pytest.mark.parametrize("path", ["Small-0.pdf", "Large-0.pdf"])
+def test_matching_etag_is_not_modified(client, storage, path):
+    etag = client.get(f"/api/content/{path}").headers["ETag"]
+    r = client.get(f"/api/content/{path}", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.data == b""
+    r = client.get(f"/api/content/{path}", headers={"If-Modified-Since": "Mon, 01 May 2023 00:00:00 GMT"})
+    assert r.status_code == 304
+    assert client.get(f"/api/content/{path}", headers={"If-None-Match": '"other"'}).status_code == 200
+
+@pytest.mark.parametrize("path", ["Small-0.pdf", "Large-0.pdf"])
+def test_range_is_partial_content(client, storage, path):
+    data = storage.blobs[path]
+    r = client.get(f"/api/content/{path}", headers={"Range": "bytes=100-899"})
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == f"bytes 100-899/{len(data)}"
+    assert r.headers["Content-Length"] == "800"
+    assert r.data == data[100:900]
+    r = client.get(f"/api/content/{path}", headers={"Range": "bytes=-10"})
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == f"bytes {len(data) - 10}-{len(data) - 1}/{len(data)}"
+    assert r.data == data[-10:]
+
+def test_large_blob_range_downloads_only_that_range(client, storage):
+    # Read in whole chunks from the start of the range
+    r = client.get("/api/content/Large-0.pdf", headers={"Range": "bytes=5000-6499"})
+    assert r.status_code == 206 and r.data == LARGE[5000:6500]
+    downloads = [call for call in storage.calls if call[0] == "download"]
+    assert downloads == [("download", "Large-0.pdf", 5000, 1024), ("download", "Large-0.pdf", 6024, 1024)]
+
+def test_missing_blob_is_not_found(client, storage):
+    assert client.get("/api/content/Missing-0.pdf").status_code == 404
+    assert storage.calls == [("properties", "Missing-0.pdf")]
+
+def test_cache_hit_makes_no_storage_call(client, storage):
+    assert client.get("/api/content/Small-0.pdf").data == SMALL
+    calls = len(storage.calls)
+    assert client.get("/api/content/Small-0.pdf").data == SMALL
+    assert client.get("/api/content/Small-0.pdf", headers={"Range": "bytes=0-9"}).data == SMALL[:10]
+    assert len(storage.calls) == calls
+    assert FlaskApp.content_cache.entries.hits == 2
+    # Ingestion rewrites page blobs, so the entries go when it changes the index
+    invalidate_index_caches()
+    client.get("/api/content/Small-0.pdf")
+    assert len(storage.calls) > calls
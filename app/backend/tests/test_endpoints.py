@@ -0,0 +1,156 @@
+import asyncio
+import socket
+import threading
+import time
+
+import openai
+import pytest
+
+from benchmarks.fakes import FakeOpenAI
+from FlaskApp.clients import azure_openai_params
+from FlaskApp.endpoints import Endpoint, EndpointPool
+from FlaskApp.ratelimit import RateLimiter, RateLimitExceeded
+
+class StubOpenAI(FakeOpenAI):
+    # Answers with the given (status, headers) failures first, then like the fake
+    def __init__(self, *failures):
+        super().__init__()
+        self.failures = list(failures)
+        self.requests = 0
+
+    def handle(self, request):
+        with self.lock:
+            self.requests += 1
+            failure = self.failures.pop(0) if self.failures else None
+        if failure is not None:
+            return self.error(*failure)
+        return super().handle(request)
+
+@pytest.fixture
+def stubs():
+    started = []
+    def start(*failures):
+        stub = StubOpenAI(*failures).start()
+        started.append(stub)
+        return stub
+    yield start
+    # Each shutdown waits for its server's next poll, so stop them together
+    threads = [threading.Thread(target=stub.stop) for stub in started]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def endpoint(name: str, url: str) -> Endpoint:
+    return Endpoint(name, url, f"{name}-key")
+
+def complete(e: Endpoint):
+    return openai.Completion.create(engine="davinci", prompt="Question: What is the deductible?", max_tokens=16, **azure_openai_params(e))
+
+def unreachable_url() -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}"
+
+def pool_of(*endpoints, **kwargs) -> EndpointPool:
+    pool = EndpointPool(list(endpoints), **kwargs)
+    # Later endpoints look slower, so the first is chosen first
+    for i, e in enumerate(endpoints):
+        e.latency = float(i)
+    return pool
+
+@pytest.mark.parametrize("status, headers, cooldown", [(429, {"Retry-After": "7"}, 7), (429, {"retry-after-ms": "2500"}, 2.5), (503, {}, 10), (500, {}, 10)])
+def test_fails_over_on_throttling_and_server_errors(stubs, status, headers, cooldown):
+    first, second = stubs((status, headers)), stubs()
+    pool = pool_of(endpoint("first", first.url), endpoint("second", second.url), cooldown=10)
+    assert pool.call(complete).choices[0].text
+    assert (first.requests, second.requests) == (1, 1)
+    failed, served = pool.endpoints
+    assert failed.errors == 1 and failed.consecutive_errors == 1 and failed.error_rate > 0
+    # Retry-After sets the cooldown, otherwise the pool's own
+    assert failed.cooldown_until - time.monotonic() == pytest.approx(cooldown, abs=0.5)
+    assert served.errors == 0 and served.requests == 1
+    assert failed.in_flight == served.in_flight == 0
+
+def test_fails_over_when_an_endpoint_cant_be_reached(stubs):
+    second = stubs()
+    pool = pool_of(endpoint("first", unreachable_url()), endpoint("second", second.url))
+    assert pool.call(complete).choices[0].text
+    assert pool.endpoints[0].errors == 1 and "Connection" in pool.endpoints[0].last_error
+    assert second.requests == 1
+
+def test_request_errors_are_not_failed_over(stubs):
+    first, second = stubs((400, {})), stubs()
+    pool = pool_of(endpoint("first", first.url), endpoint("second", second.url))
+    with pytest.raises(openai.error.InvalidRequestError):
+        pool.call(complete)
+    assert second.requests == 0
+    assert pool.endpoints[0].errors == 0 and pool.endpoints[0].cooldown_until == 0
+
+def test_gives_up_after_max_attempts(stubs):
+    failing = [stubs((503, {})) for _ in range(3)]
+    pool = pool_of(*(endpoint(f"e{i}", s.url) for i, s in enumerate(failing)), max_attempts=2)
+    with pytest.raises(openai.error.ServiceUnavailableError):
+        pool.call(complete)
+    assert [s.requests for s in failing] == [1, 1, 0]
+
+def test_cooling_down_endpoint_is_used_again_once_the_cooldown_expires(stubs):
+    first, second = stubs((503, {})), stubs()
+    pool = pool_of(endpoint("first", first.url), endpoint("second", second.url), cooldown=0.3)
+    pool.call(complete)
+    # While the first cools down every call goes to the second
+    for _ in range(3):
+        pool.call(complete)
+    assert (first.requests, second.requests) == (1, 4)
+    time.sleep(0.35)
+    # The second's latency makes the first the better choice again, and a success clears its error streak
+    pool.endpoints[1].latency = 10.0
+    pool.call(complete)
+    assert first.requests == 2
+    assert pool.endpoints[0].consecutive_errors == 0
+
+def test_consecutive_errors_back_off_exponentially(stubs):
+    first = stubs((503, {}), (503, {}), (503, {}))
+    pool = pool_of(endpoint("first", first.url), cooldown=1, max_cooldown=3)
+    for expected in (1, 2, 3):
+        pool.endpoints[0].cooldown_until = 0
+        with pytest.raises(openai.error.ServiceUnavailableError):
+            pool.call(complete)
+        assert pool.endpoints[0].cooldown_until - time.monotonic() == pytest.approx(expected, abs=0.3)
+
+def test_when_every_endpoint_cools_down_the_one_due_back_first_is_used(stubs):
+    first, second, third = stubs(), stubs(), stubs()
+    pool = pool_of(endpoint("first", first.url), endpoint("second", second.url), endpoint("third", third.url))
+    now = time.monotonic()
+    for e, seconds in zip(pool.endpoints, (30, 5, 60)):
+        e.cooldown_until = now + seconds
+    assert pool.call(complete).choices[0].text
+    assert (first.requests, second.requests, third.requests) == (0, 1, 0)
+
+def test_refused_admission_skips_the_endpoint_without_touching_its_health(stubs):
+    first, second = stubs(), stubs()
+    pool = pool_of(endpoint("first", first.url), endpoint("second", second.url))
+    limiter = RateLimiter(0, 0, {"davinci": {"rpm": 6}}, max_wait=1)
+    # The first endpoint's one request per 10 seconds is used up
+    limiter.acquire("first", "davinci", 1)
+    assert pool.call(complete, admit=lambda e: limiter.acquire(e.name, "davinci", 1)).choices[0].text
+    assert (first.requests, second.requests) == (0, 1)
+    refused = pool.endpoints[0]
+    assert (refused.requests, refused.errors, refused.consecutive_errors, refused.error_rate, refused.cooldown_until, refused.in_flight) == (0, 0, 0, 0.0, 0.0, 0)
+    # Refused by both, the caller gets the limiter's error
+    with pytest.raises(RateLimitExceeded):
+        pool.call(complete, admit=lambda e: limiter.acquire(e.name, "davinci", 1))
+    assert all(e.errors == 0 and e.cooldown_until == 0 and e.in_flight == 0 for e in pool.endpoints)
+    assert second.requests == 1
+
+def test_refused_admission_is_skipped_by_async_calls(stubs):
+    first, second = stubs(), stubs()
+    pool = pool_of(endpoint("first", first.url), endpoint("second", second.url))
+    async def admit(e):
+        if e.name == "first":
+            raise RateLimitExceeded("rate limited", 5)
+    async def acomplete(e):
+        return complete(e)
+    assert asyncio.run(pool.acall(acomplete, admit=admit)).choices[0].text
+    assert (first.requests, second.requests) == (0, 1)
+    assert pool.endpoints[0].errors == 0 and pool.endpoints[0].cooldown_until == 0
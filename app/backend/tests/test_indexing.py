@@ -0,0 +1,97 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+from azure.core.exceptions import HttpResponseError
+
+from FlaskApp import cog_services
+from FlaskApp.cog_services import index_sections, list_section_ids
+
+class ThrottlingSearchClient:
+    # Answers upload_documents with results shaped like the search client's IndexingResult, failing the chosen keys
+    # with the given status codes in turn (e.g. [429, 503] fails the first two attempts). The statuses of "*" fail
+    # whole requests instead.
+    def __init__(self, statuses: dict):
+        self.statuses = {key: list(codes) for key, codes in statuses.items()}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def upload_documents(self, documents):
+        with self.lock:
+            self.calls.append([d["id"] for d in documents])
+            if self.statuses.get("*"):
+                raise self.batch_error(self.statuses["*"].pop(0))
+            results = []
+            for d in documents:
+                codes = self.statuses.get(d["id"])
+                status = codes.pop(0) if codes else 201
+                results.append(SimpleNamespace(key=d["id"], succeeded=status == 201, status_code=status, error_message=None if status == 201 else f"status {status}"))
+            return results
+
+    @staticmethod
+    def batch_error(status: int) -> HttpResponseError:
+        e = HttpResponseError(message=f"status {status}")
+        e.status_code = status
+        return e
+
+def sections(count: int):
+    return [{"id": f"doc-{i}", "content": f"Section {i}.", "sourcefile": "Retry_Test.pdf"} for i in range(count)]
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(cog_services.time, "sleep", sleeps.append)
+    return sleeps
+
+def test_only_throttled_keys_are_resent_with_backoff(sleeps):
+    client = ThrottlingSearchClient({"doc-3": [429, 503], "doc-7": [503], "doc-9": [400]})
+    summary = index_sections("Retry_Test.pdf", sections(10), "index", client=client, concurrency=1)
+    assert client.calls == [[f"doc-{i}" for i in range(10)], ["doc-3", "doc-7"], ["doc-3"]]
+    assert summary["succeeded"] == 9 and summary["failed"] == {"doc-9": "status 400"} and summary["retries"] == 2
+    # Exponential backoff with jitter of up to half the delay
+    assert len(sleeps) == 2
+    assert 0.5 <= sleeps[0] <= 1.0 and 1.0 <= sleeps[1] <= 2.0
+
+def test_throttled_keys_fail_once_retries_are_exhausted(sleeps):
+    retries = cog_services.AZURE_SEARCH_INDEX_MAX_RETRIES
+    client = ThrottlingSearchClient({"doc-1": [429] * (retries + 1)})
+    summary = index_sections("Retry_Test.pdf", sections(3), "index", client=client, concurrency=1)
+    assert client.calls[1:] == [["doc-1"]] * retries
+    assert summary["succeeded"] == 2 and summary["failed"] == {"doc-1": "throttled, retries exhausted"}
+    assert sleeps == sorted(sleeps)
+
+def test_throttled_batch_is_resent_whole(sleeps):
+    client = ThrottlingSearchClient({"*": [503], "doc-2": [429]})
+    summary = index_sections("Retry_Test.pdf", sections(4), "index", client=client, concurrency=1)
+    assert client.calls == [[f"doc-{i}" for i in range(4)]] * 2 + [["doc-2"]]
+    assert summary["succeeded"] == 4 and summary["failed"] == {} and summary["retries"] == 2
+
+class KeyOrderedSearchClient:
+    # Key only searches over the given ids, recording the arguments of each
+    def __init__(self, ids, sortable: bool = True):
+        self.ids = sorted(ids)
+        self.sortable = sortable
+        self.calls = []
+
+    def search(self, search_text, filter=None, order_by=None, select=None, top=None, **kwargs):
+        self.calls.append({"filter": filter, "order_by": order_by, "top": top, **kwargs})
+        if order_by and not self.sortable:
+            raise ThrottlingSearchClient.batch_error(400)
+        ids = [id for id in self.ids if filter is None or id > filter.split("'")[1]]
+        return [{"id": id} for id in ids[:top]]
+
+def test_unfiltered_section_ids_are_paged_by_key():
+    client = KeyOrderedSearchClient([f"doc-{i:03}" for i in range(25)])
+    assert list_section_ids(None, client, page_size=10) == client.ids
+    assert [call["filter"] for call in client.calls] == [None, "id gt 'doc-009'", "id gt 'doc-019'"]
+    assert all(call["order_by"] == "id" and "skip" not in call for call in client.calls)
+
+def test_unsortable_index_falls_back_to_listing():
+    client = KeyOrderedSearchClient(["b", "a"], sortable=False)
+    assert list_section_ids(None, client, page_size=10) == ["a", "b"]
+    assert client.calls[-1]["order_by"] is None
+
+def test_section_ids_are_listed_from_the_search_service(fakes):
+    ids = list_section_ids(None, page_size=30)
+    assert ids == sorted(fakes.search.indexes["gptkbindex"])
+    assert len(ids) >= 200
@@ -0,0 +1,54 @@
+import os
+import threading
+import time
+
+import pytest
+
+from FlaskApp.ingestion import IngestionWorkers, JobQueue, SqliteJobQueue
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = SqliteJobQueue(os.path.join(tmp_path, "jobs.db"))
+    queue.lease_seconds = 0.5
+    return queue
+
+def test_job_queue_is_abstract():
+    with pytest.raises(TypeError):
+        JobQueue()
+
+def test_lease_is_renewed_while_a_job_runs_without_progress(queue):
+    runs = []
+    started = threading.Event()
+    finished = threading.Event()
+
+    def process(filename, progress):
+        runs.append(filename)
+        started.set()
+        # Longer than the lease, without reporting progress, like a slow Form Recognizer analysis
+        time.sleep(1.5)
+        finished.set()
+        return {"pages": 1}
+
+    workers = IngestionWorkers(queue, process, num_workers=1)
+    workers.heartbeat_interval = 0.1
+    job_id = workers.submit("file.pdf", "file.pdf")
+    assert started.wait(5)
+    deadline = time.time() + 1.2
+    while time.time() < deadline:
+        # Another worker looking for work must not get the running job
+        assert queue.claim() is None
+        time.sleep(0.05)
+    assert finished.wait(5)
+    for _ in range(50):
+        if queue.get(job_id)["status"] == "succeeded":
+            break
+        time.sleep(0.05)
+    assert queue.get(job_id)["status"] == "succeeded"
+    assert runs == ["file.pdf"]
+
+def test_job_of_a_dead_worker_is_claimed_again(queue):
+    job_id = queue.enqueue("file.pdf", "file.pdf")
+    assert queue.claim()["id"] == job_id
+    assert queue.claim() is None
+    time.sleep(0.6)
+    assert queue.claim()["id"] == job_id
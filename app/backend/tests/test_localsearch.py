@@ -0,0 +1,124 @@
+import math
+import os
+import threading
+from collections import Counter
+
+import pytest
+
+from FlaskApp.localsearch import B, K1, LocalSearchClient, generation_version, tokenize
+
+DOCUMENTS = [
+    {"id": "plan-0", "content": "The deductible for the Northwind Standard plan is $2,000 per year. Dental care is not covered.", "category": "plans", "sourcefile": "Standard.pdf"},
+    {"id": "plan-1", "content": "Northwind Health Plus covers dental and vision care. The deductible is $1,500.", "category": "plans", "sourcefile": "Plus.pdf"},
+    {"id": "plan-2", "content": "Vision exams are covered once a year. Glasses are covered every two years.", "category": "plans", "sourcefile": "Plus.pdf"},
+    {"id": "handbook-0", "content": "Employees accrue vacation every month. Ask your manager about the vacation policy.", "category": "handbook", "sourcefile": "Handbook.pdf"},
+    {"id": "handbook-1", "content": "The dental plan and the vision plan are chosen during open enrollment every year.", "category": "handbook", "sourcefile": "Handbook.pdf"},
+]
+
+@pytest.fixture
+def client(tmp_path):
+    client = LocalSearchClient(str(tmp_path))
+    # Rebuilt explicitly by the tests rather than by the timer
+    client.rebuild_delay = 60
+    client.upload_documents(DOCUMENTS)
+    client.rebuild()
+    return client
+
+def brute_force_bm25(documents, query: str) -> dict:
+    contents = {d["id"]: Counter(tokenize(d["content"])) for d in documents}
+    average_length = sum(sum(c.values()) for c in contents.values()) / len(contents)
+    scores = {}
+    for id, counts in contents.items():
+        length = sum(counts.values())
+        score = 0.0
+        for term in dict.fromkeys(tokenize(query)):
+            frequency = counts[term]
+            if frequency:
+                df = sum(1 for c in contents.values() if c[term])
+                idf = math.log(1 + (len(contents) - df + 0.5) / (df + 0.5))
+                score += idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average_length))
+        if score:
+            scores[id] = score
+    return scores
+
+@pytest.mark.parametrize("query", ["deductible", "dental vision", "vision plan year", "vacation policy manager"])
+def test_ranking_matches_brute_force_bm25(client, query):
+    expected = brute_force_bm25(DOCUMENTS, query)
+    results = list(client.search(query))
+    # Every matching document with its BM25 score, best first (ties in any order)
+    assert sorted(r["id"] for r in results) == sorted(expected)
+    for r in results:
+        assert r["@search.score"] == pytest.approx(expected[r["id"]], rel=1e-5)
+    scores = [r["@search.score"] for r in results]
+    assert scores == sorted(scores, reverse=True)
+
+def test_top_select_and_count(client):
+    results = client.search("dental vision", top=2, select=["id", "sourcefile"], include_total_count=True)
+    documents = list(results)
+    assert len(documents) == 2 and results.get_count() == 4
+    assert set(documents[0]) == {"id", "sourcefile", "@search.score"}
+
+@pytest.mark.parametrize("filter, ids", [("category eq 'handbook'", {"handbook-1"}),
+                                         ("category ne 'handbook'", {"plan-0", "plan-1", "plan-2"}),
+                                         ("category eq 'plans' and sourcefile ne 'Plus.pdf'", {"plan-0"}),
+                                         ("sourcefile eq 'Missing.pdf'", set())])
+def test_filters(client, filter, ids):
+    assert {r["id"] for r in client.search("dental vision deductible", filter=filter)} == ids
+
+def test_unsupported_filters_are_rejected(client):
+    with pytest.raises(ValueError):
+        client.search("dental", filter="content eq 'x'")
+    with pytest.raises(ValueError):
+        client.search("dental", filter="category gt 'a'")
+
+def test_captions_and_answers(client):
+    results = client.search("vision exams", query_caption="extractive|highlight-true", query_answer="extractive")
+    documents = list(results)
+    # The sentence with the most query terms, highlighted
+    caption = documents[0]["@search.captions"][0]
+    assert documents[0]["id"] == "plan-2"
+    assert caption.text == "Vision exams are covered once a year."
+    assert caption.highlights == "<em>Vision</em> <em>exams</em> are covered once a year."
+    # One answer, from the best passage that has every query term
+    answers = results.get_answers()
+    assert [(a.key, a.text) for a in answers] == [("plan-2", "Vision exams are covered once a year.")]
+    plain = list(client.search("vision exams", query_caption="extractive|highlight-false"))
+    assert plain[0]["@search.captions"][0].highlights is None
+    assert client.search("glasses vacation", query_answer="extractive").get_answers() == []
+
+def test_uploads_and_deletes_are_searchable_after_a_rebuild(client):
+    assert list(client.search("orthodontics")) == []
+    client.upload_documents([{"id": "plan-3", "content": "Orthodontics are covered for children.", "category": "plans", "sourcefile": "Plus.pdf"}])
+    # Still the old generation until the rebuild
+    assert list(client.search("orthodontics")) == []
+    client.rebuild()
+    assert [r["id"] for r in client.search("orthodontics")] == ["plan-3"]
+    client.delete_documents([{"id": "plan-3"}])
+    client.rebuild()
+    assert list(client.search("orthodontics")) == []
+
+def test_rebuild_keeps_the_generation_it_replaces(client):
+    for i in range(3):
+        client.upload_documents([{"id": f"extra-{i}", "content": f"Extra section {i}.", "category": "plans", "sourcefile": "Extra.pdf"}])
+        client.rebuild()
+    generations = sorted(generation_version(entry) for entry in os.listdir(client.path) if generation_version(entry) is not None)
+    assert generations == [3, 4]
+    assert not [entry for entry in os.listdir(client.path) if entry.endswith(".tmp")]
+
+def test_concurrent_rebuilds_from_several_processes(client):
+    # Clients of their own stand in for other worker processes sharing the directory
+    others = [LocalSearchClient(client.path) for _ in range(4)]
+    for other in others:
+        other.rebuild_delay = 60
+    client.upload_documents([{"id": "plan-3", "content": "Orthodontics are covered for children.", "category": "plans", "sourcefile": "Plus.pdf"}])
+    built = []
+    threads = [threading.Thread(target=lambda c=c: built.append(c.rebuild())) for c in others * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(index is not None and index.version == 2 for index in built)
+    # One generation was built and swapped in, the others found it up to date
+    assert len({index.path for index in built}) == 1
+    for c in others + [client]:
+        assert [r["id"] for r in c.search("orthodontics")] == ["plan-3"]
@@ -0,0 +1,60 @@
+import io
+import os
+
+import pandas as pd
+import pytest
+
+from FlaskApp.lookuptool import EmployeeDirectory, EmployeeTable
+
+CSV = """name,title,insurance,insurancegroup
+Employee1,Program Manager,Northwind Health Plus,Family
+Employee2,Software Engineer,Northwind Health Plus,Single
+John Smith,Designer,Northwind Standard,Family
+John Smith,Accountant,Northwind Standard,Single
+Mary Ann Jones,Support Engineer,Northwind Health Plus,Single
+,Contractor,None,None
+"""
+
+def read_csv():
+    return pd.read_csv(io.StringIO(CSV))
+
+def old_lookup(df, name):
+    # The lookup the table replaced, which matched whole names only
+    return df.loc[df["name"].str.lower() == name.lower()].to_string(index=False)
+
+@pytest.mark.parametrize("query, name", [("Employee1", "employee1"),
+                                         ("  EMPLOYEE2 ", "employee2"),
+                                         ("john smith", "john smith"),
+                                         ("mary", "mary ann jones"),
+                                         ("jones mary", "mary ann jones"),
+                                         ("nobody", "nobody"),
+                                         ("employee", "employee"),
+                                         ("smith", "john smith"),
+                                         ("nan", "nan")])
+def test_lookup_renders_like_the_dataframe(query, name):
+    df = read_csv()
+    assert EmployeeTable(df, "name").lookup(query) == old_lookup(df, name)
+
+def test_duplicate_keys_return_every_row():
+    df = read_csv()
+    response = EmployeeTable(df, "name").lookup("John Smith")
+    assert "Designer" in response and "Accountant" in response
+
+def test_misses_are_an_empty_dataframe():
+    df = read_csv()
+    table = EmployeeTable(df, "name")
+    assert table.lookup("nobody").startswith("Empty DataFrame")
+    # The row without a name is not indexed under "nan"
+    assert table.lookup("nan") == table.empty
+    assert "nan" not in table.index
+
+def test_directory_reloads_a_changed_file(tmp_path):
+    filename = tmp_path / "employees.csv"
+    filename.write_text(CSV)
+    directory = EmployeeDirectory(str(filename))
+    assert "Program Manager" in directory.lookup("employee1")
+    filename.write_text(CSV.replace("Program Manager", "Director"))
+    # Make sure the modification time moves on even on coarse clocks
+    stat = filename.stat()
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert "Director" in directory.lookup("employee1")
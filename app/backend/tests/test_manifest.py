@@ -0,0 +1,84 @@
+import io
+import os
+import threading
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+from FlaskApp import cog_services
+from FlaskApp.cog_services import process_pdf
+from FlaskApp.manifest import ManifestStore, page_hash
+
+from .conftest import workdir
+
+def text_pdf(texts, font: str = "Helvetica") -> bytes:
+    # One page per text, drawn with a standard font
+    writer = PdfWriter()
+    for text in texts:
+        page = writer.add_blank_page(612, 792)
+        contents = DecodedStreamObject()
+        contents.set_data(f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode())
+        page[NameObject("/Contents")] = writer._add_object(contents)
+        font_dict = DictionaryObject({NameObject("/Type"): NameObject("/Font"), NameObject("/Subtype"): NameObject("/Type1"),
+                                      NameObject("/BaseFont"): NameObject(f"/{font}")})
+        page[NameObject("/Resources")] = DictionaryObject({NameObject("/Font"): DictionaryObject({NameObject("/F1"): writer._add_object(font_dict)})})
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+def page_hashes(data: bytes):
+    return [page_hash(p) for p in PdfReader(io.BytesIO(data)).pages]
+
+def test_page_hash_covers_what_is_drawn():
+    first, second = page_hashes(text_pdf(["Deductibles", "Copays"]))
+    assert first is not None and first != second
+    assert page_hashes(text_pdf(["Deductibles", "Copays"])) == [first, second]
+    # The same content stream drawn with another font
+    assert page_hashes(text_pdf(["Deductibles", "Copays"], font="Courier"))[0] != first
+
+def ingest(name: str, texts):
+    filename = os.path.join(workdir, name)
+    with open(filename, "wb") as f:
+        f.write(text_pdf(texts))
+    return process_pdf(filename)
+
+def indexed_ids(fakes, sourcefile: str):
+    return sorted(id for id, document in fakes.search.indexes["gptkbindex"].items() if document["sourcefile"] == sourcefile)
+
+def test_unchanged_file_is_skipped(fakes):
+    texts = ["Medical", "Dental", "Vision"]
+    assert ingest("Manifest_Unchanged.pdf", texts)["pages_changed"] == 3
+    fakes.formrecognizer.calls.clear()
+    assert ingest("Manifest_Unchanged.pdf", texts) == {"unchanged": True}
+    assert fakes.formrecognizer.calls == {}
+
+def test_only_a_changed_page_is_analyzed_again(fakes, monkeypatch):
+    ingest("Manifest_Changed.pdf", ["Medical", "Dental", "Vision"])
+    analyzed = []
+    get_document_text = cog_services.get_document_text
+    monkeypatch.setattr(cog_services, "get_document_text", lambda filename, progress, pages: analyzed.append(pages) or get_document_text(filename, progress, pages))
+    result = ingest("Manifest_Changed.pdf", ["Medical", "Orthodontics", "Vision"])
+    assert result["pages_changed"] == 1 and analyzed == [[1]]
+    assert result["sections_changed"] > 0
+    assert result["blobs"]["uploaded"] == 1
+
+def test_sections_of_removed_pages_leave_the_index(fakes):
+    first = ingest("Manifest_Removed.pdf", ["Medical", "Dental", "Vision"])
+    before = indexed_ids(fakes, "Manifest_Removed.pdf")
+    result = ingest("Manifest_Removed.pdf", ["Medical", "Dental"])
+    after = indexed_ids(fakes, "Manifest_Removed.pdf")
+    assert result["pages_changed"] == 0 and result["sections_removed"] > 0
+    assert len(after) == len(before) - result["sections_removed"]
+    assert after == sorted(cog_services.manifest_store.load("Manifest_Removed.pdf")["sections"])
+    assert first["sections_changed"] == len(before)
+
+def test_concurrent_saves_leave_no_temporary_files(tmp_path):
+    store = ManifestStore(str(tmp_path))
+    manifests = [{"file_hash": str(i), "pages": [{"hash": str(i), "text": "x" * 10000}]} for i in range(8)]
+    threads = [threading.Thread(target=lambda m=m: [store.save("file.pdf", m) for _ in range(20)]) for m in manifests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert os.listdir(tmp_path) == ["file.pdf.json"]
+    assert store.load("file.pdf") in manifests
@@ -0,0 +1,61 @@
+import re
+import threading
+
+from FlaskApp.metrics import Counter, Histogram, Registry
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{([a-zA-Z_][a-zA-Z0-9_]*="(\\.|[^"\\])*",?)*\})? (-?[0-9.e+-]+|\+Inf|NaN)$')
+
+def test_exited_threads_are_folded_into_the_totals():
+    counter = Counter("jobs_total", "", ["result"])
+    histogram = Histogram("job_seconds", "", buckets=(1.0,))
+    def work():
+        for _ in range(3):
+            counter.inc("ok")
+            histogram.observe(0.5)
+    threads = [threading.Thread(target=work) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert counter.shards == [] and histogram.shards == []
+    counter.inc("ok")
+    assert list(counter.samples()) == [("jobs_total", {"result": "ok"}, 61.0)]
+    assert list(histogram.samples()) == [("job_seconds_bucket", {"le": "1.0"}, 60), ("job_seconds_bucket", {"le": "+Inf"}, 60),
+                                         ("job_seconds_sum", {}, 30.0), ("job_seconds_count", {}, 60)]
+
+def test_render_escapes_label_values():
+    registry = Registry()
+    registry.counter("errors_total", "Errors", ["message"]).inc('a "quoted"\\path\nline')
+    assert registry.render() == '# HELP errors_total Errors\n# TYPE errors_total counter\nerrors_total{message="a \\"quoted\\"\\\\path\\nline"} 1.0\n'
+
+def test_metrics_exposition_format(client):
+    assert client.post("/api/ask", json={"approach": "rtr", "question": "What is the deductible?", "overrides": {}}).status_code == 200
+    r = client.get("/api/metrics")
+    assert r.status_code == 200
+    assert r.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    text = r.get_data(as_text=True)
+    assert text.endswith("\n")
+
+    types = {}
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            continue
+        if line.startswith("# TYPE "):
+            _, _, name, type = line.split(" ")
+            assert type in ("counter", "gauge", "histogram") and name not in types
+            types[name] = type
+            continue
+        match = SAMPLE.match(line)
+        assert match, line
+        name = match.group(1)
+        # Every sample follows the TYPE line of its metric
+        assert name in types or re.sub("_(bucket|sum|count)$", "", name) in types, line
+        samples[line.rsplit(" ", 1)[0]] = float(line.rsplit(" ", 1)[1])
+
+    assert samples['http_requests_total{route="/api/ask",approach="rtr",status="200"}'] >= 1
+    assert types["http_request_duration_seconds"] == "histogram"
+    buckets = [value for key, value in samples.items() if key.startswith('http_request_duration_seconds_bucket{route="/api/ask",approach="rtr",')]
+    assert buckets == sorted(buckets)
+    assert samples['http_request_duration_seconds_bucket{route="/api/ask",approach="rtr",le="+Inf"}'] == samples['http_request_duration_seconds_count{route="/api/ask",approach="rtr"}']
+    assert {"cache_hits_total", "openai_endpoint_calls_total", "rate_limiter_calls_total"} <= set(types)
@@ -0,0 +1,86 @@
+import re
+import time
+
+import pytest
+
+from FlaskApp import promptbudget
+from FlaskApp.promptbudget import PromptBudget, count_tokens, get_encoding, truncate_tokens
+
+class WordEncoding:
+    # One token per word, so that budgets are easy to work out
+    def encode(self, text, disallowed_special=()):
+        return re.findall(r"\S+\s*", text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+@pytest.fixture
+def words(monkeypatch):
+    monkeypatch.setattr(promptbudget, "encodings", {"words": WordEncoding()})
+    return "words"
+
+def sentence(n: int, word: str = "word") -> str:
+    return " ".join([word] * n)
+
+def test_leading_items_that_fit_are_kept(words):
+    budget = PromptBudget(words, 100, 20)
+    assert budget.reserve("instructions", sentence(30)) == 30
+    kept = budget.fit("sources", [sentence(20, "first"), sentence(20, "second"), sentence(20, "third")])
+    # 50 tokens are left, two sources and their separators take 42, the 7 left are too few to cut the third short
+    assert kept == [sentence(20, "first"), sentence(20, "second")]
+    assert budget.report() == {"instructions": 30, "sources": 42, "total": 72}
+
+def test_partly_fitting_source_is_truncated(words):
+    budget = PromptBudget(words, 200, 20)
+    kept = budget.fit("sources", [sentence(100, "first"), sentence(100, "second")])
+    assert kept[0] == sentence(100, "first")
+    # 180 - 101 tokens leave room for 78 words of the second source and its separator
+    assert count_tokens(kept[1], words) == 78 and kept[1].startswith("second")
+    assert budget.remaining == 0
+
+def test_max_tokens_caps_a_part(words):
+    budget = PromptBudget(words, 1000, 0)
+    assert budget.fit("history", [sentence(10)] * 5, max_tokens=25, truncate=False, separator_tokens=0) == [sentence(10)] * 2
+    assert budget.remaining == 980
+
+def test_chat_history_keeps_the_most_recent_whole_turns(words, monkeypatch):
+    from FlaskApp import chat_approaches
+    from FlaskApp.approaches import chatreadretrieveread
+    approach = chat_approaches["rrr"]
+    monkeypatch.setattr(approach, "chatgpt_deployment", words)
+    monkeypatch.setattr(approach, "history_max_tokens", 1000)
+    monkeypatch.setattr(chatreadretrieveread, "AZURE_OPENAI_CHATGPT_CONTEXT_TOKENS", approach.max_tokens + 2000)
+    history = [{"user": sentence(200, f"question{i}"), "bot": sentence(200, f"answer{i}")} for i in range(10)]
+    history.append({"user": "What is the deductible?"})
+    prompt, tokens = approach.build_prompt(history, {}, [sentence(300, "snippet")])
+    # Earlier turns of about 400 tokens get at most half of what's left after the instructions and the question,
+    # which is room for the two most recent
+    assert "What is the deductible?" in prompt
+    assert all(f"question{i}" in prompt and f"answer{i}" in prompt for i in (8, 9))
+    assert not any(f"question{i}" in prompt or f"answer{i}" in prompt for i in range(8))
+    assert tokens["history"] <= (2000 - tokens["instructions"] - tokens["question"]) // 2
+    assert prompt.count("snippet") == 300
+    assert tokens["total"] <= 2000
+
+def test_failed_tokenizer_load_is_retried_after_a_backoff(monkeypatch):
+    loads = []
+    def load_encoding(model):
+        loads.append(model)
+        if len(loads) == 1:
+            raise ConnectionError("no network")
+        return WordEncoding()
+    monkeypatch.setattr(promptbudget, "tiktoken", object())
+    monkeypatch.setattr(promptbudget, "load_encoding", load_encoding)
+    monkeypatch.setattr(promptbudget, "encodings", {})
+    monkeypatch.setattr(promptbudget, "encoding_failures", {})
+    monkeypatch.setattr(promptbudget, "ENCODING_RETRY_SECONDS", 0.2)
+    # Approximated while the tokenizer can't be loaded, without trying again before the backoff is over
+    assert get_encoding("retry-model") is None
+    assert count_tokens(sentence(8), "retry-model") == (len(sentence(8)) + 3) // 4
+    assert truncate_tokens("abcdefghij", 2, "retry-model") == "abcdefgh"
+    assert loads == ["retry-model"]
+    time.sleep(0.25)
+    assert isinstance(get_encoding("retry-model"), WordEncoding)
+    assert count_tokens(sentence(8), "retry-model") == 8
+    assert loads == ["retry-model"] * 2
+    assert promptbudget.encoding_failures == {}
@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+import pytest
+
+from FlaskApp import clients
+from FlaskApp.ratelimit import RateLimiter, RateLimitExceeded
+
+def test_calls_over_the_request_limit_are_delayed():
+    # 600 requests per minute allows bursts of 100, then one every 0.1 seconds
+    limiter = RateLimiter(0, 600)
+    for _ in range(100):
+        assert limiter.reserve("endpoint", "gpt", 10) == 0
+    start = time.monotonic()
+    limiter.acquire("endpoint", "gpt", 10)
+    assert time.monotonic() - start >= 0.08
+    metrics = limiter.metrics()
+    assert (metrics["admitted"], metrics["delayed"], metrics["rejected"]) == (101, 1, 0)
+    assert metrics["buckets"][0]["waiting"] == 0
+
+def test_calls_over_the_token_limit_wait_for_their_tokens():
+    # 6000 tokens per minute allows bursts of 1000 tokens, refilled at 100 a second
+    limiter = RateLimiter(6000, 0, max_wait=10)
+    assert limiter.reserve("endpoint", "gpt", 1000) == 0
+    assert limiter.reserve("endpoint", "gpt", 500) == pytest.approx(5, abs=0.1)
+    # Later calls queue behind the tokens reserved by earlier ones
+    assert limiter.reserve("endpoint", "gpt", 200) == pytest.approx(7, abs=0.1)
+
+def test_async_calls_are_delayed_without_blocking_the_loop():
+    limiter = RateLimiter(0, 600)
+    async def run():
+        start = time.monotonic()
+        await asyncio.gather(*(limiter.acquire_async("endpoint", "gpt", 10) for _ in range(103)))
+        return time.monotonic() - start
+    assert asyncio.run(run()) >= 0.25
+    assert limiter.metrics()["delayed"] == 3
+
+def test_calls_waiting_longer_than_max_wait_are_rejected():
+    limiter = RateLimiter(6000, 0, max_wait=2)
+    limiter.reserve("endpoint", "gpt", 1000)
+    with pytest.raises(RateLimitExceeded) as e:
+        limiter.reserve("endpoint", "gpt", 500)
+    assert e.value.retry_after == 5 and e.value.headers == {"retry-after": "5"}
+    # A rejected call takes nothing, a smaller one still fits within max_wait
+    assert limiter.reserve("endpoint", "gpt", 150) == pytest.approx(1.5, abs=0.1)
+    assert limiter.metrics()["rejected"] == 1
+
+def test_calls_beyond_a_full_queue_are_rejected():
+    limiter = RateLimiter(0, 60, max_queue=2, max_wait=100)
+    for _ in range(10):
+        limiter.reserve("endpoint", "gpt", 1)
+    assert limiter.reserve("endpoint", "gpt", 1) > 0
+    assert limiter.reserve("endpoint", "gpt", 1) > 0
+    with pytest.raises(RateLimitExceeded):
+        limiter.reserve("endpoint", "gpt", 1)
+    # Other endpoint/deployment pairs have queues of their own
+    assert limiter.reserve("other", "gpt", 1) == 0
+    limiter.done_waiting("endpoint", "gpt")
+    assert limiter.reserve("endpoint", "gpt", 1) > 0
+
+def test_deployment_limits_override_the_defaults():
+    limiter = RateLimiter(0, 0, {"gpt": {"rpm": 6}}, max_wait=1)
+    limiter.reserve("endpoint", "gpt", 1)
+    with pytest.raises(RateLimitExceeded):
+        limiter.reserve("endpoint", "gpt", 1)
+    for _ in range(100):
+        assert limiter.reserve("endpoint", "embedding", 1) == 0
+
+def test_ask_answers_429_when_rate_limited(client, fakes, monkeypatch):
+    # One request per 10 seconds, and no waiting for the next one
+    monkeypatch.setattr(clients, "rate_limiter", RateLimiter(0, 6, max_wait=1))
+    body = {"approach": "rtr", "question": "What is the deductible?", "overrides": {}}
+    assert client.post("/api/ask", json=body).status_code == 200
+    r = client.post("/api/ask", json=body)
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) >= 1
+    assert "error" in r.get_json()
+    assert fakes.openai.calls["completions"] == 1
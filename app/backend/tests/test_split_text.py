@@ -0,0 +1,48 @@
+import pytest
+
+from FlaskApp.cog_services import build_page_map, split_text
+
+# Golden output of split_text for fixed page maps, pinned as the (start, end, page) of each section in the joined
+# page text. The values come from the original character by character implementation, so any change to where
+# sections start and end shows up here.
+
+def prose(page: int, sentences: int) -> str:
+    return " ".join(f"Sentence {i} of page {page} says the plan covers item {page * 100 + i}." for i in range(sentences)) + " "
+
+def table(rows: int, closed: bool = True) -> str:
+    cells = "".join(f"<tr><td>Tier {i}</td><td>${i * 15} copay</td></tr>" for i in range(rows))
+    return "<table>" + cells + ("</table>" if closed else "")
+
+def words(first: int, count: int) -> str:
+    return " ".join(f"word{i}" for i in range(first, first + count))
+
+PAGE_MAPS = {
+    "prose": build_page_map([prose(page, 20) for page in range(3)]),
+    "empty_pages": build_page_map(["", prose(1, 15), "", "", prose(4, 15), ""]),
+    "all_empty": build_page_map(["", "", ""]),
+    "short": build_page_map(["Just one short sentence. "]),
+    "table_across_sections": build_page_map([prose(0, 12) + table(30), prose(1, 10)]),
+    "unclosed_table": build_page_map([prose(0, 14) + table(20, closed=False), table(25, closed=False) + prose(1, 5)]),
+    "table_longer_than_section": build_page_map([prose(0, 3) + table(80), prose(1, 8)]),
+    "no_sentence_endings": build_page_map([words(0, 300) + " ", words(300, 200)]),
+    "no_word_breaks": build_page_map(["x" * 1500, "y" * 1200]),
+}
+
+GOLDEN = {
+    "prose": [(0, 1019, 0), (915, 1963, 0), (1857, 2907, 1), (2801, 3120, 2)],
+    "empty_pages": [(0, 1044, 1), (940, 1570, 4)],
+    "all_empty": [],
+    # Text no longer than the overlap never makes a section
+    "short": [],
+    "table_across_sections": [(0, 1090, 0), (603, 1678, 0), (1266, 2441, 0)],
+    "unclosed_table": [(0, 1079, 0), (707, 1806, 0), (1502, 2677, 0), (1736, 2926, 1)],
+    "table_longer_than_section": [(0, 1092, 0), (900, 2088, 0), (1884, 3072, 0), (2808, 3991, 0), (3887, 4096, 1)],
+    "no_sentence_endings": [(0, 1098, 0), (906, 2098, 0), (1906, 3098, 0), (2698, 3889, 1)],
+    "no_word_breaks": [(0, 1101, 0), (903, 2102, 0), (1500, 2699, 1)],
+}
+
+@pytest.mark.parametrize("name", sorted(PAGE_MAPS))
+def test_split_text_golden(name):
+    page_map = PAGE_MAPS[name]
+    all_text = "".join(text for _, _, text in page_map)
+    assert list(split_text(page_map)) == [(all_text[start:end], page) for start, end, page in GOLDEN[name]]
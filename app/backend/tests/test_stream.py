@@ -0,0 +1,52 @@
+import json
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+from FlaskApp.approaches import chatreadretrieveread, retrievethenread
+
+ROUTES = [("/api/ask/stream", {"approach": "rtr", "question": "What is the deductible?", "overrides": {}}, retrievethenread),
+          ("/api/chat/stream", {"approach": "rrr", "history": [{"user": "What is the deductible?"}], "overrides": {}}, chatreadretrieveread)]
+
+def parse_events(body: str):
+    events = []
+    for message in body.split("\n\n"):
+        if message:
+            lines = dict(line.split(": ", 1) for line in message.split("\n"))
+            events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+@pytest.mark.parametrize("route, body, module", ROUTES)
+def test_events_arrive_in_order(client, route, body, module):
+    r = client.post(route, json=body)
+    assert r.status_code == 200 and r.mimetype == "text/event-stream"
+    events = parse_events(r.get_data(as_text=True))
+    names = [name for name, _ in events]
+    # The data points first, then the answer in pieces, then the end
+    assert names[0] == "data_points" and names[-1] == "end"
+    assert set(names[1:-1]) == {"answer"} and len(names) > 3
+    assert events[0][1]["data_points"]
+    answer = "".join(data["text"] for name, data in events if name == "answer")
+    assert answer.startswith("Contoso's plans cover this")
+    assert "Prompt:" in events[-1][1]["thoughts"]
+
+@pytest.mark.parametrize("route, body, module", ROUTES)
+def test_failed_completion_ends_with_an_error_event(client, monkeypatch, route, body, module):
+    # Only the streamed answer fails, after its first piece, the chat's query generation still gets a completion
+    completion_client = module.completion_client
+    def failing_stream():
+        yield SimpleNamespace(choices=[SimpleNamespace(text="Contoso's ")])
+        raise openai.error.ServiceUnavailableError("The server is overloaded")
+    def failing_completion(*args, stream=False, **kwargs):
+        return failing_stream() if stream else completion_client(*args, **kwargs)
+    monkeypatch.setattr(module, "completion_client", failing_completion)
+    r = client.post(route, json=body)
+    assert r.status_code == 200
+    events = parse_events(r.get_data(as_text=True))
+    assert [name for name, _ in events] == ["data_points", "answer", "error"]
+    assert events[-1][1] == {"error": "The server is overloaded"}
+
+def test_unknown_approach_is_rejected(client):
+    r = client.post("/api/ask/stream", json={"approach": "nope", "question": "What is the deductible?", "overrides": {}})
+    assert r.status_code == 400
@@ -0,0 +1,64 @@
+import logging
+import os
+
+import pytest
+
+from benchmarks.load import sample_pdf
+from FlaskApp import tracing
+from FlaskApp.cog_services import process_pdf
+from FlaskApp.tracing import noop_span, span, start_trace
+
+from .conftest import workdir
+
+def span_tree(timings):
+    return [(s["name"], s["depth"]) for s in timings["spans"]]
+
+def test_ask_spans(client):
+    r = client.post("/api/ask", json={"approach": "rtr", "question": "What is the deductible?", "overrides": {"include_timings": True}})
+    assert r.status_code == 200
+    timings = r.get_json()["timings"]
+    assert span_tree(timings) == [("ask", 0), ("retrieve", 1), ("build_prompt", 1), ("completion", 1)]
+    assert set(timings["stages"]) == {"retrieve", "build_prompt", "completion"}
+
+def test_chat_spans(client):
+    r = client.post("/api/chat", json={"approach": "rrr", "history": [{"user": "What is the deductible?"}], "overrides": {"include_timings": True}})
+    assert r.status_code == 200
+    assert span_tree(r.get_json()["timings"]) == [("chat", 0), ("generate_query", 1), ("completion", 2), ("retrieve", 1), ("build_prompt", 1), ("completion", 1)]
+
+def test_speculative_chat_spans(client, caplog):
+    caplog.set_level(logging.INFO)
+    r = client.post("/api/chat", json={"approach": "rrr", "history": [{"user": "What is the deductible?"}], "overrides": {"include_timings": True, "speculative_retrieval": True}})
+    assert r.status_code == 200
+    timings = r.get_json()["timings"]
+    # The question's search and the query rewrite run concurrently, the rewritten query's results are then merged in
+    assert sorted(span_tree(timings)) == sorted([("chat", 0), ("speculative_retrieve", 1), ("retrieve", 2), ("generate_query", 2), ("completion", 3),
+                                                 ("retrieve", 2), ("build_prompt", 1), ("completion", 1)])
+    assert set(timings) == {"total_ms", "stages", "spans"}
+    # The stage timings are logged once, from the trace
+    assert [m for m in caplog.messages if "timings" in m and m.startswith(("chat", "Chat"))] == [m for m in caplog.messages if m.startswith("chat timings: ")]
+    assert len([m for m in caplog.messages if m.startswith("chat timings: ")]) == 1
+
+def test_process_pdf_spans(fakes):
+    filename = os.path.join(workdir, "Tracing_Test.pdf")
+    with open(filename, "wb") as f:
+        f.write(sample_pdf(2, "tracing test"))
+    with start_trace("ingest", file="Tracing_Test.pdf") as trace:
+        process_pdf(filename)
+    assert span_tree(trace.timings()) == [("ingest", 0), ("hash_pages", 1), ("upload_blobs", 1), ("analyze_document", 1), ("index_sections", 1)]
+
+def test_untraced_spans_are_noops():
+    assert span("retrieve") is noop_span
+    assert start_trace("ask", False) is noop_span
+    with start_trace("ask", False) as trace, span("retrieve") as s:
+        s.set(query="deductible")
+    assert trace.timings() is None
+
+@pytest.mark.parametrize("route, body", [("/api/ask", {"approach": "rtr", "question": "What is the deductible?", "overrides": {}}),
+                                         ("/api/chat", {"approach": "rrr", "history": [{"user": "What is the deductible?"}], "overrides": {}})])
+def test_requests_without_timings_record_no_spans(client, monkeypatch, route, body):
+    recorded = []
+    monkeypatch.setattr(tracing.Trace, "add", lambda self, s: recorded.append(s.name))
+    r = client.post(route, json=body)
+    assert r.status_code == 200
+    assert "timings" not in r.get_json()
+    assert recorded == []
@@ -1,4 +1,4 @@
-import { AskRequest, AskResponse, ChatRequest, UploadFileRequest, UploadFileResponse } from "./models";
+import { AskRequest, AskResponse, ChatRequest, StreamEvent, UploadFileRequest, UploadFileResponse, UploadJobStatus } from "./models";
 
 export async function askApi(options: AskRequest): Promise<AskResponse> {
   const response = await fetch("/api/ask", {
@@ -17,7 +17,8 @@ export async function askApi(options: AskRequest): Promise<AskResponse> {
               prompt_template: options.overrides?.promptTemplate,
               prompt_template_prefix: options.overrides?.promptTemplatePrefix,
               prompt_template_suffix: options.overrides?.promptTemplateSuffix,
-              exclude_category: options.overrides?.excludeCategory
+              exclude_category: options.overrides?.excludeCategory,
+              include_timings: options.overrides?.includeTimings
           }
       })
   });
@@ -48,7 +49,9 @@ export async function chatApi(options: ChatRequest): Promise<AskResponse> {
               prompt_template_prefix: options.overrides?.promptTemplatePrefix,
               prompt_template_suffix: options.overrides?.promptTemplateSuffix,
               exclude_category: options.overrides?.excludeCategory,
-              suggest_followup_questions: options.overrides?.suggestFollowupQuestions
+              suggest_followup_questions: options.overrides?.suggestFollowupQuestions,
+              speculative_retrieval: options.overrides?.speculativeRetrieval,
+              include_timings: options.overrides?.includeTimings
           }
       })
   });
@@ -61,6 +64,60 @@ export async function chatApi(options: ChatRequest): Promise<AskResponse> {
   return parsedResponse;
 }
 
+// Posts to one of the /stream routes and calls onEvent for every server-sent event as it arrives
+async function streamApi(url: string, body: object, onEvent: (event: StreamEvent) => void): Promise<void> {
+  const response = await fetch(url, {
+      method: "POST",
+      headers: {
+          "Content-Type": "application/json"
+      },
+      body: JSON.stringify(body)
+  });
+  if (response.status > 299 || !response.ok || !response.body) {
+      const parsedResponse = await response.json();
+      throw Error(parsedResponse.error || "Unknown error");
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  for (;;) {
+      const { done, value } = await reader.read();
+      if (done) {
+          break;
+      }
+      buffer += decoder.decode(value, { stream: true });
+      let separator;
+      while ((separator = buffer.indexOf("\n\n")) >= 0) {
+          const message = buffer.slice(0, separator);
+          buffer = buffer.slice(separator + 2);
+          const event = message.match(/^event: (.*)$/m)?.[1];
+          const data = message.match(/^data: (.*)$/m)?.[1];
+          if (event && data) {
+              onEvent({ event, data: JSON.parse(data) } as StreamEvent);
+          }
+      }
+  }
+}
+
+export async function chatStreamApi(options: ChatRequest, onEvent: (event: StreamEvent) => void): Promise<void> {
+  return streamApi("/api/chat/stream", {
+      history: options.history,
+      approach: options.approach,
+      overrides: {
+          semantic_ranker: options.overrides?.semanticRanker,
+          semantic_captions: options.overrides?.semanticCaptions,
+          top: options.overrides?.top,
+          temperature: options.overrides?.temperature,
+          prompt_template: options.overrides?.promptTemplate,
+          prompt_template_prefix: options.overrides?.promptTemplatePrefix,
+          prompt_template_suffix: options.overrides?.promptTemplateSuffix,
+          exclude_category: options.overrides?.excludeCategory,
+          suggest_followup_questions: options.overrides?.suggestFollowupQuestions
+      }
+  }, onEvent);
+}
+
 export function getCitationFilePath(citation: string): string {
   return `/api/content/${citation}`;
 }
@@ -83,3 +140,15 @@ export async function uploadApi(
 
   return parsedResponse;
 }
+
+export async function uploadStatusApi(jobId: string): Promise<UploadJobStatus> {
+  const response = await fetch(`/api/upload/${jobId}`);
+
+  const parsedResponse = await response.json();
+
+  if (response.status > 299 || !response.ok) {
+    throw Error(parsedResponse.error || `Failed to get upload status: ${response.statusText}`);
+  }
+
+  return parsedResponse;
+}
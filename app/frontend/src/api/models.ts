@@ -14,6 +14,8 @@ export type AskRequestOverrides = {
     promptTemplatePrefix?: string;
     promptTemplateSuffix?: string;
     suggestFollowupQuestions?: boolean;
+    speculativeRetrieval?: boolean;
+    includeTimings?: boolean;
 };
 
 export type AskRequest = {
@@ -22,10 +24,27 @@ export type AskRequest = {
     overrides?: AskRequestOverrides;
 };
 
+export type TimingSpan = {
+    name: string;
+    depth: number;
+    start_ms: number;
+    duration_ms: number;
+    error?: string;
+};
+
+export type Timings = {
+    total_ms?: number;
+    stages?: Record<string, number>;
+    spans?: TimingSpan[];
+    [key: string]: number | string | Record<string, number> | TimingSpan[] | undefined;
+};
+
 export type AskResponse = {
     answer: string;
     thoughts: string | null;
     data_points: string[];
+    timings?: Timings;
+    tool_calls?: Record<string, number>;
     error?: string;
 };
 
@@ -34,6 +53,12 @@ export type ChatTurn = {
     bot?: string;
 };
 
+export type StreamEvent =
+    | { event: "data_points"; data: { data_points: string[] } }
+    | { event: "answer"; data: { text: string } }
+    | { event: "end"; data: { thoughts: string; followup_questions?: string[] } }
+    | { event: "error"; data: { error: string } };
+
 export type ChatRequest = {
     history: ChatTurn[];
     approach: Approaches;
@@ -48,4 +73,21 @@ export type UploadFileResponse = {
     success: boolean;
     message?: string;
     error?: string;
+    jobs?: Record<string, string>;
+};
+
+export type UploadStageStatus = {
+    status: "pending" | "running" | "done" | "failed";
+    done: number;
+    total: number | null;
+};
+
+export type UploadJobStatus = {
+    id: string;
+    file: string;
+    status: "queued" | "running" | "succeeded" | "failed";
+    stage: string | null;
+    stages: Record<string, UploadStageStatus>;
+    result?: any;
+    error?: string;
 };
\ No newline at end of file
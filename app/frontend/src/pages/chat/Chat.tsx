@@ -4,7 +4,7 @@ import { SparkleFilled } from "@fluentui/react-icons";
 
 import styles from "./Chat.module.css";
 
-import { chatApi, Approaches, AskResponse, ChatRequest, ChatTurn } from "../../api";
+import { chatStreamApi, Approaches, AskResponse, ChatRequest, ChatTurn } from "../../api";
 import { Answer, AnswerError, AnswerLoading } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
 import { ExampleList } from "../../components/Example";
@@ -26,6 +26,7 @@ const Chat = () => {
     const chatMessageStreamEnd = useRef<HTMLDivElement | null>(null);
 
     const [isLoading, setIsLoading] = useState<boolean>(false);
+    const [isStreaming, setIsStreaming] = useState<boolean>(false);
     const [error, setError] = useState<unknown>();
 
     const [activeCitation, setActiveCitation] = useState<string>();
@@ -56,12 +57,32 @@ const Chat = () => {
                     suggestFollowupQuestions: useSuggestFollowupQuestions
                 }
             };
-            const result = await chatApi(request);
-            setAnswers([...answers, [question, result]]);
+            // The answer is shown as it streams in, from the first "answer" event on
+            let result: AskResponse = { answer: "", thoughts: null, data_points: [] };
+            await chatStreamApi(request, event => {
+                switch (event.event) {
+                    case "data_points":
+                        result = { ...result, data_points: event.data.data_points };
+                        return;
+                    case "answer":
+                        result = { ...result, answer: result.answer + event.data.text };
+                        break;
+                    case "end":
+                        result = { ...result, thoughts: event.data.thoughts };
+                        break;
+                    case "error":
+                        throw Error(event.data.error);
+                }
+                setIsLoading(false);
+                setIsStreaming(true);
+                setAnswers([...answers, [question, result]]);
+            });
         } catch (e) {
+            setAnswers(answers);
             setError(e);
         } finally {
             setIsLoading(false);
+            setIsStreaming(false);
         }
     };
 
@@ -127,7 +148,7 @@ const Chat = () => {
     return (
         <div className={styles.container}>
             <div className={styles.commandsContainer}>
-                <ClearChatButton className={styles.commandButton} onClick={clearChat} disabled={!lastQuestionRef.current || isLoading} />
+                <ClearChatButton className={styles.commandButton} onClick={clearChat} disabled={!lastQuestionRef.current || isLoading || isStreaming} />
                 <SettingsButton className={styles.commandButton} onClick={() => setIsConfigPanelOpen(!isConfigPanelOpen)} />
             </div>
             <div className={styles.chatRoot}>
@@ -182,7 +203,7 @@ const Chat = () => {
                         <QuestionInput
                             clearOnSend
                             placeholder="Type a new question (e.g. does my plan cover annual eye exams?)"
-                            disabled={isLoading}
+                            disabled={isLoading || isStreaming}
                             onSend={question => makeApiRequest(question)}
                         />
                     </div>
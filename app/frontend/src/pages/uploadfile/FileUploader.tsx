@@ -2,13 +2,44 @@ import { useRef, useState, useEffect, useCallback } from "react";
 import { PrimaryButton,Spinner} from "@fluentui/react";
 import { useDropzone } from "react-dropzone";
 import styles from "./FileUploader.module.css";
-import { UploadFileRequest, UploadFileResponse } from "../../api/models";
-import { uploadApi } from "../../api/api";
+import { UploadFileRequest, UploadFileResponse, UploadJobStatus } from "../../api/models";
+import { uploadApi, uploadStatusApi } from "../../api/api";
+
+const POLL_INTERVAL_MS = 2000;
 
 const FileUploader: React.FC = () => {
   const [files, setFiles] = useState<File[]>([]);
   const [uploadStatus, setUploadStatus] = useState<UploadFileResponse[]>([]);
   const [isUploading, setIsUploading] = useState<boolean>(false);
+  const [jobs, setJobs] = useState<Record<string, UploadJobStatus>>({});
+
+  // Uploaded PDFs are ingested in the background after the 202, so follow each job until it succeeds or fails
+  const pollJob = async (jobId: string) => {
+    for (;;) {
+      try {
+        const job = await uploadStatusApi(jobId);
+        setJobs((prevJobs) => ({ ...prevJobs, [jobId]: job }));
+        if (job.status === "succeeded" || job.status === "failed") {
+          return;
+        }
+      } catch (error: unknown) {
+        const message = error instanceof Error ? error.message : "Unknown error";
+        setJobs((prevJobs) => ({ ...prevJobs, [jobId]: { ...prevJobs[jobId], id: jobId, status: "failed", error: message } }));
+        return;
+      }
+      await new Promise((resolve) => setTimeout(resolve, POLL_INTERVAL_MS));
+    }
+  };
+
+  const renderJobs = () => {
+    return Object.values(jobs).map((job) => (
+      <li key={job.id}>
+        {job.file}: {job.status}
+        {job.status === "running" && job.stage ? ` (${job.stage})` : ""}
+        {job.status === "failed" && job.error ? ` - ${job.error}` : ""}
+      </li>
+    ));
+  };
 
   const onDrop = useCallback((acceptedFiles: File[]) => {
     setFiles(acceptedFiles);
@@ -36,6 +67,10 @@ const FileUploader: React.FC = () => {
       const response = await uploadApi(request);
       const responseData = await response;
       setUploadStatus((prevStatus) => [...prevStatus, responseData]);
+      Object.entries(responseData.jobs || {}).forEach(([file, jobId]) => {
+        setJobs((prevJobs) => ({ ...prevJobs, [jobId]: { id: jobId, file, status: "queued", stage: null, stages: {} } }));
+        pollJob(jobId);
+      });
       setIsUploading(false);
       setFiles([]);
       console.log(responseData);
@@ -76,6 +111,7 @@ const FileUploader: React.FC = () => {
         {files.length > 0 && <ul>{renderFiles()}</ul>}
       </div>
       <div className={styles.oneshotBottomSection}>
+        {Object.keys(jobs).length > 0 && <ul>{renderJobs()}</ul>}
         </div>
       <PrimaryButton
         className={styles.primaryButton}